@@ -0,0 +1 @@
+x
\ No newline at end of file
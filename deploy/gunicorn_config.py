@@ -6,6 +6,8 @@ bind = "127.0.0.1:8000"
 backlog = 2048
 
 # 工作进程
+# 视频字节传输较多时建议配合 MEDIA_OFFLOAD_MODE=nginx，
+# worker只做鉴权，文件由nginx发送，少量4K观众不会再占满所有worker
 workers = multiprocessing.cpu_count() * 2 + 1
 worker_class = "sync"
 worker_connections = 1000
@@ -25,6 +27,20 @@ loglevel = "info"
 # 进程名称
 proc_name = "movieweb"
 
+
+def on_starting(server):
+    """
+    在master进程中探测FFmpeg能力（不受worker的timeout限制），
+    结果写入能力文件，worker启动后直接读取
+    """
+    import os
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'movieweb.settings')
+    django.setup()
+    from movies.capabilities import capability_registry
+    capability_registry.warm()
+
 # 用户和组
 # user = "www-data"
 # group = "www-data"
@@ -1,6 +1,9 @@
 from django.contrib import admin
+from django.utils import timezone
 from django.utils.html import format_html
-from .models import Movie, WatchHistory, MovieRating, Series, ScrapingLog
+from .models import Movie, WatchHistory, MovieRating, Series, ScrapingLog, TranscodeQuota, TranscodeSession
+from .quotas import limits_for, usage
+from .transcoding import TranscodingService
 
 
 @admin.register(Series)
@@ -142,4 +145,71 @@ class ScrapingLogAdmin(admin.ModelAdmin):
             return format_html('<span style="color: green;">✓ 成功</span>')
         else:
             return format_html('<span style="color: red;">✗ 失败</span>')
-    success_status.short_description = '状态' 
\ No newline at end of file
+    success_status.short_description = '状态' 
+
+
+def format_quota(used, limit, unit=''):
+    """用量/限额，接近或超过限额时标红"""
+    if not limit:
+        return f'{used}{unit} / 不限'
+    color = 'red' if used >= limit else ('orange' if used >= limit * 0.8 else 'green')
+    return format_html('<span style="color: {};">{}{} / {}{}</span>', color, used, unit, limit, unit)
+
+
+@admin.register(TranscodeQuota)
+class TranscodeQuotaAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'max_sessions', 'max_encoder_seconds', 'current_usage']
+    search_fields = ['user__username', 'group__name']
+    autocomplete_fields = ['user', 'group']
+    
+    def current_usage(self, obj):
+        if not obj.user_id:
+            return '-'
+        current = usage(obj.user)
+        return format_html(
+            '{} 会话，{}', current['sessions'],
+            format_quota(round(current['encoder_seconds']), obj.max_encoder_seconds, '秒'),
+        )
+    current_usage.short_description = '当前用量'
+
+
+@admin.register(TranscodeSession)
+class TranscodeSessionAdmin(admin.ModelAdmin):
+    list_display = ['user', 'movie', 'kind', 'resolution', 'status', 'encoder_seconds_display', 'user_usage', 'started_at', 'last_access', 'pid']
+    list_filter = ['kind', 'end_reason', 'resolution', 'started_at']
+    search_fields = ['user__username', 'movie__title', 'session_id']
+    readonly_fields = ['session_id', 'kind', 'user', 'movie', 'resolution', 'pid', 'started_at', 'last_access', 'ended_at', 'end_reason', 'encoder_seconds']
+    actions = ['stop_sessions']
+    
+    def status(self, obj):
+        if obj.is_active:
+            return format_html('<span style="color: green;">● 运行中</span>')
+        return obj.get_end_reason_display() or '已结束'
+    status.short_description = '状态'
+    
+    def encoder_seconds_display(self, obj):
+        return f'{obj.encoder_seconds:.0f}秒'
+    encoder_seconds_display.short_description = '编码器时间'
+    
+    def user_usage(self, obj):
+        limits = limits_for(obj.user)
+        current = usage(obj.user)
+        if limits is None:
+            return f"{current['sessions']} 会话，{current['encoder_seconds']:.0f}秒（不受限制）"
+        return format_html(
+            '{}，{}',
+            format_quota(current['sessions'], limits['max_sessions'], ' 会话'),
+            format_quota(round(current['encoder_seconds']), limits['encoder_seconds'], '秒'),
+        )
+    user_usage.short_description = '用户当前用量'
+    
+    @admin.action(description='停止所选的运行中会话')
+    def stop_sessions(self, request, queryset):
+        stopped = 0
+        for session in queryset.filter(ended_at__isnull=True):
+            # 即时分段转码的会话结束后原令牌的片段请求被拒绝；点播缓存任务只结束配额记录
+            if session.kind == 'realtime':
+                TranscodingService.request_stop_realtime(session.session_id)
+            stopped += 1
+        queryset.filter(ended_at__isnull=True).update(ended_at=timezone.now(), end_reason='stopped')
+        self.message_user(request, f'已停止 {stopped} 个转码会话')
@@ -0,0 +1,194 @@
+"""
+实时转码准入控制
+- 负载以"720p实时单位"衡量：一个720p会话以1.0x速度转码为1个单位，其他分辨率按像素数折算；
+  直接复制视频的会话不占用编码器，不计入
+- 负载按整台主机统计：占用调度器槽位的任务来自主机范围的槽位文件（SlotRegistry），
+  实时会话的速度和进度读取其输出目录中的progress.json，与会话在哪个worker进程中无关
+- 容量：配置的容量基线（default_capacity）和最近 capacity_window 秒内同一编码器上所有正在运行
+  （未被节流暂停）的会话 Σ(权重 × FFmpeg报告的speed) 的最大值，两者取较大的一个
+- 需求：每个实时会话稳定状态下只需要1.0x（领先播放器过多时会被暂停），
+  其他占用槽位的转码任务（点播缓存、即时分段）各按1个单位计算
+- 新请求加入后的需求不超过 容量×headroom 时接受；否则尝试更低的档位，
+  仍然不可行时排队：会话等到容量足够后再启动，响应中给出预计等待时间
+  （现有会话陆续转码完成、释放出足够容量的时间）和不需要编码的替代播放方式
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+from .progress import read_progress
+from .transcoding import (
+    TRANSCODING_CONFIG, TranscodingService, REMUX_RESOLUTION, TRANSCODED_DIR,
+    transcoding_service, transcode_scheduler, scheduler_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+# 折算负载的基准分辨率
+BASE_PIXELS = 1280 * 720
+
+# speed超过该时间（秒）未更新时视为不可靠（刚启动或被暂停）
+SPEED_STALE_SECONDS = 5
+
+_samples = {}  # 资源池 -> deque[(时间, Σ权重×speed)]
+_samples_lock = threading.Lock()
+
+
+def admission_config():
+    return TRANSCODING_CONFIG['admission']
+
+
+def session_weight(resolution, plan=None):
+    """会话占用的编码器负载（720p实时单位），直接复制视频时为0"""
+    if plan and plan['video'] == 'copy':
+        return 0.0
+    res_config = TRANSCODING_CONFIG['resolutions'].get(resolution)
+    if res_config is None:
+        return 0.0
+    return res_config['width'] * res_config['height'] / BASE_PIXELS
+
+
+def _pool_jobs(pool):
+    """
+    整台主机上占用资源池槽位的任务：[(权重, 进度)]
+
+    实时会话按分辨率折算权重，进度读取输出目录中的progress.json（可能为空）；其他任务按1个单位、没有进度
+    """
+    jobs = []
+    for record in transcode_scheduler.holders(pool):
+        session_id = record.get('session_id')
+        if session_id:
+            weight = session_weight(record.get('resolution'), {'video': record.get('video')})
+            progress = read_progress(os.path.join(TRANSCODED_DIR, f"realtime_{session_id}")) or {}
+        else:
+            weight, progress = 1.0, {}
+        jobs.append((weight, progress))
+    return jobs
+
+
+def _speed(progress, now):
+    """进度中的speed，超过 SPEED_STALE_SECONDS 未更新（刚启动、被暂停或已结束）时返回None"""
+    updated_at = progress.get('updated_at')
+    if progress.get('finished') or not updated_at or now - updated_at >= SPEED_STALE_SECONDS:
+        return None
+    return progress.get('speed')
+
+
+def observed_capacity(pool, jobs=None):
+    """记录当前的 Σ(权重×speed)，返回时间窗口内的最大值；没有可靠的观测值时返回None"""
+    now = time.time()
+    throughput = 0.0
+    for weight, progress in jobs if jobs is not None else _pool_jobs(pool):
+        speed = _speed(progress, now)
+        if speed:
+            throughput += weight * speed
+
+    window = admission_config()['capacity_window']
+    with _samples_lock:
+        samples = _samples.setdefault(pool, deque())
+        if throughput > 0:
+            samples.append((now, throughput))
+        while samples and now - samples[0][0] > window:
+            samples.popleft()
+        return max((value for _, value in samples), default=None)
+
+
+def pool_load(pool):
+    """资源池当前的负载（整台主机）：容量、需求以及每个会话预计还需要的转码时间"""
+    config = admission_config()
+    jobs = _pool_jobs(pool)
+    capacity = max(config['default_capacity'].get(pool, 1.0), observed_capacity(pool, jobs) or 0.0)
+
+    now = time.time()
+    demand = 0.0
+    remaining = []  # (预计剩余秒数, 权重)
+    for weight, progress in jobs:
+        demand += weight
+        if progress.get('duration'):
+            # 被节流的会话跟随播放进度，按1.0x估计
+            speed = _speed(progress, now) or 1.0
+            left = max(0.0, progress['duration'] - (progress.get('out_time') or 0.0))
+            remaining.append((left / max(speed, 0.1), weight))
+
+    return {
+        'capacity': round(capacity, 2),
+        'demand': round(demand, 2),
+        'sessions': len(jobs),
+        'remaining': sorted(remaining),
+    }
+
+
+def _fits(load, weight):
+    return load['demand'] + weight <= load['capacity'] * admission_config()['headroom']
+
+
+def estimate_wait(load, weight):
+    """现有会话陆续完成后释放出足够容量的预计时间（秒），无法估计时返回None"""
+    demand = load['demand']
+    limit = load['capacity'] * admission_config()['headroom']
+    if weight > limit:
+        return None
+    for seconds, freed in load['remaining']:
+        demand -= freed
+        if demand + weight <= limit:
+            return int(seconds) + 1
+    return None
+
+
+def check_capacity(resolution, plan, pool):
+    """资源池现在能否再加入一个会话；不能时给出预计等待时间（秒，无法估计时为None）"""
+    load = pool_load(pool)
+    weight = session_weight(resolution, plan)
+    if weight == 0 or _fits(load, weight):
+        return {'fits': True, 'eta': None}
+    return {'fits': False, 'eta': estimate_wait(load, weight)}
+
+
+def evaluate(video_path, resolution, available_resolutions):
+    """
+    实时转码请求的准入决策
+
+    返回 {'admit': True, 'resolution': ...}，降档时带 downgraded_from；转码负载已满且没有可以降到的档位时
+    带 queued=True（会话排队等待容量，见 start_realtime_transcoding 的 wait_for_capacity）、
+    'alternative': 'remux'/'原画'、'eta': 秒数或None 和 'load'。
+    """
+    config = admission_config()
+    if not config['enabled']:
+        return {'admit': True, 'resolution': resolution}
+
+    video_info = TranscodingService.get_video_info(video_path)
+    plan = TranscodingService.stream_plan(video_info, resolution)
+    weight = session_weight(resolution, plan)
+    if weight == 0:
+        return {'admit': True, 'resolution': resolution}
+
+    pool = scheduler_pool(transcoding_service.get_best_encoder(), plan)
+    load = pool_load(pool)
+    if _fits(load, weight):
+        return {'admit': True, 'resolution': resolution}
+
+    # 更低的档位
+    height = TRANSCODING_CONFIG['resolutions'][resolution]['height']
+    for name in available_resolutions:
+        res_config = TRANSCODING_CONFIG['resolutions'][name]
+        if config['min_height'] <= res_config['height'] < height:
+            lower_plan = TranscodingService.stream_plan(video_info, name)
+            if _fits(load, session_weight(name, lower_plan)):
+                logger.info(f"⬇️ 转码负载已满，降档: {resolution} -> {name}, 负载: {load['demand']}/{load['capacity']}")
+                return {'admit': True, 'resolution': name, 'downgraded_from': resolution}
+
+    remux_plan = TranscodingService.stream_plan(video_info, REMUX_RESOLUTION)
+    alternative = REMUX_RESOLUTION if remux_plan['video'] == 'copy' else '原画'
+    eta = estimate_wait(load, weight)
+    logger.warning(f"🚦 转码负载已满，{resolution} 排队等待容量: 负载 {load['demand']}/{load['capacity']}, 预计等待: {eta}")
+    return {
+        'admit': True,
+        'resolution': resolution,
+        'queued': True,
+        'alternative': alternative,
+        'eta': eta,
+        'load': {key: load[key] for key in ('capacity', 'demand', 'sessions')},
+    }
@@ -0,0 +1,289 @@
+"""
+视频和HLS端点的ASGI异步版本
+
+仅在 movieweb.asgi 中通过 movieweb.urls_asgi 挂载，路径与同步版本完全相同；
+页面视图仍由gunicorn同步worker处理。长时间的视频下载不再占用worker，
+文件读取在线程池中执行，单个进程即可同时服务大量观众。
+
+注意：Django 4.2 的 require_GET 等装饰器不支持异步视图，这里手动检查请求方法。
+"""
+
+import os
+import asyncio
+import logging
+
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.http import (
+    Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotFound, JsonResponse,
+)
+from django.urls import reverse
+
+from .models import Movie
+from .streaming import (
+    async_serve_file, guess_content_type,
+    file_validators, conditional_response, set_validators, vary_etag,
+)
+from .hls import (
+    segment_cache_control, playlist_cache_control, IMMUTABLE_CACHE_CONTROL,
+    realtime_output_path, render_playlist, PLAYLIST_CONTENT_TYPE, segment_content_type,
+)
+from .signing import verify_playback_token, load_playback_token, edge_enabled, edge_expiry, edge_transcoded_url
+from .pacing import pacing_enabled
+from .transcoding import TranscodingService, transcoding_service, FingerprintPending
+from .ondemand import get_ondemand, playback_scope, SegmentUnavailable
+from .quotas import playback_session_active
+
+logger = logging.getLogger(__name__)
+
+
+async def serve_video(request, pk):
+    """提供视频文件流服务，支持HTTP Range请求（异步）"""
+    try:
+        movie = await Movie.objects.aget(pk=pk)
+    except Movie.DoesNotExist:
+        raise Http404("视频不存在")
+
+    try:
+        bitrate = None
+        if pacing_enabled():
+            video_info = await asyncio.to_thread(TranscodingService.get_video_info, movie.file_path)
+            bitrate = video_info['bitrate'] if video_info else None
+
+        response = await async_serve_file(
+            request, movie.file_path,
+            content_type=guess_content_type(movie.file_path, default='video/mp4'),
+            cache_control='public, max-age=86400',
+            bitrate=bitrate,
+        )
+
+        response['Content-Disposition'] = f'inline; filename="{movie.file_name}"'
+        response['X-Content-Type-Options'] = 'nosniff'
+
+        return response
+
+    except FileNotFoundError:
+        raise Http404("视频文件不存在")
+    except Exception as e:
+        raise Http404(f"无法播放视频: {str(e)}")
+
+
+async def serve_realtime_hls(request, session_id, filename):
+    """直接提供实时HLS文件（异步）"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET'])
+
+    token = request.GET.get('token')
+    if not verify_playback_token(token, session_id):
+        return HttpResponseForbidden('无效的播放令牌')
+
+    # 输出目录中只提供播放列表和片段
+    content_type = segment_content_type(filename)
+    if content_type is None and not filename.endswith('.m3u8'):
+        return HttpResponseNotFound('HLS文件不存在')
+
+    hls_path = realtime_output_path(session_id, filename)
+
+    if content_type is not None:
+        await asyncio.to_thread(
+            TranscodingService.note_realtime_playhead, session_id, filename, request.META.get('HTTP_RANGE')
+        )
+        cache_control = await asyncio.to_thread(segment_cache_control, hls_path)
+        try:
+            return await async_serve_file(
+                request, hls_path, content_type=content_type, cache_control=cache_control,
+                cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+            )
+        except FileNotFoundError:
+            return HttpResponseNotFound('HLS文件不存在')
+
+    await asyncio.to_thread(TranscodingService.note_realtime_access, session_id)
+    cache_control = await asyncio.to_thread(playlist_cache_control, hls_path)
+
+    try:
+        stat_result = await asyncio.to_thread(os.stat, hls_path)
+    except FileNotFoundError:
+        return HttpResponseNotFound('HLS文件不存在')
+    etag, last_modified = file_validators(stat_result)
+    etag = vary_etag(etag, token)
+    not_modified = conditional_response(request, etag, last_modified, cache_control)
+    if not_modified is not None:
+        not_modified['Access-Control-Allow-Origin'] = '*'
+        return not_modified
+
+    try:
+        modified_content = await asyncio.to_thread(
+            render_playlist, hls_path, stat_result,
+            f'/api/realtime/{session_id}/ts/', urlencode({'token': token})
+        )
+
+        response = HttpResponse(modified_content, content_type=PLAYLIST_CONTENT_TYPE)
+        set_validators(response, etag, last_modified, cache_control)
+        response['Access-Control-Allow-Origin'] = '*'
+
+        return response
+
+    except Exception as e:
+        return HttpResponseNotFound(f'读取HLS文件失败: {str(e)}')
+
+
+async def serve_realtime_segment(request, session_id, filename):
+    """直接提供实时HLS片段文件（异步）"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET'])
+
+    if not verify_playback_token(request.GET.get('token'), session_id):
+        return HttpResponseForbidden('无效的播放令牌')
+
+    content_type = segment_content_type(filename)
+    if content_type is None:
+        return HttpResponseNotFound('视频片段不存在')
+
+    await asyncio.to_thread(
+        TranscodingService.note_realtime_playhead, session_id, filename, request.META.get('HTTP_RANGE')
+    )
+    segment_path = realtime_output_path(session_id, filename)
+
+    cache_control = await asyncio.to_thread(segment_cache_control, segment_path)
+    try:
+        response = await async_serve_file(
+            request, segment_path, content_type=content_type, cache_control=cache_control,
+            cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+        )
+    except FileNotFoundError:
+        return HttpResponseNotFound('视频片段不存在')
+    response['Access-Control-Allow-Origin'] = '*'
+
+    return response
+
+
+async def ondemand_segment(request, pk, resolution, index):
+    """即时转码片段（异步）：等待转码期间不占用worker"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET'])
+
+    payload = load_playback_token(request.GET.get('token'), playback_scope(pk, resolution))
+    if payload is None:
+        return HttpResponseForbidden('无效的播放令牌')
+    if not await sync_to_async(playback_session_active)(payload):
+        return HttpResponseForbidden('转码会话已结束')
+
+    try:
+        movie = await Movie.objects.aget(pk=pk)
+    except Movie.DoesNotExist:
+        raise Http404("视频不存在")
+
+    try:
+        transcode = await asyncio.to_thread(get_ondemand, movie.file_path, resolution)
+        segment_path = await asyncio.to_thread(transcode.get_segment, index)
+    except (FileNotFoundError, ValueError, IndexError):
+        return HttpResponseNotFound('视频片段不存在')
+    except SegmentUnavailable as e:
+        logger.warning(f"⚠️ {e}")
+        response = HttpResponse(str(e), status=503)
+        response['Retry-After'] = '1'
+        return response
+
+    try:
+        return await async_serve_file(
+            request, segment_path, content_type='video/MP2T', cache_control=IMMUTABLE_CACHE_CONTROL, cacheable=True
+        )
+    except FileNotFoundError:
+        return HttpResponseNotFound('视频片段不存在')
+
+
+async def realtime_segment(request, session_id, segment_name):
+    """获取实时HLS视频片段（异步）"""
+    return await serve_realtime_segment(request, session_id, segment_name)
+
+
+async def serve_hls_video(request, pk, resolution):
+    """提供HLS视频流（异步）"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        movie = await Movie.objects.aget(pk=pk)
+    except Movie.DoesNotExist:
+        raise Http404("视频不存在")
+
+    try:
+        try:
+            hls_path = await asyncio.to_thread(transcoding_service.get_hls_path, movie, resolution)
+        except FingerprintPending:
+            hls_path = None
+
+        stat_result = None
+        if hls_path is not None:
+            try:
+                stat_result = await asyncio.to_thread(os.stat, hls_path)
+            except FileNotFoundError:
+                pass
+        if stat_result is None:
+            return JsonResponse({
+                'success': False,
+                'error': f'转码文件不存在: {resolution}',
+                'need_transcode': True
+            })
+
+        cache_control = await asyncio.to_thread(playlist_cache_control, hls_path)
+        etag, last_modified = file_validators(stat_result)
+
+        segment_prefix = reverse('serve_hls_video', args=[pk, resolution])
+        if edge_enabled():
+            expires = edge_expiry()
+            segment_prefix = edge_transcoded_url(hls_path.parent.name, expires=expires)
+            etag = vary_etag(etag, expires)
+
+        not_modified = conditional_response(request, etag, last_modified, cache_control)
+        if not_modified is not None:
+            return not_modified
+
+        modified_content = await asyncio.to_thread(render_playlist, hls_path, stat_result, segment_prefix)
+
+        response = JsonResponse({
+            'success': True,
+            'content': modified_content,
+            'content_type': PLAYLIST_CONTENT_TYPE
+        })
+        set_validators(response, etag, last_modified, cache_control)
+
+        return response
+
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        })
+
+
+async def serve_hls_segment(request, pk, resolution, filename):
+    """提供HLS视频片段（异步）"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET'])
+
+    # 输出目录中还有任务信息和日志，只提供片段文件
+    content_type = segment_content_type(filename)
+    if content_type is None:
+        raise Http404(f"视频片段不存在: {filename}")
+
+    try:
+        movie = await Movie.objects.aget(pk=pk)
+    except Movie.DoesNotExist:
+        raise Http404("视频不存在")
+
+    try:
+        transcode_id = await asyncio.to_thread(transcoding_service.generate_transcode_id, movie, resolution)
+    except (OSError, ValueError, FingerprintPending):
+        raise Http404(f"视频片段不存在: {filename}")
+    segment_path = transcoding_service.transcode_dir / transcode_id / filename
+
+    cache_control = await asyncio.to_thread(segment_cache_control, segment_path)
+    try:
+        return await async_serve_file(
+            request, segment_path, content_type=content_type, cache_control=cache_control,
+            cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+        )
+    except FileNotFoundError:
+        raise Http404(f"视频片段不存在: {filename}")
@@ -0,0 +1,316 @@
+"""
+主机FFmpeg能力注册表
+- 每台主机探测一次：FFmpeg版本、编码器、硬件加速方式、滤镜和封装格式
+- 对 TRANSCODING_CONFIG['encoders'] 中FFmpeg列出的每个编码器，用测试源做一次只有几帧的编码（输出到null），
+  证明编码器确实可用：编译了 h264_nvenc 但没有显卡或驱动时，列表中有该编码器，测试编码会失败
+- 结果写入 settings.FFMPEG_CAPABILITIES_FILE，以FFmpeg可执行文件的路径、大小和mtime为键，
+  FFmpeg升级或替换后自动重新探测
+- 所有worker进程共用同一份结果：探测期间持有锁文件（内容为持有者PID），其他进程等待结果写入后直接读取；
+  只有持有者已退出或锁超过 PROBE_LOCK_STALE_SECONDS 时才接管
+- 在worker启动之外预热（gunicorn的 on_starting 钩子或 manage_transcoding capabilities），
+  测试编码耗时较长，不能计入worker的启动超时；请求路径只读取进程内缓存，每隔 REVALIDATE_SECONDS 秒stat一次可执行文件，
+  不会为查询能力启动FFmpeg
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+import subprocess
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 可执行文件的检查间隔（秒）
+REVALIDATE_SECONDS = 60
+
+# 单个探测命令和测试编码的超时时间（秒）
+PROBE_TIMEOUT = 20
+
+# 探测锁：超过该时间（秒）未完成视为持有者已卡住，可以接管
+PROBE_LOCK_STALE_SECONDS = 300
+PROBE_POLL_INTERVAL = 0.5
+
+# 测试编码：硬件编码器有最小分辨率限制，使用常见的小尺寸
+TEST_SOURCE = 'testsrc2=size=320x240:rate=25'
+TEST_FRAMES = 5
+
+
+def ffmpeg_binary():
+    return shutil.which('ffmpeg') or 'ffmpeg'
+
+
+def binary_key(path):
+    """可执行文件的身份：路径、大小和mtime，找不到时返回None"""
+    try:
+        real_path = os.path.realpath(path)
+        stat_result = os.stat(real_path)
+    except OSError:
+        return None
+    return {'path': real_path, 'size': stat_result.st_size, 'mtime_ns': stat_result.st_mtime_ns}
+
+
+def _run(args, timeout=PROBE_TIMEOUT):
+    """运行命令，返回 (返回码, 输出)；无法运行或超时时返回码为None"""
+    try:
+        result = subprocess.run(
+            args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, encoding='utf-8', errors='replace', timeout=timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return None, str(e)
+    return result.returncode, result.stdout
+
+
+def parse_listing(output):
+    """
+    解析 -encoders / -muxers 的输出：说明部分之后以一行短横线分隔，
+    之后每行为 "标志 名称 描述"，返回名称列表（-muxers 的一行可以用逗号列出多个名称）
+    """
+    names = []
+    started = False
+    for line in output.splitlines():
+        tokens = line.split()
+        if not started:
+            started = bool(tokens) and set(tokens[0]) == {'-'}
+            continue
+        if len(tokens) >= 2:
+            names.extend(tokens[1].split(','))
+    return names
+
+
+def parse_filters(output):
+    """解析 -filters 的输出：每行为 "标志 名称 输入->输出 描述" """
+    return [
+        tokens[1] for tokens in (line.split() for line in output.splitlines())
+        if len(tokens) >= 3 and '->' in tokens[2]
+    ]
+
+
+def parse_hwaccels(output):
+    """解析 -hwaccels 的输出：标题行之后每行一个名称"""
+    lines = output.splitlines()
+    for index, line in enumerate(lines):
+        if line.strip().endswith(':'):
+            return [name.strip() for name in lines[index + 1:] if name.strip()]
+    return []
+
+
+def test_encoder(binary, name, options=''):
+    """用测试源编码几帧，编码器可用时返回 (True, '')，否则返回 (False, 错误输出)"""
+    returncode, output = _run([
+        binary, '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-f', 'lavfi', '-i', TEST_SOURCE,
+        '-frames:v', str(TEST_FRAMES),
+        '-c:v', name, *options.split(),
+        '-f', 'null', '-',
+    ])
+    return returncode == 0, '' if returncode == 0 else output.strip()[-500:]
+
+
+def probe(binary=None):
+    """探测FFmpeg的全部能力（会启动多次FFmpeg，耗时数秒）"""
+    from .transcoding import TRANSCODING_CONFIG
+
+    binary = binary or ffmpeg_binary()
+    started = time.time()
+    returncode, version_output = _run([binary, '-hide_banner', '-version'])
+    if returncode != 0:
+        logger.error(f"❌ 无法运行FFmpeg: {binary} - {version_output.strip()[-200:]}")
+        return {
+            'key': binary_key(binary), 'available': False, 'error': version_output.strip()[-500:],
+            'version': None, 'encoders': [], 'hwaccels': [], 'filters': [], 'muxers': [], 'tested': {},
+            'probed_at': time.time(),
+        }
+
+    encoders = parse_listing(_run([binary, '-hide_banner', '-encoders'])[1])
+    capabilities = {
+        'key': binary_key(binary),
+        'available': True,
+        'version': version_output.splitlines()[0] if version_output else '',
+        'encoders': encoders,
+        'hwaccels': parse_hwaccels(_run([binary, '-hide_banner', '-hwaccels'])[1]),
+        'filters': parse_filters(_run([binary, '-hide_banner', '-filters'])[1]),
+        'muxers': parse_listing(_run([binary, '-hide_banner', '-muxers'])[1]),
+        'tested': {},  # 编码器 -> {'ok': bool, 'error': str}
+    }
+
+    # 只测试配置中用到、且FFmpeg列出的编码器
+    for encoder_type, config in TRANSCODING_CONFIG['encoders'].items():
+        for codec in ('h264', 'hevc'):
+            name = config.get(codec)
+            if not name or name not in encoders or name in capabilities['tested']:
+                continue
+            ok, error = test_encoder(binary, name, config['options'])
+            capabilities['tested'][name] = {'ok': ok, 'error': error}
+            if ok:
+                logger.info(f"✅ 编码器测试通过: {name} ({encoder_type})")
+            else:
+                logger.warning(f"⚠️ 编码器测试失败: {name} ({encoder_type}) - {error[-200:]}")
+
+    capabilities['probed_at'] = time.time()
+    logger.info(f"🔍 FFmpeg能力探测完成，耗时 {capabilities['probed_at'] - started:.1f}秒: {capabilities['version']}")
+    return capabilities
+
+
+class CapabilityRegistry:
+    """FFmpeg能力的进程内缓存，数据来自所有worker进程共用的能力文件"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._data = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """当前FFmpeg的能力；能力文件不存在或FFmpeg已变化时探测（只有一个进程探测，其他进程等待结果）"""
+        now = time.time()
+        data = self._data
+        if data is not None and now - self._checked_at < REVALIDATE_SECONDS:
+            return data
+        with self._lock:
+            key = binary_key(ffmpeg_binary())
+            if self._data is None or self._data['key'] != key:
+                self._data = self._load(key) or self._probe_shared(key)
+            self._checked_at = time.time()
+            return self._data
+
+    def refresh(self):
+        """删除能力文件并重新探测（更换显卡或驱动后使用，FFmpeg本身没有变化）"""
+        with self._lock:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self._data = None
+            self._checked_at = 0.0
+        return self.get()
+
+    def warm(self):
+        """启动时预热，探测失败不影响启动"""
+        try:
+            data = self.get()
+        except Exception as e:
+            logger.error(f"FFmpeg能力探测失败: {e}")
+            return None
+        working = [name for name, result in data['tested'].items() if result['ok']]
+        logger.info(f"🔍 FFmpeg能力: {data['version']}, 可用编码器: {', '.join(working) or '无'}")
+        return data
+
+    def encoder_works(self, name):
+        """编码器已列出且测试编码成功"""
+        result = self.get()['tested'].get(name)
+        return bool(result and result['ok'])
+
+    def has(self, kind, name):
+        """kind为 encoders / hwaccels / filters / muxers"""
+        return name in self.get()[kind]
+
+    # ---------- 内部实现 ----------
+
+    def _load(self, key):
+        """读取能力文件，键与当前FFmpeg一致时返回"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if data.get('key') == key else None
+
+    def _probe_shared(self, key):
+        """
+        持有锁文件时探测并写入能力文件；锁被其他进程持有时等待其结果
+
+        只接管持有者已退出（锁文件中的PID不存在）或超过 PROBE_LOCK_STALE_SECONDS 的锁，
+        持有者仍在探测时一直等待，不会出现多个进程同时探测
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        lock_path = f"{self.path}.lock"
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                data = self._load(key)
+                if data is not None:
+                    return data
+                if self._lock_abandoned(lock_path):
+                    continue
+                time.sleep(PROBE_POLL_INTERVAL)
+
+        try:
+            os.write(fd, str(os.getpid()).encode())
+            lock_ino = os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+        try:
+            # 其他进程可能在等待锁期间已经写好了结果
+            data = self._load(key)
+            if data is None:
+                data = probe()
+                tmp_path = f"{self.path}.{os.getpid()}"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            return data
+        finally:
+            # 锁已被接管时（本进程被判定为过期）不能删除新持有者的锁
+            if _lock_owner(lock_path) == (os.getpid(), lock_ino):
+                try:
+                    os.unlink(lock_path)
+                except FileNotFoundError:
+                    pass
+
+    def _lock_abandoned(self, lock_path):
+        """持有者已退出或锁已过期时删除锁文件，返回是否删除"""
+        owner = _lock_owner(lock_path)
+        if owner is None:
+            return False
+        pid, ino = owner
+        try:
+            stale = time.time() - os.path.getmtime(lock_path) > PROBE_LOCK_STALE_SECONDS
+        except OSError:
+            return False
+        # 刚创建的锁可能还没写入PID，只按时间判断
+        if not stale and (pid is None or pid_alive(pid)):
+            return False
+        # 删除前确认仍是刚才检查的那个锁文件
+        if _lock_owner(lock_path) != owner:
+            return False
+        logger.warning(f"⚠️ FFmpeg能力探测锁的持有者({pid})已退出或超时，接管探测")
+        try:
+            os.unlink(lock_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+def _lock_owner(lock_path):
+    """锁文件中的 (PID, inode)；锁文件不存在时返回None，PID尚未写入时PID为None"""
+    try:
+        with open(lock_path, encoding='utf-8') as f:
+            content = f.read().strip()
+            ino = os.fstat(f.fileno()).st_ino
+    except OSError:
+        return None
+    return (int(content) if content.isdigit() else None), ino
+
+
+def pid_alive(pid):
+    """本机进程是否仍在运行"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        # Windows等平台不支持信号0时，只按锁的时间判断
+        return True
+    return True
+
+
+capability_registry = CapabilityRegistry(settings.FFMPEG_CAPABILITIES_FILE)
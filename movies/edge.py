@@ -0,0 +1,395 @@
+"""
+独立的asyncio媒体边缘服务器
+- 只提供媒体库文件和 media/transcoded/ 下的转码输出，由 run_media_edge 命令启动
+- 只接受Django签发的HMAC签名URL（见 movies.signing），不访问数据库和会话
+- 支持Range（含多区间）、304/412条件请求和If-Range，与Django视图行为一致
+- 通过 loop.sendfile 零拷贝发送文件区间，单区间响应使用与Django相同的页缓存策略
+- 支持SO_REUSEPORT，同一台机器可以运行多个边缘进程共享端口
+- /_edge/metrics 提供访问统计（仅限本机访问）
+"""
+
+import os
+import json
+import stat
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import multiprocessing
+from http import HTTPStatus
+from urllib.parse import unquote
+
+from django.utils.http import http_date
+
+from .signing import (
+    verify_edge_path, library_roots, transcoded_root,
+    EdgeSignatureError, EdgeSignatureExpired,
+)
+from .streaming import (
+    file_validators, conditional_response, resolve_ranges, RangeNotSatisfiable,
+    multipart_parts, parts_length, guess_content_type,
+)
+from .readahead import Readahead
+from .hls import segment_cache_control, playlist_cache_control, PLAYLIST_CONTENT_TYPE, SEGMENT_CONTENT_TYPES
+
+logger = logging.getLogger(__name__)
+
+# 请求头最大长度
+MAX_HEADER_SIZE = 16 * 1024
+
+# 空闲长连接超时时间（秒）
+KEEPALIVE_TIMEOUT = 15
+
+# 媒体库文件的缓存策略，与 serve_video 一致
+LIBRARY_CACHE_CONTROL = 'public, max-age=86400'
+
+# mimetypes在不同系统上对HLS文件的识别不一致，这里固定下来
+CONTENT_TYPES = {
+    '.m3u8': PLAYLIST_CONTENT_TYPE,
+    **SEGMENT_CONTENT_TYPES,
+}
+
+METRICS_PATH = '/_edge/metrics'
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges, ETag',
+}
+
+
+class EdgeRequest:
+    """streaming中条件请求和Range辅助函数所需的最小请求对象（method / path / META）"""
+
+    def __init__(self, method, path, headers):
+        self.method = method
+        self.path = path
+        self.META = {
+            'HTTP_' + name.upper().replace('-', '_'): value
+            for name, value in headers.items()
+        }
+
+
+class EdgeMetrics:
+    """访问统计（每个进程独立计数）"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.connections_active = 0
+        self.connections_total = 0
+        self.requests_total = 0
+        self.requests_in_flight = 0
+        self.status = {}
+        self.kinds = {}
+        self.bytes_sent = 0
+        self.denied = 0
+        self.expired = 0
+        self.transfer_seconds = 0.0
+
+    def record(self, status, sent, duration, kind=None):
+        self.requests_total += 1
+        self.status[status] = self.status.get(status, 0) + 1
+        if kind:
+            self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        self.bytes_sent += sent
+        self.transfer_seconds += duration
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started_at, 1),
+            'connections_active': self.connections_active,
+            'connections_total': self.connections_total,
+            'requests_total': self.requests_total,
+            'requests_in_flight': self.requests_in_flight,
+            'status': {str(code): count for code, count in sorted(self.status.items())},
+            'kinds': dict(self.kinds),
+            'bytes_sent': self.bytes_sent,
+            'denied': self.denied,
+            'expired': self.expired,
+            'transfer_seconds': round(self.transfer_seconds, 3),
+        }
+
+
+class MediaEdgeServer:
+    """媒体边缘服务器，每个进程一个实例"""
+
+    def __init__(self, host, port, reuse_port=False, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.keepalive_timeout = keepalive_timeout
+        self.metrics = EdgeMetrics()
+        self.library_roots = [os.path.realpath(root) for root in library_roots()]
+        self.transcoded_root = os.path.realpath(transcoded_root())
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            reuse_port=self.reuse_port or None, limit=MAX_HEADER_SIZE,
+        )
+        logger.info(f"🚀 媒体边缘服务器已启动: {self.host}:{self.port} (pid {os.getpid()})")
+        async with server:
+            await server.serve_forever()
+
+    def resolve(self, kind, located):
+        """把签名路径映射为文件系统路径，越界或不存在时返回None"""
+        if kind == 'lib':
+            index, relative = located
+            if index >= len(self.library_roots):
+                return None
+            root = self.library_roots[index]
+        else:
+            output_name, relative = located
+            if '/' in output_name or '\\' in output_name:
+                return None
+            root = os.path.realpath(os.path.join(self.transcoded_root, output_name))
+            if os.path.dirname(root) != self.transcoded_root:
+                return None
+
+        file_path = os.path.realpath(os.path.join(root, *relative.split('/')))
+        try:
+            if os.path.commonpath([file_path, root]) != root or file_path == root:
+                return None
+        except ValueError:
+            return None
+        return file_path
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client = peer[0] if peer else '-'
+        self.metrics.connections_active += 1
+        self.metrics.connections_total += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send_simple(writer, 431, keep_alive=False)
+                    break
+
+                started = time.perf_counter()
+                self.metrics.requests_in_flight += 1
+                try:
+                    status, sent, keep_alive, kind, target = await self.handle_request(head, writer, client)
+                finally:
+                    self.metrics.requests_in_flight -= 1
+                duration = time.perf_counter() - started
+                self.metrics.record(status, sent, duration, kind)
+                logger.info(f'{client} "{target}" {status} {sent} {duration:.3f}s')
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.error(f"边缘服务器处理连接出错: {e}", exc_info=True)
+        finally:
+            self.metrics.connections_active -= 1
+            writer.close()
+
+    async def handle_request(self, head, writer, client):
+        """处理单个请求，返回 (状态码, 发送的正文字节数, 是否保持连接, 范围类型, 访问日志中的请求行)"""
+        try:
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, target, version = request_line.split(' ')
+        except ValueError:
+            return await self.send_simple(writer, 400, keep_alive=False), 0, False, None, '-'
+
+        headers = {}
+        for line in header_lines:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        access = f'{method} {target.split("?", 1)[0]}'
+
+        # 只支持无请求体的请求，收到请求体时直接关闭连接
+        if headers.get('transfer-encoding') or headers.get('content-length', '0') != '0':
+            keep_alive = False
+
+        path = unquote(target.split('?', 1)[0])
+
+        if path == METRICS_PATH:
+            if client not in ('127.0.0.1', '::1'):
+                return await self.send_simple(writer, 404, keep_alive), 0, keep_alive, None, access
+            body = json.dumps(self.metrics.snapshot()).encode('utf-8')
+            await self.send_head(writer, 200, {
+                'Content-Type': 'application/json', 'Content-Length': str(len(body)),
+                'Cache-Control': 'no-store',
+            }, keep_alive)
+            writer.write(body)
+            await writer.drain()
+            return 200, len(body), keep_alive, None, access
+
+        if method == 'OPTIONS':
+            await self.send_head(writer, 204, {
+                'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
+                'Access-Control-Allow-Headers': 'Range, If-None-Match, If-Modified-Since, If-Range',
+                'Access-Control-Max-Age': '86400',
+                'Content-Length': '0',
+            }, keep_alive)
+            return 204, 0, keep_alive, None, access
+
+        if method not in ('GET', 'HEAD'):
+            return await self.send_simple(writer, 405, keep_alive, {'Allow': 'GET, HEAD, OPTIONS'}), 0, keep_alive, None, access
+
+        try:
+            kind, located = verify_edge_path(path)
+        except EdgeSignatureExpired:
+            self.metrics.expired += 1
+            return await self.send_simple(writer, 403, keep_alive), 0, keep_alive, None, access
+        except EdgeSignatureError:
+            self.metrics.denied += 1
+            return await self.send_simple(writer, 403, keep_alive), 0, keep_alive, None, access
+
+        file_path = self.resolve(kind, located)
+        try:
+            stat_result = await asyncio.to_thread(os.stat, file_path) if file_path else None
+        except OSError:
+            stat_result = None
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            return await self.send_simple(writer, 404, keep_alive), 0, keep_alive, kind, access
+
+        status, sent = await self.send_file(
+            EdgeRequest(method, path, headers), writer, kind, file_path, stat_result, keep_alive
+        )
+        return status, sent, keep_alive, kind, access
+
+    async def send_file(self, request, writer, kind, file_path, stat_result, keep_alive):
+        """发送文件（完整、单区间、多区间），返回 (状态码, 正文字节数)"""
+        extension = os.path.splitext(file_path)[1].lower()
+        if kind == 'lib':
+            cache_control = LIBRARY_CACHE_CONTROL
+        elif extension == '.m3u8':
+            cache_control = await asyncio.to_thread(playlist_cache_control, file_path)
+        else:
+            cache_control = await asyncio.to_thread(segment_cache_control, file_path)
+
+        etag, last_modified = file_validators(stat_result)
+        response = conditional_response(request, etag, last_modified, cache_control)
+        if response is not None:
+            headers = dict(response.items())
+            headers.pop('Content-Type', None)
+            if response.status_code != 304:
+                headers['Content-Length'] = '0'
+            await self.send_head(writer, response.status_code, headers, keep_alive)
+            return response.status_code, 0
+
+        file_size = stat_result.st_size
+        try:
+            ranges = resolve_ranges(request, stat_result)
+        except RangeNotSatisfiable:
+            await self.send_simple(writer, 416, keep_alive, {'Content-Range': f'bytes */{file_size}'})
+            return 416, 0
+
+        content_type = CONTENT_TYPES.get(extension) or guess_content_type(file_path)
+        headers = {}
+        if ranges and len(ranges) > 1:
+            boundary = uuid.uuid4().hex
+            parts = list(multipart_parts(ranges, file_size, content_type, boundary))
+            content_type = f'multipart/byteranges; boundary={boundary}'
+        elif ranges:
+            parts = ranges
+            start, end = ranges[0]
+            headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        else:
+            parts = [(0, file_size - 1)] if file_size else []
+
+        status = 206 if ranges else 200
+        headers.update({
+            'Content-Type': content_type,
+            'Content-Length': str(parts_length(parts)),
+            'Accept-Ranges': 'bytes',
+            'ETag': etag,
+            'Last-Modified': http_date(last_modified),
+            'Cache-Control': cache_control,
+        })
+        await self.send_head(writer, status, headers, keep_alive)
+        if request.method == 'HEAD':
+            return status, 0
+
+        loop = asyncio.get_running_loop()
+        sent = 0
+        f = await asyncio.to_thread(open, file_path, 'rb')
+        readahead = None
+        if len(parts) == 1:
+            start, end = parts[0]
+            readahead = await asyncio.to_thread(Readahead.open, f, start, end - start + 1)
+        try:
+            for part in parts:
+                if isinstance(part, bytes):
+                    writer.write(part)
+                    sent += len(part)
+                    continue
+                await writer.drain()
+                start, end = part
+                sent += await loop.sendfile(writer.transport, f, start, end - start + 1)
+            await writer.drain()
+        finally:
+            if readahead is not None:
+                await asyncio.to_thread(readahead.close, parts[0][0] + sent)
+            await asyncio.to_thread(f.close)
+        return status, sent
+
+    async def send_head(self, writer, status, headers, keep_alive):
+        lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+        all_headers = {
+            'Server': 'movieweb-edge',
+            'Date': http_date(),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+        }
+        all_headers.update(CORS_HEADERS)
+        all_headers.update(headers)
+        lines.extend(f'{name}: {value}' for name, value in all_headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_simple(self, writer, status, keep_alive, headers=None):
+        """发送没有正文的错误响应（HEAD请求同样适用）"""
+        all_headers = {'Content-Length': '0'}
+        all_headers.update(headers or {})
+        await self.send_head(writer, status, all_headers, keep_alive)
+        return status
+
+
+def _serve_process(host, port, reuse_port):
+    try:
+        asyncio.run(MediaEdgeServer(host, port, reuse_port).serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def run(host, port, processes=1):
+    """
+    启动边缘服务器
+
+    支持SO_REUSEPORT的平台上使用reuse_port监听，processes>1时fork出多个进程，
+    由内核在各进程间分配连接；不支持的平台（如Windows）只能运行单进程。
+    """
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    if not reuse_port and processes > 1:
+        logger.warning("当前平台不支持SO_REUSEPORT，只启动单个边缘进程")
+        processes = 1
+
+    if processes <= 1:
+        _serve_process(host, port, reuse_port)
+        return
+
+    context = multiprocessing.get_context('fork')
+    children = [
+        context.Process(target=_serve_process, args=(host, port, reuse_port), daemon=True)
+        for _ in range(processes)
+    ]
+    for child in children:
+        child.start()
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.join()
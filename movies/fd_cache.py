@@ -0,0 +1,233 @@
+"""
+热点媒体文件的打开句柄缓存
+- 每个worker进程保留有限数量的只读文件句柄及其stat结果，热点片段和视频的每次请求
+  不再重复 exists/stat/open/close，只需一次fstat
+- 句柄独占借出：同一文件被并发读取时各自使用独立的句柄，文件位置互不干扰
+- 每隔 MEDIA_FD_CACHE_REVALIDATE 秒按路径重新stat一次，inode变化（文件被替换）或文件被删除时丢弃句柄；
+  同一inode的大小和mtime以fstat为准，增长中的片段不会返回过期的长度
+- 超出 MEDIA_FD_CACHE_SIZE 或空闲超过 MEDIA_FD_CACHE_IDLE_TIMEOUT 秒的句柄会被关闭，
+  Windows下打开的文件无法删除，空闲超时保证句柄不会长时间占用文件
+"""
+
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CachedFile:
+    """从缓存借出的文件句柄，close()时归还给缓存而不是关闭"""
+
+    def __init__(self, cache, path, file_obj, stat_result):
+        self.cache = cache
+        self.path = path
+        self.file_obj = file_obj
+        self.stat = stat_result
+        self.validated_at = time.monotonic()
+        self.released_at = None
+        self.in_use = True
+
+    @property
+    def name(self):
+        return self.file_obj.name
+
+    @property
+    def closed(self):
+        return self.file_obj.closed
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def read(self, size=-1):
+        return self.file_obj.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file_obj.seek(offset, whence)
+
+    def tell(self):
+        return self.file_obj.tell()
+
+    def close(self):
+        self.cache.release(self)
+
+    def revalidate(self, now, interval):
+        """
+        借出前检查句柄是否仍然对应路径上的文件
+
+        返回False表示文件已被替换，应丢弃句柄；文件被删除时抛出FileNotFoundError。
+        """
+        current = os.fstat(self.file_obj.fileno())
+        if now - self.validated_at >= interval:
+            on_disk = os.stat(self.path)
+            if (on_disk.st_ino, on_disk.st_dev) != (current.st_ino, current.st_dev):
+                return False
+            self.validated_at = now
+        self.stat = current
+        return True
+
+    def discard(self):
+        try:
+            self.file_obj.close()
+        except OSError as e:
+            logger.debug(f"关闭缓存句柄失败: {e}")
+
+
+class FileHandleCache:
+    """按路径LRU淘汰的文件句柄池"""
+
+    def __init__(self, max_handles, revalidate_interval, idle_timeout):
+        self.max_handles = max_handles
+        self.revalidate_interval = revalidate_interval
+        self.idle_timeout = idle_timeout
+        self._idle = OrderedDict()  # path -> [CachedFile, ...]
+        self._idle_count = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_handles > 0
+
+    def checkout(self, path):
+        """
+        借出一个已打开的句柄，用完后调用其close()归还
+
+        缓存中没有可用句柄时打开文件；文件不存在时抛出FileNotFoundError。
+        """
+        path = str(path)
+        handle = self._take(path)
+        if handle is not None:
+            try:
+                valid = handle.revalidate(time.monotonic(), self.revalidate_interval)
+            except FileNotFoundError:
+                handle.discard()
+                with self._lock:
+                    self.invalidations += 1
+                raise
+            if valid:
+                handle.in_use = True
+                with self._lock:
+                    self.hits += 1
+                return handle
+            handle.discard()
+            with self._lock:
+                self.invalidations += 1
+
+        with self._lock:
+            self.misses += 1
+        file_obj = open(path, 'rb')
+        try:
+            stat_result = os.fstat(file_obj.fileno())
+        except OSError:
+            file_obj.close()
+            raise
+        return CachedFile(self, path, file_obj, stat_result)
+
+    def release(self, handle):
+        """归还句柄；缓存关闭或句柄已失效时直接关闭，重复归还会被忽略"""
+        if not handle.in_use:
+            return
+        handle.in_use = False
+        if not self.enabled or handle.closed:
+            handle.discard()
+            return
+
+        now = time.monotonic()
+        handle.released_at = now
+        expired = []
+        with self._lock:
+            self._idle.setdefault(handle.path, []).append(handle)
+            self._idle.move_to_end(handle.path)
+            self._idle_count += 1
+
+            while self._idle_count > self.max_handles:
+                expired.append(self._pop_oldest())
+                self.evictions += 1
+            expired.extend(self._expire(now))
+
+        for stale in expired:
+            stale.discard()
+
+    def discard(self, path):
+        """关闭某个文件的所有空闲句柄"""
+        self._close_where(lambda candidate: candidate == str(path))
+
+    def discard_prefix(self, directory):
+        """目录将被删除时关闭其中文件的空闲句柄（Windows下打开的文件无法删除）"""
+        prefix = os.path.join(str(directory), '')
+        self._close_where(lambda candidate: candidate.startswith(prefix))
+
+    def clear(self):
+        self._close_where(lambda candidate: True)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'idle_handles': self._idle_count,
+                'files': len(self._idle),
+                'max_handles': self.max_handles,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _take(self, path):
+        with self._lock:
+            expired = self._expire(time.monotonic())
+            handles = self._idle.get(path)
+            handle = None
+            if handles:
+                handle = handles.pop()
+                if not handles:
+                    del self._idle[path]
+                self._idle_count -= 1
+        for stale in expired:
+            stale.discard()
+        return handle
+
+    def _expire(self, now):
+        """取出空闲超时的句柄（需持有锁）；最久未使用的路径在最前面，遇到未超时的即可停止"""
+        expired = []
+        while self._idle:
+            oldest = next(iter(self._idle.values()))
+            if now - oldest[0].released_at < self.idle_timeout:
+                break
+            expired.append(self._pop_oldest())
+            self.evictions += 1
+        return expired
+
+    def _pop_oldest(self):
+        path, handles = next(iter(self._idle.items()))
+        handle = handles.pop(0)
+        if not handles:
+            del self._idle[path]
+        self._idle_count -= 1
+        return handle
+
+    def _close_where(self, predicate):
+        closing = []
+        with self._lock:
+            for path in [path for path in self._idle if predicate(path)]:
+                handles = self._idle.pop(path)
+                self._idle_count -= len(handles)
+                closing.extend(handles)
+        for handle in closing:
+            handle.discard()
+
+
+file_handles = FileHandleCache(
+    max_handles=settings.MEDIA_FD_CACHE_SIZE,
+    revalidate_interval=settings.MEDIA_FD_CACHE_REVALIDATE,
+    idle_timeout=settings.MEDIA_FD_CACHE_IDLE_TIMEOUT,
+)
@@ -0,0 +1,134 @@
+"""
+海报和缩略图的内容哈希URL
+- URL中的文件名嵌入内容哈希（posters/foo.3f2a9c1b7d4e.jpg），与 ManifestStaticFilesStorage 的命名方式一致
+- 内容不变则URL不变，响应可以使用一年的不可变缓存；图片被替换后哈希变化，页面自然引用新URL
+- 不依赖 DEBUG 下的 MEDIA_URL 挂载，生产环境同样可用
+- 只提供上传图片所在的目录中的图片文件：名称规范化后不能含 ".."，解析符号链接后的真实路径
+  也必须位于允许的目录内，media/ 下的转码输出等其他文件不会经由此路径暴露
+- 超过 MAX_HASHED_FILE_SIZE 的文件不计算哈希，未授权请求无法让服务端读取大文件
+- 哈希按 (路径, 大小, mtime) 在进程内缓存，列表页渲染时不会重复读取图片
+"""
+
+import os
+import re
+import posixpath
+import hashlib
+import threading
+import logging
+
+from django.conf import settings
+from django.urls import reverse
+
+logger = logging.getLogger(__name__)
+
+# 允许通过哈希URL提供的目录（对应模型ImageField的upload_to）
+HASHED_MEDIA_DIRS = ('posters/', 'backdrops/', 'thumbnails/', 'episode_posters/')
+
+# 只提供图片
+HASHED_MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.bmp')
+
+# 海报和缩略图的大小上限（字节）
+MAX_HASHED_FILE_SIZE = 20 * 1024 * 1024
+
+# 哈希长度与 ManifestStaticFilesStorage 相同
+HASH_LENGTH = 12
+
+# 进程内哈希缓存的最大条目数，超过后整体清空
+MAX_CACHED_HASHES = 4096
+
+_HASHED_NAME_RE = re.compile(r'^(?P<base>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)?$' % HASH_LENGTH)
+
+_hashes = {}  # path -> (size, mtime_ns, hash)
+_hashes_lock = threading.Lock()
+
+
+def is_hashable(name):
+    """名称位于允许的目录中、是图片、且不含 ".." 等路径跳转"""
+    name = name.replace('\\', '/')
+    if name.startswith('/') or '..' in name.split('/'):
+        return False
+    normalized = posixpath.normpath(name)
+    return normalized == name and normalized.startswith(HASHED_MEDIA_DIRS) \
+        and posixpath.splitext(normalized)[1].lower() in HASHED_MEDIA_EXTENSIONS
+
+
+def resolve_hashable(name):
+    """
+    允许通过哈希URL提供的文件的真实路径
+
+    名称不合法、解析符号链接后不在允许的目录内、不是普通文件或超过大小上限时返回None。
+    """
+    if not is_hashable(name):
+        return None
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    file_path = os.path.realpath(os.path.join(media_root, *name.replace('\\', '/').split('/')))
+    allowed = any(
+        os.path.commonpath([file_path, os.path.join(media_root, directory.rstrip('/'))])
+        == os.path.join(media_root, directory.rstrip('/'))
+        for directory in HASHED_MEDIA_DIRS
+    )
+    if not allowed:
+        return None
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
+        return None
+    if not os.path.isfile(file_path) or stat_result.st_size > MAX_HASHED_FILE_SIZE:
+        return None
+    return file_path
+
+
+def content_hash(path, stat_result=None):
+    """文件内容哈希，文件未变化时直接使用缓存"""
+    path = str(path)
+    stat_result = stat_result or os.stat(path)
+    with _hashes_lock:
+        cached = _hashes.get(path)
+    if cached and cached[:2] == (stat_result.st_size, stat_result.st_mtime_ns):
+        return cached[2]
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            md5.update(chunk)
+    digest = md5.hexdigest()[:HASH_LENGTH]
+
+    with _hashes_lock:
+        if len(_hashes) >= MAX_CACHED_HASHES:
+            _hashes.clear()
+        _hashes[path] = (stat_result.st_size, stat_result.st_mtime_ns, digest)
+    return digest
+
+
+def hashed_name(name, digest):
+    """posters/foo.jpg -> posters/foo.<hash>.jpg"""
+    base, ext = os.path.splitext(name)
+    return f'{base}.{digest}{ext}'
+
+
+def parse_hashed_name(hashed):
+    """posters/foo.<hash>.jpg -> ('posters/foo.jpg', hash)；不是哈希文件名时返回None"""
+    match = _HASHED_NAME_RE.match(hashed)
+    if not match:
+        return None
+    return match.group('base') + (match.group('ext') or ''), match.group('hash')
+
+
+def hashed_media_url(field_file):
+    """
+    ImageField文件的内容哈希URL
+
+    文件不在允许的目录内或无法读取时退回字段原本的URL。
+    """
+    if not field_file:
+        return ''
+    name = field_file.name.replace('\\', '/')
+    file_path = resolve_hashable(name)
+    if file_path is None:
+        return field_file.url
+    try:
+        digest = content_hash(file_path)
+    except OSError as e:
+        logger.warning(f"无法计算图片哈希: {name} - {e}")
+        return field_file.url
+    return reverse('serve_hashed_media', args=[hashed_name(name, digest)])
@@ -0,0 +1,343 @@
+"""
+HLS输出的缓存策略
+- 已完成（非直播）的转码输出：片段和播放列表内容不会再变化，使用长期不可变缓存
+- 仍在增长的实时播放列表：必须每次重新验证（配合ETag返回304）
+- 改写后的播放列表按 (路径, size, mtime) 缓存，ffmpeg追加内容时只解析新增的尾部
+
+片段格式（TRANSCODING_CONFIG中的 hls_segment_type / single_file）：
+- mpegts：每个片段一个 .ts 文件（默认）
+- fmp4：fMP4/CMAF片段，每个片段一个 .m4s 文件，另有一个初始化片段 init.mp4（EXT-X-MAP）
+- single_file：每个档位的全部片段写入同一个文件，播放列表用 EXT-X-BYTERANGE 指明每个片段的区间，
+  播放器发送Range请求，由同一个打开的文件句柄（fd_cache）提供
+"""
+
+import os
+import re
+import bisect
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .segment_cache import segment_cache
+from .fd_cache import file_handles
+
+# 已完成输出的缓存策略：一年且不可变
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# 仍在转码中的输出：允许缓存但每次使用前必须重新验证
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+ENDLIST_TAG = b'#EXT-X-ENDLIST'
+
+PLAYLIST_CONTENT_TYPE = 'application/vnd.apple.mpegurl'
+
+# 片段文件的MIME类型：MPEG-TS片段、fMP4媒体片段和fMP4初始化片段
+SEGMENT_CONTENT_TYPES = {
+    '.ts': 'video/MP2T',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+}
+SEGMENT_EXTENSIONS = tuple(SEGMENT_CONTENT_TYPES)
+
+# fMP4输出的初始化片段（单文件输出时初始化片段位于同一文件开头）
+FMP4_INIT_FILE = 'init.mp4'
+
+_MAP_URI_RE = re.compile(r'(URI=")([^"]+)(")')
+
+# 已确认完成的输出目录 -> (标记文件, 标记文件的inode、大小和mtime)
+# 每次使用前重新stat标记文件：其他进程删除并重建同一ID的目录后，新的标记文件不存在或签名不同，
+# 不会沿用旧目录的完成状态
+_finished_dirs = {}
+_finished_lock = threading.Lock()
+
+
+def _marker_signature(path):
+    """标记文件的 (inode, 大小, mtime)，文件不存在时返回None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def is_playlist_finished(playlist_path):
+    """播放列表末尾出现 #EXT-X-ENDLIST 表示转码已结束"""
+    try:
+        with open(playlist_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 64))
+            return ENDLIST_TAG in f.read()
+    except OSError:
+        return False
+
+
+def is_output_finished(output_dir):
+    """转码输出目录是否已完成：存在completed标记，或其中的播放列表已结束"""
+    output_dir = str(output_dir)
+    cached = _finished_dirs.get(output_dir)
+    if cached is not None:
+        marker, signature = cached
+        if _marker_signature(marker) == signature:
+            return True
+        with _finished_lock:
+            if _finished_dirs.get(output_dir) is cached:
+                del _finished_dirs[output_dir]
+
+    marker = os.path.join(output_dir, 'completed')
+    finished = os.path.exists(marker)
+    if not finished:
+        try:
+            playlists = sorted(name for name in os.listdir(output_dir) if name.endswith('.m3u8'))
+        except OSError:
+            return False
+        finished = bool(playlists) and all(
+            is_playlist_finished(os.path.join(output_dir, name)) for name in playlists
+        )
+        if finished:
+            # 已结束的播放列表不会再被改写，目录重建后mtime随之变化
+            marker = os.path.join(output_dir, playlists[0])
+
+    if finished:
+        signature = _marker_signature(marker)
+        if signature is not None:
+            with _finished_lock:
+                _finished_dirs[output_dir] = (marker, signature)
+    return finished
+
+
+def forget_output(output_dir):
+    """
+    输出目录删除前调用，避免目录重建后沿用旧的完成状态，并释放缓存的片段和文件句柄
+    （Windows下打开的文件无法删除）
+    """
+    with _finished_lock:
+        _finished_dirs.pop(str(output_dir), None)
+    segment_cache.discard_prefix(output_dir)
+    file_handles.discard_prefix(output_dir)
+
+
+def is_segment_final(segment_path):
+    """片段所在的输出已完成，内容不会再变化，可以放入片段缓存"""
+    return is_output_finished(os.path.dirname(str(segment_path)))
+
+
+def segment_cache_control(segment_path):
+    """片段的缓存策略"""
+    if is_segment_final(segment_path):
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
+
+
+def playlist_cache_control(playlist_path):
+    """播放列表的缓存策略：已结束的播放列表不可变，增长中的必须重新验证"""
+    if is_playlist_finished(playlist_path):
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
+
+
+def segment_content_type(filename):
+    """片段文件的MIME类型，不是片段文件（播放列表、任务信息、日志等）时返回None"""
+    return SEGMENT_CONTENT_TYPES.get(os.path.splitext(str(filename))[1].lower())
+
+
+def segment_extension(config):
+    """config为含 hls_segment_type 的配置（TRANSCODING_CONFIG['hls'] 或 ['realtime']）"""
+    return '.m4s' if config['hls_segment_type'] == 'fmp4' else '.ts'
+
+
+def hls_segment_args(config, segment_filename=None):
+    """
+    片段格式相关的FFmpeg参数
+
+    segment_filename为不含扩展名的片段文件路径（单文件输出时即唯一的媒体文件），
+    为None时使用FFmpeg的默认命名（播放列表文件名加序号）。
+    """
+    flags = config['hls_flags'].split('+')
+    args = ['-hls_segment_type', config['hls_segment_type']]
+    if config['hls_segment_type'] == 'fmp4':
+        args.extend(['-hls_fmp4_init_filename', FMP4_INIT_FILE])
+    if config['single_file']:
+        flags.append('single_file')
+    args.extend(['-hls_flags', '+'.join(flags)])
+    if segment_filename:
+        args.extend(['-hls_segment_filename', segment_filename + segment_extension(config)])
+    return args
+
+
+def parse_byterange(value, previous_end=0):
+    """解析 EXT-X-BYTERANGE 的值 "长度[@偏移]"，省略偏移时紧接上一个区间，返回 (偏移, 长度)"""
+    length, _, offset = value.strip().strip('"').partition('@')
+    return (int(offset) if offset else previous_end), int(length)
+
+
+def playlist_segments(playlist_path):
+    """
+    播放列表中的片段：[(时长, URI, 区间)]，区间为 (偏移, 长度)，不是单文件输出时为None
+    """
+    segments = []
+    duration = byterange = None
+    previous_end = 0
+    with open(playlist_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+            elif line.startswith('#EXT-X-BYTERANGE:'):
+                byterange = parse_byterange(line[len('#EXT-X-BYTERANGE:'):], previous_end)
+                previous_end = sum(byterange)
+            elif line and not line.startswith('#') and duration is not None:
+                segments.append((duration, line, byterange))
+                duration = byterange = None
+    return segments
+
+
+def count_segments(playlist_path):
+    """播放列表中已写出的片段数（不列出目录，单文件输出时也适用）"""
+    try:
+        with open(playlist_path, 'rb') as f:
+            return f.read().count(b'#EXTINF:')
+    except OSError:
+        return 0
+
+
+def byterange_index(playlist_path, offset):
+    """单文件输出中，字节偏移所在片段的序号；偏移在第一个片段之前或播放列表不可读时返回None"""
+    try:
+        starts = [byterange[0] for _, _, byterange in playlist_segments(playlist_path) if byterange]
+    except (OSError, ValueError):
+        return None
+    index = bisect.bisect_right(starts, offset) - 1
+    return index if index >= 0 else None
+
+
+def range_start(range_header):
+    """Range请求头中第一个区间的起始字节，没有或无法解析时返回None"""
+    match = re.match(r'\s*bytes=\s*(\d+)-', range_header or '')
+    return int(match.group(1)) if match else None
+
+
+def realtime_output_path(session_id, filename=''):
+    """实时转码会话输出目录（或其中的文件）路径"""
+    return os.path.join(settings.MEDIA_ROOT, 'transcoded', f"realtime_{session_id}", filename)
+
+
+def rewrite_playlist(content, url_prefix, query=''):
+    """将播放列表中的相对片段文件名改写为以url_prefix开头的绝对URL，query不为空时附加到片段URL后"""
+    lines = content.split('\n')
+    modified_lines = []
+    suffix = f'?{query}' if query else ''
+    
+    for line in lines:
+        if line.endswith(SEGMENT_EXTENSIONS) and not line.startswith('#'):
+            modified_lines.append(f'{url_prefix}{line}{suffix}')
+        elif line.startswith('#EXT-X-MAP:'):
+            # fMP4的初始化片段
+            modified_lines.append(_MAP_URI_RE.sub(lambda m: f'{m[1]}{url_prefix}{m[2]}{suffix}{m[3]}', line))
+        else:
+            modified_lines.append(line)
+    
+    return '\n'.join(modified_lines)
+
+
+class PlaylistCache:
+    """
+    改写后播放列表的缓存
+
+    以 (路径, URL前缀, 查询参数) 为键，文件size和mtime未变化时直接返回缓存的文本；
+    文件变大且开头和已解析部分的末尾都没有变化时（ffmpeg向播放列表追加片段），
+    只读取并改写新增的尾部；其他情况（滑动窗口删除了旧片段、文件被截断等）完整重新改写。
+    """
+
+    # 用于判断文件是否只是追加：文件开头（含EXT-X-MEDIA-SEQUENCE）和已解析部分的最后若干字节
+    HEAD_BYTES = 512
+    ANCHOR_BYTES = 256
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.incremental = 0
+        self.full = 0
+
+    def render(self, path, stat_result, url_prefix, query=''):
+        """返回改写后的播放列表文本"""
+        key = (str(path), url_prefix, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry['size'] == stat_result.st_size and entry['mtime_ns'] == stat_result.st_mtime_ns:
+                    self.hits += 1
+                    return entry['body'] + entry['tail']
+
+        new_entry = None
+        if entry is not None and stat_result.st_size > entry['parsed']:
+            new_entry = self._extend(path, entry, url_prefix, query)
+        incremental = new_entry is not None
+        if new_entry is None:
+            new_entry = self._rewrite(path, url_prefix, query)
+
+        with self._lock:
+            if incremental:
+                self.incremental += 1
+            else:
+                self.full += 1
+            self._entries[key] = new_entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return new_entry['body'] + new_entry['tail']
+
+    def _rewrite(self, path, url_prefix, query):
+        with open(path, 'rb') as f:
+            data = f.read()
+            current = os.fstat(f.fileno())
+        return self._build(current, data[:self.HEAD_BYTES], '', 0, b'', data, url_prefix, query)
+
+    def _extend(self, path, entry, url_prefix, query):
+        anchor = entry['anchor']
+        with open(path, 'rb') as f:
+            head = f.read(len(entry['head']))
+            f.seek(entry['parsed'] - len(anchor))
+            data = f.read()
+            current = os.fstat(f.fileno())
+        if head != entry['head'] or not data.startswith(anchor):
+            return None
+        return self._build(
+            current, entry['head'], entry['body'], entry['parsed'], anchor, data[len(anchor):],
+            url_prefix, query
+        )
+
+    def _build(self, current, head, body, parsed, anchor, new_data, url_prefix, query):
+        """只改写完整的行；最后一行不完整时单独改写，下次从该行开头继续解析"""
+        cut = new_data.rfind(b'\n') + 1
+        complete, partial = new_data[:cut], new_data[cut:]
+        return {
+            'size': current.st_size,
+            'mtime_ns': current.st_mtime_ns,
+            'head': head,
+            'body': body + rewrite_playlist(complete.decode('utf-8'), url_prefix, query),
+            'tail': rewrite_playlist(partial.decode('utf-8'), url_prefix, query),
+            'parsed': parsed + cut,
+            'anchor': (anchor + complete)[-self.ANCHOR_BYTES:],
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'incremental': self.incremental,
+                'full': self.full,
+            }
+
+
+playlist_cache = PlaylistCache()
+
+
+def render_playlist(playlist_path, stat_result, url_prefix, query=''):
+    """读取并改写播放列表（带缓存），参数含义同 rewrite_playlist"""
+    return playlist_cache.render(playlist_path, stat_result, url_prefix, query)
@@ -4,8 +4,11 @@
 
 from django.core.management.base import BaseCommand
 from movies.transcoding import transcoding_service
+from movies.capabilities import capability_registry
+from movies.scheduler import BATCH
 from movies.models import Movie
 import os
+import time
 from pathlib import Path
 
 class Command(BaseCommand):
@@ -14,7 +17,7 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             'action',
-            choices=['status', 'cleanup', 'test', 'benchmark'],
+            choices=['status', 'cleanup', 'test', 'benchmark', 'capabilities', 'fingerprint'],
             help='执行的操作'
         )
         parser.add_argument(
@@ -27,6 +30,11 @@ class Command(BaseCommand):
             default='720p',
             help='测试转码的分辨率 (默认: 720p)'
         )
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            help='重新探测FFmpeg能力（更换显卡或驱动后使用）'
+        )
         parser.add_argument(
             '--max-age',
             type=int,
@@ -45,6 +53,42 @@ class Command(BaseCommand):
             self.test_transcoding(options.get('movie_id'), options['resolution'])
         elif action == 'benchmark':
             self.benchmark_performance()
+        elif action == 'capabilities':
+            self.show_capabilities(options['refresh'])
+        elif action == 'fingerprint':
+            self.compute_fingerprints(options.get('movie_id'))
+
+    def compute_fingerprints(self, movie_id=None):
+        """预先计算源文件指纹（需要读取完整文件），播放时不必等待后台计算"""
+        movies = Movie.objects.filter(pk=movie_id) if movie_id else Movie.objects.all()
+        for movie in movies:
+            if not os.path.exists(movie.file_path):
+                self.stdout.write(self.style.WARNING(f'⚠️ 文件不存在: {movie.title}'))
+                continue
+            started = time.time()
+            fingerprint = transcoding_service.source_fingerprint(movie.file_path, wait=True)
+            self.stdout.write(f'🔑 {movie.title}: {fingerprint[:12]} ({time.time() - started:.1f}秒)')
+
+    def show_capabilities(self, refresh=False):
+        """显示主机的FFmpeg能力注册表"""
+        self.stdout.write(self.style.SUCCESS('🔍 FFmpeg能力'))
+        self.stdout.write('=' * 60)
+        
+        data = capability_registry.refresh() if refresh else capability_registry.get()
+        if not data['available']:
+            self.stdout.write(self.style.ERROR(f'❌ 无法运行FFmpeg: {data["error"]}'))
+            return
+        
+        self.stdout.write(f'📦 版本: {data["version"]}')
+        self.stdout.write(f'📁 可执行文件: {data["key"]["path"]}')
+        self.stdout.write(f'🕐 探测时间: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(data["probed_at"]))}')
+        self.stdout.write(f'🎛️ 硬件加速: {", ".join(data["hwaccels"]) or "无"}')
+        self.stdout.write(f'🧩 编码器: {len(data["encoders"])} 个, 滤镜: {len(data["filters"])} 个, 封装格式: {len(data["muxers"])} 个')
+        for name, result in data['tested'].items():
+            if result['ok']:
+                self.stdout.write(self.style.SUCCESS(f'   ✅ {name}'))
+            else:
+                self.stdout.write(self.style.WARNING(f'   ❌ {name}: {result["error"][-200:]}'))
 
     def show_status(self):
         """显示转码状态"""
@@ -75,7 +119,7 @@ class Command(BaseCommand):
         else:
             self.stdout.write('📂 转码目录不存在')
         
-        # 检查活动任务
+        # 检查活动任务（仅本进程启动的任务）
         active_jobs = len(transcoding_service.active_jobs)
         self.stdout.write(f'⚡ 活动转码: {active_jobs}个任务')
         
@@ -131,19 +175,41 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'❌ 分辨率 {resolution} 不可用'))
             return
         
+        # 转码ID需要源文件指纹，命令中直接计算
+        transcoding_service.source_fingerprint(movie.file_path, wait=True)
+        
         # 开始转码测试
         self.stdout.write(f'🚀 开始转码到 {resolution}...')
-        transcode_id, status = transcoding_service.start_transcoding(movie, resolution)
+        transcode_id, status = transcoding_service.start_transcoding(movie, resolution, priority=BATCH)
         
         if transcode_id:
             self.stdout.write(self.style.SUCCESS(f'✅ 转码启动: {transcode_id}'))
             self.stdout.write(f'📦 状态: {status}')
             
+            # 命令退出后监控线程随之结束，这里等待转码完成
+            while status in ('started', 'queued', 'transcoding'):
+                time.sleep(5)
+                job = transcoding_service.get_transcode_status(transcode_id)
+                status = job['status'] if job else 'interrupted'
+                progress = (job or {}).get('progress') or {}
+                self.stdout.write(
+                    f'⏳ 状态: {status}, 已用时: {job["elapsed"] if job else 0}秒, '
+                    f'进度: {progress.get("percent")}%, 速度: {progress.get("speed")}x, '
+                    f'帧率: {progress.get("fps")}, 预计剩余: {progress.get("eta")}秒'
+                )
+            
             if status == 'completed':
-                hls_path = transcoding_service.get_hls_path(movie.id, resolution)
+                hls_path = transcoding_service.get_hls_path(movie, resolution)
                 if hls_path.exists():
                     self.stdout.write(f'🎉 HLS文件: {hls_path}')
                     self.stdout.write(f'📦 大小: {hls_path.stat().st_size} bytes')
+                # 基准数据：完整的采样保存在输出目录的 progress.json 中
+                summary = (job.get('progress') or {}).get('summary')
+                if summary:
+                    self.stdout.write(
+                        f'📈 速度: 平均 {summary["speed_avg"]}x, 最低 {summary["speed_min"]}x, 最高 {summary["speed_max"]}x, '
+                        f'平均帧率: {summary["fps_avg"]}, 丢帧: {summary["drop_frames"]}, 采样数: {summary["samples"]}'
+                    )
         else:
             self.stdout.write(self.style.ERROR(f'❌ 转码失败: {status}'))
 
@@ -0,0 +1,81 @@
+"""
+媒体边缘服务器命令
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from movies.models import Movie
+from movies.edge import run
+from movies.signing import edge_enabled, edge_library_url
+
+
+class Command(BaseCommand):
+    help = '启动独立的asyncio媒体边缘服务器（只接受签名URL）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action',
+            nargs='?',
+            default='run',
+            choices=['run', 'sign'],
+            help='run: 启动服务器；sign: 为指定视频生成签名URL用于测试 (默认: run)'
+        )
+        parser.add_argument(
+            '--host',
+            default=settings.MEDIA_EDGE_BIND,
+            help=f'监听地址 (默认: {settings.MEDIA_EDGE_BIND})'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=settings.MEDIA_EDGE_PORT,
+            help=f'监听端口 (默认: {settings.MEDIA_EDGE_PORT})'
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help='边缘进程数量，通过SO_REUSEPORT共享端口 (默认: 1)'
+        )
+        parser.add_argument(
+            '--movie-id',
+            type=int,
+            help='sign操作使用的视频ID'
+        )
+
+    def handle(self, *args, **options):
+        if options['action'] == 'sign':
+            self.sign_movie(options.get('movie_id'))
+            return
+
+        self.stdout.write(self.style.SUCCESS('🚀 媒体边缘服务器'))
+        self.stdout.write('=' * 60)
+        self.stdout.write(f'🌐 监听: {options["host"]}:{options["port"]}   进程数: {options["processes"]}')
+        for index, root in enumerate(settings.MEDIA_EDGE_LIBRARY_ROOTS):
+            self.stdout.write(f'📁 媒体库[{index}]: {root}')
+        if not edge_enabled():
+            self.stdout.write(self.style.WARNING('⚠️ 未设置MEDIA_EDGE_URL，Django不会签发边缘URL'))
+
+        run(options['host'], options['port'], options['processes'])
+
+    def sign_movie(self, movie_id):
+        """为视频生成签名URL"""
+        if not edge_enabled():
+            self.stdout.write(self.style.ERROR('❌ 未设置MEDIA_EDGE_URL'))
+            return
+        if not movie_id:
+            self.stdout.write(self.style.ERROR('❌ 请使用 --movie-id 指定视频'))
+            return
+
+        try:
+            movie = Movie.objects.get(id=movie_id)
+        except Movie.DoesNotExist:
+            self.stdout.write(self.style.ERROR(f'❌ 视频ID {movie_id} 不存在'))
+            return
+
+        url = edge_library_url(movie.file_path)
+        if not url:
+            self.stdout.write(self.style.ERROR(f'❌ 视频文件不在边缘服务器的媒体库目录内: {movie.file_path}'))
+            return
+        self.stdout.write(url)
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('movies', '0002_scrapinglog_series_alter_movie_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscodeQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_sessions', models.PositiveIntegerField(help_text='0为不限制', verbose_name='最大并发会话数')),
+                ('max_encoder_seconds', models.PositiveIntegerField(help_text='0为不限制', verbose_name='窗口内编码器时间(秒)')),
+                ('group', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='transcode_quota', to='auth.group', verbose_name='用户组')),
+                ('user', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='transcode_quota', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '转码配额',
+                'verbose_name_plural': '转码配额',
+            },
+        ),
+        migrations.CreateModel(
+            name='TranscodeSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=64, unique=True, verbose_name='会话ID')),
+                ('resolution', models.CharField(max_length=20, verbose_name='分辨率')),
+                ('pid', models.PositiveIntegerField(blank=True, null=True, verbose_name='进程ID')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='开始时间')),
+                ('last_access', models.DateTimeField(default=django.utils.timezone.now, verbose_name='最后访问')),
+                ('ended_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('end_reason', models.CharField(blank=True, choices=[('completed', '转码完成'), ('stopped', '已停止'), ('evicted', '被新会话淘汰'), ('failed', '转码失败')], max_length=20, verbose_name='结束原因')),
+                ('encoder_seconds', models.FloatField(default=0, verbose_name='编码器时间(秒)')),
+                ('movie', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='movies.movie', verbose_name='影片')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transcode_sessions', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '转码会话',
+                'verbose_name_plural': '转码会话',
+                'ordering': ['-started_at'],
+                'indexes': [models.Index(fields=['user', 'ended_at'], name='movies_tran_user_id_f5f394_idx'), models.Index(fields=['user', 'started_at'], name='movies_tran_user_id_2a9d27_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='transcodequota',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('group__isnull', True), ('user__isnull', False)), models.Q(('group__isnull', False), ('user__isnull', True)), _connector='OR'), name='transcode_quota_user_or_group'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0003_transcode_quotas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transcodesession',
+            name='kind',
+            field=models.CharField(choices=[('realtime', '实时转码'), ('ondemand', '即时分段转码'), ('cached', '点播缓存转码')], default='realtime', max_length=20, verbose_name='类型'),
+        ),
+    ]
@@ -1,7 +1,8 @@
 import os
 from django.db import models
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
 from django.urls import reverse
+from django.utils import timezone
 
 
 class Series(models.Model):
@@ -172,4 +173,71 @@ class ScrapingLog(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return f'{self.search_query} - {self.source} - {"成功" if self.success else "失败"}' 
\ No newline at end of file
+        return f'{self.search_query} - {self.source} - {"成功" if self.success else "失败"}' 
+
+class TranscodeQuota(models.Model):
+    """实时转码配额：按用户或用户组配置，用户配额优先，用户属于多个组时取最宽松的组配额"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True, related_name='transcode_quota', verbose_name='用户')
+    group = models.OneToOneField(Group, on_delete=models.CASCADE, null=True, blank=True, related_name='transcode_quota', verbose_name='用户组')
+    max_sessions = models.PositiveIntegerField(verbose_name='最大并发会话数', help_text='0为不限制')
+    max_encoder_seconds = models.PositiveIntegerField(verbose_name='窗口内编码器时间(秒)', help_text='0为不限制')
+
+    class Meta:
+        verbose_name = '转码配额'
+        verbose_name_plural = '转码配额'
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(user__isnull=False, group__isnull=True) | models.Q(user__isnull=True, group__isnull=False),
+                name='transcode_quota_user_or_group',
+            ),
+        ]
+
+    def __str__(self):
+        return f'用户 {self.user.username}' if self.user_id else f'用户组 {self.group.name}'
+
+
+class TranscodeSession(models.Model):
+    """
+    转码会话记录，所有worker进程据此统计每个用户的并发会话数和编码器时间
+
+    实时转码会话、即时分段转码的一次播放、用户发起的点播缓存（含自适应码率）转码任务各记为一个会话
+    """
+    KINDS = [
+        ('realtime', '实时转码'),
+        ('ondemand', '即时分段转码'),
+        ('cached', '点播缓存转码'),
+    ]
+    END_REASONS = [
+        ('completed', '转码完成'),
+        ('stopped', '已停止'),
+        ('evicted', '被新会话淘汰'),
+        ('failed', '转码失败'),
+    ]
+
+    session_id = models.CharField(max_length=64, unique=True, verbose_name='会话ID')
+    kind = models.CharField(max_length=20, choices=KINDS, default='realtime', verbose_name='类型')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='transcode_sessions', verbose_name='用户')
+    movie = models.ForeignKey(Movie, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='影片')
+    resolution = models.CharField(max_length=20, verbose_name='分辨率')
+    pid = models.PositiveIntegerField(null=True, blank=True, verbose_name='进程ID')
+    started_at = models.DateTimeField(default=timezone.now, verbose_name='开始时间')
+    last_access = models.DateTimeField(default=timezone.now, verbose_name='最后访问')
+    ended_at = models.DateTimeField(null=True, blank=True, verbose_name='结束时间')
+    end_reason = models.CharField(max_length=20, blank=True, choices=END_REASONS, verbose_name='结束原因')
+    encoder_seconds = models.FloatField(default=0, verbose_name='编码器时间(秒)')
+
+    class Meta:
+        verbose_name = '转码会话'
+        verbose_name_plural = '转码会话'
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['user', 'ended_at']),
+            models.Index(fields=['user', 'started_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} - {self.movie} - {self.resolution}'
+
+    @property
+    def is_active(self):
+        return self.ended_at is None
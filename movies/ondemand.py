@@ -0,0 +1,566 @@
+"""
+即时（JIT）分段点播转码
+- 按ffprobe得到的时长生成完整的VOD播放列表，片段在被请求时才转码；
+  从观看记录续播或向前拖动时不需要从头转码
+- 请求第N个片段：已生成则直接返回；正在运行的转码进程即将产出该片段时等待；
+  否则从 N*segment_time 处启动新的FFmpeg（-ss 输入定位，-initial_offset 保持时间戳连续）
+- 片段先写为 part_ 临时文件，FFmpeg在片段列表（stdout）中报告完成后才重命名为 seg_，
+  存在的 seg_ 文件一定是完整的；输出目录保留期间拖回已生成的范围不需要任何转码，
+  目录与其他转码缓存一样由 cleanup_old_transcodes 按修改时间清理（默认24小时）
+- 转码进程运行到已生成的片段，或领先最后一次请求超过 max_ahead_segments 个片段时自动停止
+- 输出目录按源文件身份（路径、大小、mtime）寻址，不读取完整内容；同一路径的影片记录共享片段，
+  内容相同但路径不同的文件不共享
+- 转码进程在输出目录中写认领文件（claim_<起始片段>，内容为PID，持有者定期刷新mtime），
+  其他worker进程发现仍有效的认领时等待 seg_ 文件，不再启动自己的FFmpeg；
+  在其他进程的进程前方请求片段时写入 .requested 文件，该进程不会因领先过多而停止
+- 转码进程以播放优先级在调度器中排队，按输出轮流分配槽位
+- 进程内的输出对象没有转码进程且超过 IDLE_SECONDS 未被使用时移除
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import threading
+import subprocess
+import logging
+from pathlib import Path
+
+from .transcoding import (
+    TRANSCODING_CONFIG, TranscodingService, transcoding_service, transcode_scheduler, scheduler_pool,
+)
+from .scheduler import TicketCancelled, INTERACTIVE
+from .progress import ProgressTracker, PROGRESS_ARGS
+from .capabilities import pid_alive
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'seg_'
+PART_PREFIX = 'part_'
+LOG_FILE = 'ffmpeg.log'
+
+# 转码进程的认领文件：持有者每隔 CLAIM_HEARTBEAT 秒刷新一次，
+# 持有者进程已退出或超过 CLAIM_STALE_SECONDS 未刷新时视为失效
+CLAIM_PREFIX = 'claim_'
+CLAIM_REQUESTED_SUFFIX = '.requested'
+CLAIM_HEARTBEAT = 5
+CLAIM_STALE_SECONDS = 30
+
+# 没有转码进程的输出对象超过该时间（秒）未被使用时从进程内移除
+IDLE_SECONDS = 600
+
+
+class SegmentUnavailable(Exception):
+    """片段无法生成（转码失败或等待超时）"""
+
+
+def ondemand_config():
+    return TRANSCODING_CONFIG['ondemand']
+
+
+def playback_scope(movie_id, resolution):
+    """即时转码播放令牌绑定的范围（影片+分辨率）"""
+    return f"ondemand:{movie_id}:{resolution}"
+
+
+class SegmentWorker:
+    """从start_index开始顺序产出片段的一个FFmpeg进程，取得调度槽位前process为None"""
+
+    def __init__(self, start_index, tag, ticket, progress):
+        self.start_index = start_index
+        self.tag = tag
+        self.ticket = ticket
+        self.progress = progress
+        self.process = None
+        self.next_index = start_index  # 正在转码的片段
+        self.last_requested = start_index
+        self.stopping = False
+        self.beat_at = 0.0  # 最后一次刷新认领文件的时间
+
+    @property
+    def alive(self):
+        return not self.stopping and (self.process is None or self.process.poll() is None)
+
+    @property
+    def returncode(self):
+        return self.process.returncode if self.process else None
+
+    def covers(self, index, lookahead):
+        """该进程很快会产出第index个片段，等待即可"""
+        return self.alive and self.next_index <= index <= self.next_index + lookahead
+
+    def stop(self):
+        self.stopping = True
+        if self.process is None:
+            self.ticket.cancel()
+        elif self.process.poll() is None:
+            self.process.terminate()
+
+
+class OnDemandTranscode:
+    """一个源文件在一个分辨率下的即时转码输出"""
+
+    def __init__(self, name, video_path, resolution, duration, output_dir):
+        config = ondemand_config()
+        self.name = name
+        self.video_path = video_path
+        self.resolution = resolution
+        self.duration = duration
+        self.output_dir = Path(output_dir)
+        self.segment_time = config['segment_time']
+        self.segment_count = max(1, math.ceil(duration / self.segment_time))
+        self.workers = []
+        self.condition = threading.Condition()
+        self._tags = 0
+        self.last_used = time.monotonic()
+
+    def segment_path(self, index):
+        return self.output_dir / f"{SEGMENT_PREFIX}{index:05d}.ts"
+
+    def claim_path(self, index):
+        return self.output_dir / f"{CLAIM_PREFIX}{index:05d}"
+
+    def segment_duration(self, index):
+        if index < self.segment_count - 1:
+            return self.segment_time
+        return self.duration - self.segment_time * (self.segment_count - 1) or self.segment_time
+
+    def playlist(self, segment_url):
+        """完整的VOD播放列表，segment_url(index)返回片段地址"""
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-PLAYLIST-TYPE:VOD',
+            f'#EXT-X-TARGETDURATION:{math.ceil(self.segment_time)}',
+            '#EXT-X-MEDIA-SEQUENCE:0',
+            '#EXT-X-INDEPENDENT-SEGMENTS',
+        ]
+        for index in range(self.segment_count):
+            lines.append(f'#EXTINF:{self.segment_duration(index):.6f},')
+            lines.append(segment_url(index))
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def get_segment(self, index, timeout=None):
+        """
+        返回第index个片段的路径，需要时启动或重定向转码进程并等待片段生成
+
+        片段无法生成时抛出SegmentUnavailable。指定timeout时（同步视图只等待几秒）超时后保留
+        为该片段启动的进程，客户端重试时继续等待同一个进程；否则等待 segment_timeout 后停止仍在排队的进程。
+        其他worker进程的转码进程即将产出该片段时（重试落到了另一个worker）只等待片段文件。
+        """
+        if not 0 <= index < self.segment_count:
+            raise IndexError(index)
+        path = self.segment_path(index)
+        if path.exists():
+            self._note_request(index)
+            return path
+
+        config = ondemand_config()
+        deadline = time.monotonic() + (timeout or config['segment_timeout'])
+        started = None
+        with self.condition:
+            while not path.exists():
+                worker = next((w for w in self.workers if w.covers(index, config['lookahead_segments'])), None)
+                claim = None
+                if worker is None:
+                    claim = self._remote_claim(index, config['lookahead_segments'])
+                if worker is None and claim is None:
+                    if started is not None:
+                        # 为该片段启动的进程已经退出却没有产出片段
+                        raise SegmentUnavailable(f"片段转码失败: {self.name}/{index}，返回码: {started.returncode}")
+                    # 其他进程抢先认领了该片段时返回None，下一轮等待它的片段
+                    started = worker = self._start_worker(index)
+                if worker is not None:
+                    worker.last_requested = max(worker.last_requested, index)
+                elif claim is not None:
+                    self._note_remote_request(claim, index)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if timeout is None and started is not None and started.process is None:
+                        # 仍在排队的进程不再需要
+                        started.stop()
+                    raise SegmentUnavailable(f"等待片段超时: {self.name}/{index}")
+                self.condition.wait(min(remaining, 0.5))
+        return path
+
+    def _note_request(self, index):
+        """记录播放位置，播放器读取已生成的片段时转码进程（包括其他worker进程的）不会因领先过多而停止"""
+        with self.condition:
+            for worker in self.workers:
+                if worker.start_index <= index:
+                    worker.last_requested = max(worker.last_requested, index)
+            for claim in self._remote_claims():
+                if claim['start_index'] <= index:
+                    self._note_remote_request(claim, index)
+
+    def stop(self):
+        with self.condition:
+            for worker in self.workers:
+                worker.stop()
+
+    def idle(self, now):
+        """没有转码进程且超过 IDLE_SECONDS 未被使用"""
+        with self.condition:
+            busy = any(worker.alive for worker in self.workers)
+        return not busy and now - self.last_used > IDLE_SECONDS
+
+    def stats(self):
+        """运行中（或排队中）的转码进程及其进度"""
+        with self.condition:
+            workers = list(self.workers)
+        return {
+            'name': self.name,
+            'resolution': self.resolution,
+            'workers': [
+                {
+                    'start_index': worker.start_index,
+                    'next_index': worker.next_index,
+                    'state': 'queued' if worker.process is None else 'running',
+                    'progress': worker.progress.snapshot(),
+                }
+                for worker in workers if worker.alive
+            ],
+        }
+
+    def _start_worker(self, index):
+        """
+        从第index个片段开始转码（需持有condition）；并发进程数超出上限时停止最久未被请求的进程
+
+        其他worker进程已认领该片段时返回None
+        """
+        config = ondemand_config()
+        self._tags += 1
+        tag = f"{os.getpid()}_{self._tags}"
+        if not self._claim(index, tag):
+            return None
+
+        self.workers = [worker for worker in self.workers if worker.alive]
+        while len(self.workers) >= config['max_workers']:
+            oldest = min(self.workers, key=lambda worker: worker.last_requested)
+            logger.info(f"⏹️ 重定向即时转码: {self.name}, 停止从片段 {oldest.start_index} 开始的进程")
+            oldest.stop()
+            self.workers.remove(oldest)
+
+        ticket = transcode_scheduler.submit(
+            scheduler_pool(transcoding_service.get_best_encoder()), INTERACTIVE, self.name, label=f"ondemand:{self.name}:{index}"
+        )
+        start = index * self.segment_time
+        worker = SegmentWorker(index, tag, ticket, ProgressTracker(max(0.0, self.duration - start), offset=start))
+        worker.beat_at = time.monotonic()
+        self.workers.append(worker)
+        threading.Thread(target=self._run, args=(worker,), daemon=True).start()
+        return worker
+
+    def _run(self, worker):
+        """等待调度槽位（期间刷新认领文件），取得后启动FFmpeg并监控到结束"""
+        try:
+            while not worker.ticket.wait(CLAIM_HEARTBEAT):
+                self._heartbeat(worker)
+        except TicketCancelled:
+            self._remove(worker)
+            return
+
+        with self.condition:
+            if worker.stopping:
+                worker.ticket.release()
+                self._remove(worker)
+                return
+            try:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                with open(self.output_dir / LOG_FILE, 'ab') as log:
+                    worker.process = subprocess.Popen(
+                        self.build_command(worker.start_index, worker.tag),
+                        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log,
+                        text=True, encoding='utf-8', errors='replace',
+                    )
+            except OSError as e:
+                logger.error(f"❌ 启动即时转码失败: {self.name} - {e}")
+                worker.stopping = True
+                worker.ticket.release()
+                self._remove(worker)
+                return
+        worker.progress.started_at = time.time()
+        logger.info(f"🚀 即时转码: {self.name}, 从片段 {worker.start_index} ({worker.start_index * self.segment_time}秒) 开始")
+        try:
+            self._supervise(worker)
+        finally:
+            worker.ticket.release()
+
+    def _remove(self, worker):
+        with self.condition:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self._release_claim(worker)
+            self.condition.notify_all()
+
+    # ---------- 跨进程认领 ----------
+
+    def _read_claim(self, path):
+        """认领文件的内容；文件不存在、内容不完整或已失效时返回None"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                claim = json.load(f)
+                beat = os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError):
+            return None
+        if time.time() - beat > CLAIM_STALE_SECONDS or not pid_alive(claim.get('pid', 0)):
+            return None
+        return claim
+
+    def _write_claim(self, worker):
+        """更新认领文件中的当前片段（同时刷新mtime）"""
+        path = self.claim_path(worker.start_index)
+        tmp_path = path.with_name(f"{path.name}.{worker.tag}")
+        try:
+            tmp_path.write_text(json.dumps({
+                'pid': os.getpid(),
+                'tag': worker.tag,
+                'start_index': worker.start_index,
+                'next_index': worker.next_index,
+            }), encoding='utf-8')
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+        worker.beat_at = time.monotonic()
+
+    def _claim(self, index, tag):
+        """创建第index个片段的认领文件；其他进程持有有效认领时返回False，失效的认领被接管"""
+        path = self.claim_path(index)
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            return False
+        # 先写好临时文件再硬链接为认领文件：链接是原子的，其他进程不会读到空的认领文件
+        tmp_path = path.with_name(f"{path.name}.{tag}")
+        try:
+            tmp_path.write_text(json.dumps({
+                'pid': os.getpid(), 'tag': tag, 'start_index': index, 'next_index': index,
+            }), encoding='utf-8')
+        except OSError:
+            return False
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, path)
+                    return True
+                except FileExistsError:
+                    if self._read_claim(path) is not None:
+                        return False
+                    logger.warning(f"⚠️ 即时转码认领已失效，接管: {self.name}/{index}")
+                    for stale in (path, path.with_name(path.name + CLAIM_REQUESTED_SUFFIX)):
+                        try:
+                            stale.unlink()
+                        except FileNotFoundError:
+                            pass
+                except OSError:
+                    return False
+            return False
+        finally:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+
+    def _heartbeat(self, worker):
+        """每隔 CLAIM_HEARTBEAT 秒刷新一次认领文件"""
+        if time.monotonic() - worker.beat_at < CLAIM_HEARTBEAT:
+            return
+        try:
+            os.utime(self.claim_path(worker.start_index))
+        except OSError:
+            pass
+        worker.beat_at = time.monotonic()
+
+    def _release_claim(self, worker):
+        """删除本进程持有的认领文件（已被其他进程接管时保留）"""
+        path = self.claim_path(worker.start_index)
+        try:
+            claim = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return
+        if claim.get('tag') != worker.tag:
+            return
+        for item in (path, path.with_name(path.name + CLAIM_REQUESTED_SUFFIX)):
+            try:
+                item.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _remote_claims(self):
+        """其他worker进程持有的有效认领"""
+        try:
+            names = [name for name in os.listdir(self.output_dir)
+                     if name.startswith(CLAIM_PREFIX) and name[len(CLAIM_PREFIX):].isdigit()]
+        except OSError:
+            return []
+        claims = []
+        for name in names:
+            claim = self._read_claim(self.output_dir / name)
+            if claim is not None and claim['pid'] != os.getpid():
+                claims.append(claim)
+        return claims
+
+    def _remote_claim(self, index, lookahead):
+        """其他worker进程中很快会产出第index个片段的转码进程的认领"""
+        for claim in self._remote_claims():
+            if claim['next_index'] <= index <= claim['next_index'] + lookahead:
+                return claim
+        return None
+
+    def _note_remote_request(self, claim, index):
+        """记录其他进程的转码进程对应的播放位置（只增不减）"""
+        path = self.claim_path(claim['start_index'])
+        requested_path = path.with_name(path.name + CLAIM_REQUESTED_SUFFIX)
+        if index <= self._remote_requested(requested_path):
+            return
+        tmp_path = requested_path.with_name(f"{requested_path.name}.{os.getpid()}")
+        try:
+            tmp_path.write_text(str(index), encoding='utf-8')
+            os.replace(tmp_path, requested_path)
+        except OSError:
+            pass
+
+    def _remote_requested(self, requested_path):
+        """其他进程记录的播放位置，没有记录时返回-1"""
+        try:
+            return int(requested_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return -1
+
+    def build_command(self, index, tag):
+        """从第index个片段开始转码的FFmpeg命令；片段列表输出到stdout，每完成一个片段输出一行"""
+        encoder = transcoding_service.get_best_encoder()
+        res_config = TRANSCODING_CONFIG['resolutions'][self.resolution]
+        width, height = res_config['width'], res_config['height']
+        bitrate = res_config['bitrate']
+        start = index * self.segment_time
+
+        return [
+            shutil.which('ffmpeg') or 'ffmpeg',
+            '-hide_banner',
+            '-y',  # 覆盖输出文件
+            *PROGRESS_ARGS,  # 进度与片段列表共用stdout
+            '-ss', f"{start:g}",  # 输入定位（解码到精确位置）
+            '-i', self.video_path,  # 输入文件
+            '-map', '0:v:0',
+            '-map', '0:a:0?',
+            '-c:v', encoder['name'],  # 视频编码器
+            *encoder['options'].split(),  # 编码器选项
+            '-b:v', bitrate,  # 视频码率
+            '-maxrate', res_config['maxrate'],  # 最大码率
+            '-bufsize', f"{float(bitrate[:-1]) * 2:g}{bitrate[-1]}",  # 缓冲区大小（码率的2倍，保留单位）
+            '-vf', f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+            # 关键帧对齐片段边界，从任意片段重新开始时切分位置一致
+            '-force_key_frames', f"expr:gte(t,n_forced*{self.segment_time})",
+            '-c:a', 'aac',  # 音频编码器
+            '-b:a', '128k',  # 音频码率
+            '-ac', '2',  # 双声道
+            '-ar', '44100',  # 采样率
+            '-f', 'segment',
+            '-segment_format', 'mpegts',
+            '-segment_time', str(self.segment_time),
+            '-segment_start_number', str(index),
+            '-segment_list', 'pipe:1',
+            '-segment_list_type', 'flat',
+            # 切分按定位后的时间进行，写出时再加上偏移，片段时间戳与完整视频一致
+            '-reset_timestamps', '0',
+            '-initial_offset', f"{start:g}",
+            str(self.output_dir / f"{PART_PREFIX}{tag}_%05d.ts"),
+        ]
+
+    def _supervise(self, worker):
+        """读取FFmpeg报告的进度和已完成片段，片段重命名为正式片段，进程结束后清理临时文件"""
+        max_ahead = ondemand_config()['max_ahead_segments']
+        part_prefix = f"{PART_PREFIX}{worker.tag}_"
+        requested_path = self.claim_path(worker.start_index)
+        requested_path = requested_path.with_name(requested_path.name + CLAIM_REQUESTED_SUFFIX)
+        try:
+            for line in worker.process.stdout:
+                self._heartbeat(worker)
+                if worker.progress.feed(line):
+                    continue
+                name = os.path.basename(line.strip())
+                if not name.startswith(part_prefix):
+                    continue
+                index = int(name[len(part_prefix):-len('.ts')])
+                try:
+                    os.replace(self.output_dir / name, self.segment_path(index))
+                except FileNotFoundError:
+                    # 输出目录已被清理
+                    worker.stop()
+                    break
+
+                with self.condition:
+                    worker.next_index = index + 1
+                    self._write_claim(worker)
+                    self.condition.notify_all()
+                    if worker.next_index >= self.segment_count:
+                        continue
+                    # 播放器的请求可能由其他worker进程处理
+                    last_requested = max(worker.last_requested, self._remote_requested(requested_path))
+                    if self.segment_path(worker.next_index).exists():
+                        logger.info(f"⏹️ 即时转码到达已生成的片段: {self.name}/{worker.next_index}")
+                        worker.stop()
+                    elif worker.next_index - last_requested > max_ahead:
+                        logger.info(f"⏸️ 即时转码领先播放位置过多，停止: {self.name}/{worker.next_index}")
+                        worker.stop()
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取即时转码进度失败: {self.name} - {e}")
+        worker.process.wait()
+        worker.progress.finish()
+        self._remove(worker)
+
+        for leftover in self.output_dir.glob(f"{part_prefix}*"):
+            try:
+                leftover.unlink()
+            except OSError:
+                pass
+        if worker.process.returncode != 0 and not worker.stopping:
+            logger.error(f"❌ 即时转码进程异常退出: {self.name}, 返回码: {worker.process.returncode}，详见 {LOG_FILE}")
+
+
+_transcodes = {}  # 输出目录名 -> OnDemandTranscode
+_transcodes_lock = threading.Lock()
+
+
+def get_ondemand(video_path, resolution):
+    """
+    源文件在指定分辨率下的即时转码输出
+
+    分辨率不支持时抛出ValueError，源文件不存在时抛出FileNotFoundError，无法获取时长时抛出SegmentUnavailable。
+    """
+    # 片段按需生成、随时可以重建，以源文件身份（路径、大小、mtime）而不是完整内容指纹寻址，
+    # 第一次播放不需要等待读完整个源文件
+    transcode_id = transcoding_service.transcode_id_for_file(
+        video_path, resolution, source=transcoding_service.source_identity(video_path)
+    )
+    # 片段时长变化后片段边界不同，不能复用旧片段
+    name = f"ondemand{ondemand_config()['segment_time']}_{transcode_id}"
+    now = time.monotonic()
+    with _transcodes_lock:
+        transcode = _transcodes.get(name)
+        for other_name, other in list(_transcodes.items()):
+            if other is not transcode and other.idle(now):
+                del _transcodes[other_name]
+    if transcode is not None:
+        transcode.last_used = now
+        return transcode
+
+    video_info = TranscodingService.get_video_info(video_path)
+    if not video_info or not video_info['duration']:
+        raise SegmentUnavailable(f"无法获取视频时长: {video_path}")
+    transcode = OnDemandTranscode(
+        name, video_path, resolution, video_info['duration'], transcoding_service.transcode_dir / name
+    )
+    with _transcodes_lock:
+        return _transcodes.setdefault(name, transcode)
+
+
+def ondemand_stats():
+    """当前进程中有转码进程的即时转码输出"""
+    with _transcodes_lock:
+        transcodes = list(_transcodes.values())
+    return [stats for stats in (transcode.stats() for transcode in transcodes) if stats['workers']]
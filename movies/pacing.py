@@ -0,0 +1,202 @@
+"""
+媒体流带宽控制
+- 令牌桶限速：单个连接的速率 = 视频码率（ffprobe）× bitrate_multiplier，
+  开始时允许突发 burst_seconds 秒的数据，让播放器快速填满缓冲区
+- 进程级出口带宽上限：在所有受控流之间按最大最小公平（max-min fairness）分配，
+  需求低于平均份额的流让出的带宽分给其他流
+- 记录每个流的实时吞吐量，供管理员查看谁在占用带宽
+- 进程内限速只用于ASGI响应（asyncio.sleep等待，不占用线程）；同步worker在限速等待期间会被一直占用，
+  因此同步响应和卸载给nginx的响应都改用 X-Accel-Limit-Rate，由nginx按速率发送
+"""
+
+import time
+import itertools
+import threading
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 吞吐量统计窗口（秒）
+RATE_WINDOW = 1.0
+
+
+def pacing_enabled():
+    return settings.STREAM_PACING['enabled']
+
+
+class TokenBucket:
+    """令牌桶：rate为None表示不限速"""
+
+    def __init__(self, rate, burst_seconds):
+        self.burst_seconds = burst_seconds
+        self.rate = None
+        self.capacity = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+        self.tokens = self.capacity
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        self.capacity = rate * self.burst_seconds if rate else 0
+        self.tokens = min(self.tokens, self.capacity)
+
+    def consume(self, size):
+        """取出size字节的令牌，返回需要等待的秒数"""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class PacedStream:
+    """
+    一个受控的媒体流（一次HTTP响应）
+
+    第一次发送数据时才加入registry参与带宽分配，响应体从未被迭代（如客户端提前断开）时不会残留。
+    """
+
+    def __init__(self, registry, stream_id, label, client, requested_rate):
+        self.registry = registry
+        self.id = stream_id
+        self.label = label
+        self.client = client
+        self.requested_rate = requested_rate
+        self.allocated_rate = requested_rate
+        self.started_at = None
+        self.bytes_sent = 0
+        self.current_rate = 0.0
+        self._window_started = time.monotonic()
+        self._window_bytes = 0
+        self.bucket = TokenBucket(requested_rate, settings.STREAM_PACING['burst_seconds'])
+        self.registered = False
+        self.closed = False
+
+    def allocate(self, rate):
+        self.allocated_rate = rate
+        self.bucket.set_rate(rate)
+
+    def consume(self, size):
+        """记录发送了size字节，返回发送下一块之前需要等待的秒数"""
+        if not self.registered and not self.closed:
+            self.registered = True
+            self.started_at = time.time()
+            self._window_started = time.monotonic()
+            self.registry.register(self)
+        self.bytes_sent += size
+        self._window_bytes += size
+        now = time.monotonic()
+        elapsed = now - self._window_started
+        if elapsed >= RATE_WINDOW:
+            instant = self._window_bytes / elapsed
+            self.current_rate = instant if not self.current_rate else 0.5 * self.current_rate + 0.5 * instant
+            self._window_started = now
+            self._window_bytes = 0
+        return self.bucket.consume(size)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.registered:
+                self.registry.unregister(self)
+
+    def snapshot(self):
+        return {
+            'id': self.id,
+            'label': self.label,
+            'client': self.client,
+            'started_at': self.started_at,
+            'bytes_sent': self.bytes_sent,
+            'current_rate': round(self.current_rate),
+            'requested_rate': self.requested_rate,
+            'allocated_rate': round(self.allocated_rate) if self.allocated_rate else None,
+        }
+
+
+class PacingRegistry:
+    """进程内所有受控流，负责在出口带宽上限内分配速率"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def create(self, label, client, requested_rate):
+        return PacedStream(self, next(self._ids), label, client, requested_rate)
+
+    def register(self, stream):
+        with self._lock:
+            self._streams[stream.id] = stream
+            self._reallocate()
+
+    def unregister(self, stream):
+        with self._lock:
+            self._streams.pop(stream.id, None)
+            self._reallocate()
+
+    def _reallocate(self):
+        """max-min公平分配：按需求从小到大，每个流最多分到剩余带宽的平均份额"""
+        cap = settings.STREAM_PACING['egress_cap']
+        streams = list(self._streams.values())
+        if not cap:
+            for stream in streams:
+                stream.allocate(stream.requested_rate)
+            return
+
+        streams.sort(key=lambda s: s.requested_rate or float('inf'))
+        remaining = float(cap)
+        for index, stream in enumerate(streams):
+            share = remaining / (len(streams) - index)
+            rate = min(stream.requested_rate or float('inf'), share)
+            stream.allocate(rate)
+            remaining -= rate
+
+    def snapshot(self):
+        with self._lock:
+            streams = [stream.snapshot() for stream in self._streams.values()]
+        return {
+            'egress_cap': settings.STREAM_PACING['egress_cap'],
+            'active_streams': len(streams),
+            'total_rate': sum(stream['current_rate'] for stream in streams),
+            'streams': sorted(streams, key=lambda s: s['current_rate'], reverse=True),
+        }
+
+
+registry = PacingRegistry()
+
+
+def stream_rate(bitrate):
+    """
+    单个连接的目标速率（字节/秒）
+
+    bitrate为视频码率（bit/s），未知时按 default_rate 处理；返回None表示不限速（只受出口上限约束）。
+    """
+    config = settings.STREAM_PACING
+    if bitrate:
+        return int(max(config['min_rate'], bitrate / 8 * config['bitrate_multiplier']))
+    return config['default_rate'] or None
+
+
+def open_stream(request, file_path, bitrate):
+    """为一次响应创建受控流；未启用限速或既无单连接限速也无出口上限时返回None"""
+    if not pacing_enabled():
+        return None
+
+    rate = stream_rate(bitrate)
+    if rate is None and not settings.STREAM_PACING['egress_cap']:
+        return None
+
+    label = str(file_path).replace('\\', '/').rsplit('/', 1)[-1]
+    return registry.create(label, request.META.get('REMOTE_ADDR', ''), rate)
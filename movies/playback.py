@@ -0,0 +1,135 @@
+"""
+播放协商：根据客户端上报的播放能力和缓存的媒体信息选择播放方式
+- direct：容器、视频编码和音频编码客户端都支持，分辨率和码率在客户端上限内，直接提供源文件
+- remux：视频和音频都直接复制，只把封装改为HLS（例如MKV中的H.264/AAC）
+- audio_transcode：视频直接复制，只转码客户端无法播放的音轨（例如AC-3、DTS）
+- transcode：完整转码，选择不超过客户端分辨率和带宽的最高档位
+决策只读取get_video_info的缓存结果，不启动转码；由视图按决策启动转码并返回可以直接加载的URL
+"""
+
+import os
+
+from .transcoding import (
+    TRANSCODING_CONFIG, TranscodingService, REMUX_RESOLUTION, parse_bitrate,
+)
+
+DIRECT = 'direct'
+REMUX = 'remux'
+AUDIO_TRANSCODE = 'audio_transcode'
+TRANSCODE = 'transcode'
+
+# 文件扩展名 -> 容器名（与客户端上报的容器名一致）
+CONTAINERS = {
+    '.mp4': 'mp4',
+    '.m4v': 'mp4',
+    '.mov': 'mov',
+    '.webm': 'webm',
+    '.mkv': 'mkv',
+    '.avi': 'avi',
+    '.wmv': 'wmv',
+    '.flv': 'flv',
+}
+
+# 只使用客户端带宽估计的一部分，为波动留出余量
+BANDWIDTH_HEADROOM = 0.8
+
+
+def parse_capabilities(data):
+    """
+    客户端上报的播放能力
+
+    containers/video_codecs/audio_codecs 为名称列表（编码名与ffprobe一致，如 h264、hevc、aac）；
+    max_height（像素）和 bandwidth（bit/s）缺省时不限制；hls 表示客户端能否播放HLS。
+    格式错误时抛出ValueError。
+    """
+    if not isinstance(data, dict):
+        raise ValueError("请求体必须是JSON对象")
+
+    def names(key):
+        values = data.get(key) or []
+        if not isinstance(values, list):
+            raise ValueError(f"{key} 必须是列表")
+        return {str(value).lower() for value in values}
+
+    def limit(key):
+        value = data.get(key)
+        if value in (None, ''):
+            return None
+        value = float(value)
+        if value <= 0:
+            raise ValueError(f"{key} 必须大于0")
+        return value
+
+    return {
+        'containers': names('containers'),
+        'video_codecs': names('video_codecs'),
+        'audio_codecs': names('audio_codecs'),
+        'max_height': limit('max_height'),
+        'bandwidth': limit('bandwidth'),
+        'hls': bool(data.get('hls', True)),
+    }
+
+
+def source_container(video_path):
+    return CONTAINERS.get(os.path.splitext(video_path)[1].lower())
+
+
+def within_limits(capabilities, height, bitrate):
+    """分辨率和码率是否在客户端上限内，码率未知时只比较分辨率"""
+    if capabilities['max_height'] and height > capabilities['max_height']:
+        return False
+    if capabilities['bandwidth'] and bitrate > capabilities['bandwidth'] * BANDWIDTH_HEADROOM:
+        return False
+    return True
+
+
+def choose_resolution(capabilities, resolutions):
+    """完整转码的档位：resolutions（从高到低）中不超过客户端上限的最高档位，都超过时取最低档位"""
+    for name in resolutions:
+        res_config = TRANSCODING_CONFIG['resolutions'][name]
+        if within_limits(capabilities, res_config['height'], parse_bitrate(res_config['maxrate'])):
+            return name
+    return resolutions[-1] if resolutions else None
+
+
+def decide_playback(video_path, video_info, capabilities, resolutions):
+    """
+    选择播放方式
+
+    返回 {'method', 'resolution', 'plan', 'allow_hevc', 'reason'}：resolution为原画、remux或转码档位；
+    plan为直接复制时各轨道的处理方式（见TranscodingService.stream_plan）。
+    """
+    audio_codec = video_info['audio_codec']
+    video_supported = video_info['codec'] in capabilities['video_codecs']
+    audio_supported = audio_codec is None or audio_codec in capabilities['audio_codecs']
+    fits = within_limits(capabilities, video_info['height'], video_info['bitrate'])
+
+    if fits and video_supported and audio_supported and source_container(video_path) in capabilities['containers']:
+        return {'method': DIRECT, 'resolution': '原画', 'plan': None, 'allow_hevc': False, 'reason': '客户端可以直接播放源文件'}
+
+    if not capabilities['hls']:
+        # 无法播放HLS时只能尝试直接播放
+        return {'method': DIRECT, 'resolution': '原画', 'plan': None, 'allow_hevc': False, 'reason': '客户端不支持HLS'}
+
+    if fits and video_supported:
+        allow_hevc = TRANSCODING_CONFIG['remux']['allow_hevc'] and 'hevc' in capabilities['video_codecs']
+        plan = TranscodingService.stream_plan(video_info, REMUX_RESOLUTION, allow_hevc=allow_hevc)
+        if plan['audio'] == 'copy' and not audio_supported:
+            plan['audio'] = 'encode'
+        if plan['video'] == 'copy':
+            if plan['audio'] == 'encode':
+                return {'method': AUDIO_TRANSCODE, 'resolution': REMUX_RESOLUTION, 'plan': plan,
+                        'allow_hevc': allow_hevc, 'reason': f'视频直接复制，转码音频（{audio_codec}）'}
+            return {'method': REMUX, 'resolution': REMUX_RESOLUTION, 'plan': plan,
+                    'allow_hevc': allow_hevc, 'reason': '视频和音频直接复制为HLS'}
+
+    resolution = choose_resolution(capabilities, resolutions)
+    if resolution is None:
+        raise ValueError("没有可用的转码分辨率")
+    if not video_supported:
+        reason = f'客户端不支持视频编码（{video_info["codec"]}）'
+    elif not fits:
+        reason = '源视频超过客户端分辨率或带宽上限'
+    else:
+        reason = '视频编码不能直接复制'
+    return {'method': TRANSCODE, 'resolution': resolution, 'plan': None, 'allow_hevc': False, 'reason': reason}
@@ -0,0 +1,208 @@
+"""
+FFmpeg进度遥测
+- 受管理的FFmpeg进程都带 -progress pipe:1 -nostats：FFmpeg每隔约0.5秒向stdout写一组 key=value，
+  每组以 progress=continue（结束时为 progress=end）收尾
+- 读取线程逐组解析，记录已输出时间、帧率、速度、码率和丢帧/重复帧数，
+  按视频时长计算完成百分比和预计剩余时间
+- 每秒保留一个采样（最多 MAX_SAMPLES 个），点播缓存转码把最终结果和全部采样写入输出目录的
+  progress.json，用于基准测试；其他worker进程查询状态时读取该文件
+- 与其他输出共用stdout时（即时分段转码的片段列表），不含"="的行交给调用方处理
+"""
+
+import os
+import json
+import time
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_ARGS = ['-progress', 'pipe:1', '-nostats']
+PROGRESS_FILE = 'progress.json'
+
+# 采样间隔（秒）和保留的采样数
+SAMPLE_INTERVAL = 1.0
+MAX_SAMPLES = 7200
+
+# 写入progress.json的最小间隔（秒）
+WRITE_INTERVAL = 2.0
+
+
+def _number(value):
+    """FFmpeg输出的数值，N/A或无法解析时返回None"""
+    try:
+        return float(value.rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+class ProgressTracker:
+    """
+    一个FFmpeg进程的进度
+
+    duration为本次转码覆盖的视频时长（秒），offset为输出起点在完整视频中的位置（输入定位时），
+    两者用于计算完成百分比和预计剩余时间；path不为空时定期写入进度文件。
+    """
+
+    def __init__(self, duration=None, offset=0.0, path=None):
+        self.duration = duration
+        self.offset = offset
+        self.path = path
+        self.started_at = time.time()
+        self.updated_at = None
+        self.finished = False
+        self.out_time = 0.0  # 已输出的视频时间（秒，不含offset）
+        self.frame = 0
+        self.fps = None
+        self.speed = None
+        self.bitrate = None  # kbit/s
+        self.total_size = 0
+        self.drop_frames = 0
+        self.dup_frames = 0
+        self.samples = deque(maxlen=MAX_SAMPLES)
+        self._block = {}
+        self._written_at = 0.0
+        self._thread = None
+
+    def feed(self, line):
+        """处理一行输出；是进度行时返回True"""
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            return False
+        if key == 'progress':
+            self._commit(self._block, value == 'end')
+            self._block = {}
+        else:
+            self._block[key] = value
+        return True
+
+    def follow(self, stream, on_line=None):
+        """读取stream直到结束，非进度行交给on_line"""
+        try:
+            for line in stream:
+                if not self.feed(line) and on_line is not None:
+                    on_line(line)
+        except (OSError, ValueError):
+            pass
+        self.finish()
+
+    def start(self, stream):
+        """在后台线程中读取stream"""
+        self._thread = threading.Thread(target=self.follow, args=(stream,), daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """等待读取线程处理完全部输出"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def finish(self):
+        """进程结束：写入最终结果和全部采样"""
+        self.finished = True
+        self.write(samples=True)
+
+    @property
+    def position(self):
+        """在完整视频中的位置（秒）"""
+        return self.offset + self.out_time
+
+    @property
+    def percent(self):
+        if not self.duration:
+            return None
+        return round(min(100.0, self.out_time / self.duration * 100), 1)
+
+    @property
+    def eta(self):
+        """预计剩余秒数，速度未知时为None"""
+        if not self.duration or not self.speed:
+            return None
+        return round(max(0.0, self.duration - self.out_time) / self.speed, 1)
+
+    def snapshot(self):
+        return {
+            'out_time': round(self.out_time, 2),
+            'position': round(self.position, 2),
+            'duration': self.duration,
+            'percent': self.percent,
+            'eta': self.eta,
+            'frame': self.frame,
+            'fps': self.fps,
+            'speed': self.speed,
+            'bitrate': self.bitrate,
+            'total_size': self.total_size,
+            'drop_frames': self.drop_frames,
+            'dup_frames': self.dup_frames,
+            'elapsed': round((self.updated_at or time.time()) - self.started_at, 1),
+            'updated_at': self.updated_at,
+            'finished': self.finished,
+        }
+
+    def summary(self):
+        """基准测试用的汇总：平均/最低/最高速度和帧率"""
+        speeds = [sample[2] for sample in self.samples if sample[2]]
+        fps = [sample[3] for sample in self.samples if sample[3]]
+        return {
+            'samples': len(self.samples),
+            'speed_avg': round(sum(speeds) / len(speeds), 2) if speeds else None,
+            'speed_min': min(speeds, default=None),
+            'speed_max': max(speeds, default=None),
+            'fps_avg': round(sum(fps) / len(fps), 1) if fps else None,
+            'drop_frames': self.drop_frames,
+            'dup_frames': self.dup_frames,
+        }
+
+    def write(self, samples=False):
+        """写入进度文件（先写临时文件再替换）；samples为True时包含汇总和全部采样"""
+        if not self.path:
+            return
+        data = self.snapshot()
+        if samples:
+            data['summary'] = self.summary()
+            # 采样：(耗时, 已输出时间, 速度, 帧率, 码率, 丢帧数)
+            data['samples'] = list(self.samples)
+        tmp_path = f"{self.path}.{os.getpid()}"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"写入转码进度失败: {self.path} - {e}")
+
+    def _commit(self, block, end):
+        """一组进度输出完整后更新状态"""
+        now = time.time()
+        # out_time_us 是新版FFmpeg的字段，旧版本只有单位同样是微秒的 out_time_ms
+        out_time = _number(block.get('out_time_us', block.get('out_time_ms')))
+        if out_time is not None and out_time >= 0:
+            self.out_time = out_time / 1000000
+        self.frame = int(_number(block.get('frame')) or self.frame)
+        self.fps = _number(block.get('fps')) or self.fps
+        self.speed = _number(block.get('speed'))
+        self.bitrate = _number(block.get('bitrate', '').replace('kbits/s', ''))
+        self.total_size = int(_number(block.get('total_size')) or self.total_size)
+        self.drop_frames = int(_number(block.get('drop_frames')) or self.drop_frames)
+        self.dup_frames = int(_number(block.get('dup_frames')) or self.dup_frames)
+        self.updated_at = now
+        if end:
+            self.finished = True
+
+        elapsed = now - self.started_at
+        if not self.samples or elapsed - self.samples[-1][0] >= SAMPLE_INTERVAL:
+            self.samples.append((
+                round(elapsed, 2), round(self.out_time, 2), self.speed, self.fps, self.bitrate, self.drop_frames,
+            ))
+        if now - self._written_at >= WRITE_INTERVAL:
+            self._written_at = now
+            self.write()
+
+
+def read_progress(output_dir):
+    """读取输出目录中的进度文件（其他worker进程写入），不存在时返回None"""
+    try:
+        with open(os.path.join(output_dir, PROGRESS_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
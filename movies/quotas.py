@@ -0,0 +1,245 @@
+"""
+转码配额
+- 每个用户同时运行的转码会话数、时间窗口内消耗的编码器时间（秒）都有上限
+- 所有为用户启动编码器的路径都占用配额（TranscodeSession.kind）：
+  - realtime：实时转码会话，FFmpeg结束时结束
+  - ondemand：即时分段转码的一次播放（播放令牌中带会话ID），片段请求刷新最后访问时间；
+    同一用户再次播放同一影片时替换原来的会话，被淘汰或替换后原令牌的片段请求被拒绝
+  - cached：用户发起的点播缓存/自适应码率转码任务（附加到已有任务或命中缓存时不占用），任务结束时结束
+- 限额来源：用户自己的配额 > 所在用户组中最宽松的配额 > TRANSCODING_CONFIG['quotas'] 的默认值；
+  超级用户不受限制
+- 会话记录在数据库（TranscodeSession）中，所有worker进程共用同一份计数；
+  同一用户的并发请求在事务开始时先对用户行执行一次不改变数据的UPDATE取得写锁，再计数和创建会话：
+  SQLite不支持SELECT ... FOR UPDATE（select_for_update会被忽略），UPDATE会立即取得数据库写锁，
+  其他数据库上则锁定该用户行，检查和创建因此不会交错
+- 新会话超出并发数时淘汰该用户最久未访问、且已空闲 idle_seconds 以上的会话（点播缓存任务只在
+  所在进程已退出时淘汰）；没有可以淘汰的会话时拒绝。实时会话在其他进程中时写入停止标记，由所在进程停止
+- 编码器时间：实时会话按FFmpeg实际运行（未被节流暂停）的时间计算，直接复制视频的会话不计入，
+  运行中的会话由所在进程每 sync_interval 秒写回一次；点播缓存任务按FFmpeg的运行时间计算；
+  即时分段转码的片段由所有观众共用，只计入并发会话数
+"""
+
+import os
+import uuid
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import TranscodeQuota, TranscodeSession
+from .transcoding import TRANSCODING_CONFIG, TranscodingService, REALTIME_PLAYHEAD_FILE
+from .capabilities import pid_alive
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """启动转码任务时超出配额，reservation为 reserve 的返回值"""
+
+    def __init__(self, reservation):
+        super().__init__(reservation['error'])
+        self.reservation = reservation
+
+
+def quota_config():
+    return TRANSCODING_CONFIG['quotas']
+
+
+def limits_for(user):
+    """用户的限额 {'max_sessions', 'encoder_seconds'}（0为不限制），不受限制时返回None"""
+    config = quota_config()
+    if not config['enabled'] or user.is_superuser:
+        return None
+
+    quota = TranscodeQuota.objects.filter(user=user).first()
+    if quota is not None:
+        return {'max_sessions': quota.max_sessions, 'encoder_seconds': quota.max_encoder_seconds}
+
+    group_quotas = list(TranscodeQuota.objects.filter(group__in=user.groups.all()))
+    if group_quotas:
+        # 多个组时取最宽松的配额，0表示不限制
+        def loosest(values):
+            return 0 if 0 in values else max(values)
+        return {
+            'max_sessions': loosest([quota.max_sessions for quota in group_quotas]),
+            'encoder_seconds': loosest([quota.max_encoder_seconds for quota in group_quotas]),
+        }
+
+    return {'max_sessions': config['max_sessions'], 'encoder_seconds': config['encoder_seconds']}
+
+
+def usage(user):
+    """用户当前的用量：运行中的会话数、时间窗口内的编码器时间（秒）"""
+    since = timezone.now() - timedelta(seconds=quota_config()['window'])
+    sessions = TranscodeSession.objects.filter(user=user)
+    encoder_seconds = sessions.filter(started_at__gte=since).aggregate(total=Sum('encoder_seconds'))['total']
+    return {
+        'sessions': sessions.filter(ended_at__isnull=True).count(),
+        'encoder_seconds': round(encoder_seconds or 0, 1),
+    }
+
+
+def _evictable(session, idle_cutoff):
+    """会话可以被同一用户的新会话淘汰：点播缓存任务所在进程已退出，其他会话已空闲"""
+    if session.kind == 'cached':
+        return not (session.pid and pid_alive(session.pid))
+    return session.last_access <= idle_cutoff
+
+
+def reserve(user, movie, resolution, kind='realtime'):
+    """
+    为新的转码会话占用配额，kind见 TranscodeSession.KINDS
+
+    成功时返回 {'success': True, 'session_id', 'evicted': [被淘汰的会话ID]}，
+    实时转码的会话ID需要传给 start_realtime_transcoding；
+    超出配额时返回 {'success': False, 'quota': True, 'error', 'usage', 'limits'}。
+    """
+    config = quota_config()
+    limits = limits_for(user)
+    evicted = []
+    now = timezone.now()
+
+    with transaction.atomic():
+        # 先写后读：不改变数据的UPDATE取得写锁（SQLite为整个数据库，其他数据库为该用户行），
+        # 同一用户在不同worker中的请求依次计数和创建会话
+        User.objects.filter(pk=user.pk).update(last_login=F('last_login'))
+        if kind == 'ondemand':
+            # 同一影片的即时分段转码播放（例如切换清晰度）替换原来的会话
+            replaced = list(TranscodeSession.objects.filter(
+                user=user, movie=movie, kind='ondemand', ended_at__isnull=True
+            ).values_list('session_id', flat=True))
+            if replaced:
+                TranscodeSession.objects.filter(session_id__in=replaced).update(ended_at=now, end_reason='stopped')
+                for session_id in replaced:
+                    cache.set(_touch_key(session_id), 'ended', config['sync_interval'])
+        if limits is not None:
+            current = usage(user)
+            if limits['encoder_seconds'] and current['encoder_seconds'] >= limits['encoder_seconds']:
+                logger.warning(f"🎫 {user.username} 的转码时长已用完: {current['encoder_seconds']}/{limits['encoder_seconds']}秒")
+                return {
+                    'success': False, 'quota': True, 'error': '转码时长已用完，请稍后再试或使用原画播放',
+                    'usage': current, 'limits': limits,
+                }
+
+            if limits['max_sessions']:
+                active = list(
+                    TranscodeSession.objects.filter(user=user, ended_at__isnull=True).order_by('last_access')
+                )
+                idle_cutoff = now - timedelta(seconds=config['idle_seconds'])
+                excess = len(active) - limits['max_sessions'] + 1
+                candidates = [session for session in active if _evictable(session, idle_cutoff)][:max(excess, 0)]
+                if len(candidates) < excess:
+                    logger.warning(f"🎫 {user.username} 的转码会话数已达上限: {len(active)}/{limits['max_sessions']}")
+                    return {
+                        'success': False, 'quota': True, 'error': '同时进行的转码会话数已达上限，请先关闭其他播放',
+                        'usage': current, 'limits': limits,
+                    }
+                evicted = [(session.session_id, session.kind) for session in candidates]
+                TranscodeSession.objects.filter(
+                    session_id__in=[session_id for session_id, _ in evicted], ended_at__isnull=True
+                ).update(ended_at=now, end_reason='evicted')
+
+        session = TranscodeSession.objects.create(
+            session_id=str(uuid.uuid4()), user=user, movie=movie, kind=kind,
+            resolution=resolution, pid=os.getpid(),
+        )
+
+    for session_id, evicted_kind in evicted:
+        logger.info(f"♻️ 淘汰 {user.username} 最久未访问的转码会话: {session_id} ({evicted_kind})")
+        if evicted_kind == 'realtime':
+            TranscodingService.request_stop_realtime(session_id)
+        else:
+            cache.set(_touch_key(session_id), 'ended', config['sync_interval'])
+    return {'success': True, 'session_id': session.session_id, 'evicted': [session_id for session_id, _ in evicted]}
+
+
+def release(session_id, reason='failed'):
+    """会话没有启动成功时结束配额记录"""
+    TranscodeSession.objects.filter(session_id=session_id, ended_at__isnull=True).update(
+        ended_at=timezone.now(), end_reason=reason
+    )
+
+
+def _touch_key(session_id):
+    return f"quota_touch:{session_id}"
+
+
+def touch_session(session_id):
+    """
+    即时分段转码的片段请求：刷新会话的最后访问时间，会话已结束（被淘汰或替换）时返回False
+
+    结果在缓存中保留 sync_interval 秒，期间的片段请求不再访问数据库
+    """
+    key = _touch_key(session_id)
+    state = cache.get(key)
+    if state is None:
+        updated = TranscodeSession.objects.filter(session_id=session_id, ended_at__isnull=True).update(
+            last_access=timezone.now()
+        )
+        state = 'active' if updated else 'ended'
+        cache.set(key, state, quota_config()['sync_interval'])
+    return state == 'active'
+
+
+def playback_session_active(payload):
+    """播放令牌（signing.load_playback_token的返回值）对应的配额会话仍然有效；令牌不带配额会话时返回True"""
+    return not payload.get('q') or touch_session(payload['q'])
+
+
+def finish_job(session_id, reason, encoder_seconds):
+    """点播缓存转码任务结束后记录编码器时间并结束会话（由任务所在进程的监控线程调用）"""
+    try:
+        TranscodeSession.objects.filter(session_id=session_id).update(
+            encoder_seconds=encoder_seconds, last_access=timezone.now()
+        )
+        release(session_id, reason)
+    except Exception as e:
+        logger.error(f"记录转码任务结束失败: {session_id} - {e}")
+    finally:
+        # 监控线程不经过请求周期，需要自己关闭数据库连接
+        connection.close()
+
+
+def _session_usage(session):
+    """进程内会话的编码器时间和最后访问时间（其他进程提供的片段请求记录在playhead文件的修改时间）"""
+    if session['plan'] and session['plan']['video'] == 'copy':
+        encoder_seconds = 0.0
+    else:
+        encoder_seconds = TranscodingService.realtime_throttle_stats(session)['running_seconds']
+
+    last_access = session['last_access']
+    try:
+        last_access = max(last_access, os.path.getmtime(os.path.join(session['output_dir'], REALTIME_PLAYHEAD_FILE)))
+    except OSError:
+        pass
+    return encoder_seconds, datetime.fromtimestamp(last_access, tz=dt_timezone.utc)
+
+
+def sync_session(session_id, session):
+    """把运行中会话的用量写回数据库（由会话所在进程的检查线程调用）"""
+    encoder_seconds, last_access = _session_usage(session)
+    try:
+        TranscodeSession.objects.filter(session_id=session_id).update(
+            encoder_seconds=encoder_seconds, last_access=last_access
+        )
+    except Exception as e:
+        logger.error(f"写回转码会话用量失败: {session_id} - {e}")
+
+
+def finish_session(session_id, session, reason):
+    """会话的FFmpeg进程结束后记录最终用量；已被淘汰的会话保留原来的结束原因"""
+    encoder_seconds, last_access = _session_usage(session)
+    try:
+        TranscodeSession.objects.filter(session_id=session_id).update(
+            encoder_seconds=encoder_seconds, last_access=last_access
+        )
+        release(session_id, reason)
+    except Exception as e:
+        logger.error(f"记录转码会话结束失败: {session_id} - {e}")
+    finally:
+        # 监控线程不经过请求周期，需要自己关闭数据库连接
+        connection.close()
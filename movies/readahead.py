@@ -0,0 +1,153 @@
+"""
+媒体流读取的页缓存策略（posix_fadvise）
+- 在客户端当前位置之前发出 WILLNEED 预读，预读窗口按观测到的消费速率调整
+- 冷数据（如一次性观看的媒体库原片）在读过之后发出 DONTNEED，避免挤出热点转码片段
+- 同一文件在本进程内有多个流同时读取时视为热点，不丢弃其页缓存
+- 策略按目录配置：STREAM_READAHEAD_DEFAULT + STREAM_READAHEAD_POLICIES
+- 不支持 posix_fadvise 的平台（如Windows）上所有操作均为空操作
+"""
+
+import os
+import time
+import threading
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED = hasattr(os, 'posix_fadvise')
+
+# 丢弃已读数据时，在当前位置之后保留的字节数（客户端小范围回退时仍能命中缓存）
+KEEP_BEHIND = 4 * 1024 * 1024
+
+# 本进程内正在读取的文件 -> 流数量
+_active_streams = {}
+_active_lock = threading.Lock()
+
+
+def _fadvise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        logger.debug(f"posix_fadvise失败: {e}")
+
+
+def resolve_policy(file_path):
+    """
+    查找文件所属目录的策略（最长匹配），与默认策略合并
+
+    未启用或平台不支持时返回None。
+    """
+    if not SUPPORTED:
+        return None
+
+    policy = dict(settings.STREAM_READAHEAD_DEFAULT)
+    real_path = os.path.realpath(file_path)
+    best_root = ''
+    for root, overrides in settings.STREAM_READAHEAD_POLICIES.items():
+        real_root = os.path.realpath(root)
+        try:
+            if os.path.commonpath([real_path, real_root]) != real_root:
+                continue
+        except ValueError:
+            continue
+        if len(real_root) > len(best_root):
+            best_root = real_root
+            matched = overrides
+    if best_root:
+        policy.update(matched)
+
+    return policy if policy.get('enabled', True) else None
+
+
+class Readahead:
+    """
+    单个流的预读控制
+
+    advance() 在每次读取之后调用；sendfile路径下没有逐块读取，
+    由初始的 SEQUENTIAL/WILLNEED 建议和内核预读完成，关闭时统一丢弃已发送区间。
+    """
+
+    def __init__(self, fd, path, offset, length, policy):
+        self.fd = fd
+        self.path = path
+        self.start = offset
+        self.end = offset + length
+        self.policy = policy
+        self.started_at = time.monotonic()
+        self.rate = 0.0
+        self.position = offset
+        self.advised_until = offset
+        self.dropped_until = offset
+        self.window = policy['min_window']
+
+        with _active_lock:
+            _active_streams[path] = _active_streams.get(path, 0) + 1
+
+        _fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        self._advise_ahead(offset)
+
+    @classmethod
+    def open(cls, file_obj, offset, length):
+        """按文件所属目录的策略创建；策略关闭或平台不支持时返回None"""
+        path = os.path.realpath(file_obj.name)
+        policy = resolve_policy(path)
+        if policy is None or length <= 0:
+            return None
+        return cls(file_obj.fileno(), path, offset, length, policy)
+
+    @property
+    def is_hot(self):
+        with _active_lock:
+            return _active_streams.get(self.path, 0) > 1
+
+    def advance(self, position):
+        """读取到position之后调用：更新消费速率，按需预读和丢弃"""
+        self.position = position
+        elapsed = time.monotonic() - self.started_at
+        if elapsed > 0:
+            self.rate = (position - self.start) / elapsed
+
+        window = int(self.rate * self.policy['window_seconds'])
+        self.window = max(self.policy['min_window'], min(self.policy['max_window'], window))
+
+        # 剩余预读量不足半个窗口时继续预读
+        if self.advised_until - position < self.window // 2:
+            self._advise_ahead(position)
+
+        if self.policy['drop_behind']:
+            drop_until = position - KEEP_BEHIND
+            if drop_until - self.dropped_until >= self.policy['min_window']:
+                self._drop(drop_until)
+
+    def close(self, position=None):
+        """
+        流结束：冷数据丢弃已发送和已预读的区间
+
+        position为关闭时的文件位置（sendfile发送后文件位置会移动到已发送数据的末尾）。
+        """
+        if position is not None:
+            self.position = max(self.position, position)
+        if self.policy['drop_behind']:
+            self._drop(max(self.position, self.advised_until))
+        with _active_lock:
+            count = _active_streams.get(self.path, 0) - 1
+            if count > 0:
+                _active_streams[self.path] = count
+            else:
+                _active_streams.pop(self.path, None)
+
+    def _advise_ahead(self, position):
+        until = min(self.end, position + self.window)
+        begin = max(position, self.advised_until)
+        if until > begin:
+            _fadvise(self.fd, begin, until - begin, os.POSIX_FADV_WILLNEED)
+            self.advised_until = until
+
+    def _drop(self, until):
+        until = min(until, self.end)
+        if until <= self.dropped_until or self.is_hot:
+            return
+        _fadvise(self.fd, self.dropped_until, until - self.dropped_until, os.POSIX_FADV_DONTNEED)
+        self.dropped_until = until
@@ -0,0 +1,321 @@
+"""
+转码任务调度
+- 所有FFmpeg进程启动前先取得所在资源池（编码器类型或直接复制）的执行槽位，槽位用完时排队
+- 优先级：播放中的请求（INTERACTIVE）> 预取（PREFETCH）> 批量预转码（BATCH）
+- 同一优先级内按用户轮流分配（最久未获得槽位的用户优先），同一用户内先到先得
+- 排队中的任务可以取消；任务结束（或启动失败）后必须释放槽位
+- 统计队列深度、运行数量和排队等待时间
+- 排队在进程内进行；指定槽位目录（SlotRegistry）时槽位在整台主机的所有worker进程间共享：
+  每个槽位是目录中的一个文件，持有文件锁即占用槽位，进程退出时锁由系统释放；
+  其他进程释放槽位时不会通知本进程，排队中的任务每 SLOT_POLL_INTERVAL 秒重新尝试。
+  优先级和按用户轮流只在同一进程的排队任务之间生效
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有flock，槽位只在进程内计算
+    fcntl = None
+
+INTERACTIVE = 0
+PREFETCH = 1
+BATCH = 2
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', PREFETCH: 'prefetch', BATCH: 'batch'}
+
+# 保留最近多少次排队等待时间用于统计
+WAIT_SAMPLES = 200
+
+# 使用主机范围的槽位时，排队中的任务重新尝试取得槽位的间隔（秒）
+SLOT_POLL_INTERVAL = 1.0
+
+
+class TicketCancelled(Exception):
+    """排队中的任务已被取消"""
+
+
+class SlotRegistry:
+    """
+    主机范围的执行槽位：目录中的 <资源池>.<序号>.slot 文件，持有文件锁（flock）即占用该槽位
+
+    占用槽位的任务信息（进程、标签和提交时附带的info）以JSON写入槽位文件，
+    holders() 只读取仍被锁定的槽位文件，供统计和准入控制使用。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def supported():
+        return fcntl is not None
+
+    def _path(self, pool, index):
+        return os.path.join(self.directory, f"{pool}.{index}.slot")
+
+    def claim(self, pool, slots, ticket):
+        """占用资源池中的一个空闲槽位，返回持有锁的文件描述符；没有空闲槽位时返回None"""
+        for index in range(slots):
+            fd = os.open(self._path(pool, index), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            record = {
+                'pid': os.getpid(), 'pool': pool, 'label': ticket.label, 'owner': ticket.owner,
+                'priority': ticket.priority, 'granted_at': time.time(), **ticket.info,
+            }
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, json.dumps(record, ensure_ascii=False).encode('utf-8'), 0)
+            return fd
+        return None
+
+    def release(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def holders(self, pool=None):
+        """当前被占用的槽位（整台主机），返回槽位文件中记录的任务信息列表"""
+        records = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return records
+        for name in names:
+            if not name.endswith('.slot') or (pool is not None and not name.startswith(f"{pool}.")):
+                continue
+            try:
+                fd = os.open(os.path.join(self.directory, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except OSError:
+                    # 被其他任务锁定：槽位占用中
+                    try:
+                        records.append(json.loads(os.pread(fd, 65536, 0) or b'{}'))
+                    except ValueError:
+                        records.append({})
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        return records
+
+
+class Ticket:
+    """一个任务的槽位申请：waiting -> running -> done，排队中可以变为 cancelled"""
+
+    def __init__(self, scheduler, ticket_id, pool, priority, owner, label, info=None):
+        self.scheduler = scheduler
+        self.id = ticket_id
+        self.pool = pool
+        self.priority = priority
+        self.owner = owner
+        self.label = label
+        self.info = info or {}
+        self.state = 'waiting'
+        self.submitted_at = time.monotonic()
+        self.granted_at = None
+        self.slot = None  # 主机范围槽位文件的描述符
+
+    @property
+    def waited(self):
+        return (self.granted_at or time.monotonic()) - self.submitted_at
+
+    def wait(self, timeout=None):
+        """等待取得槽位；超时返回False，已取消时抛出TicketCancelled"""
+        return self.scheduler.wait(self, timeout)
+
+    def cancel(self):
+        """取消排队；已经取得槽位时释放槽位"""
+        self.scheduler.cancel(self)
+
+    def withdraw(self):
+        """只取消排队，已经取得槽位时不做处理（由持有者负责释放），返回是否取消"""
+        return self.scheduler.withdraw(self)
+
+    def release(self):
+        self.scheduler.release(self)
+
+
+class TranscodeScheduler:
+    """
+    按资源池限制同时运行的转码任务数，slots(pool)返回资源池的槽位数
+
+    指定registry（SlotRegistry）时槽位数是整台主机的限制，否则每个进程各自计算。
+    """
+
+    def __init__(self, slots, registry=None):
+        self._slots = slots
+        self._registry = registry if registry is not None and registry.supported() else None
+        self._condition = threading.Condition()
+        self._ids = itertools.count(1)
+        self._waiting = []  # 排队中的Ticket
+        self._running = {}  # pool -> {ticket_id: Ticket}
+        self._last_grant = {}  # (pool, owner) -> 最后一次获得槽位的时间
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._totals = {'granted': 0, 'cancelled': 0, 'released': 0}
+
+    def submit(self, pool, priority=INTERACTIVE, owner=None, label='', info=None):
+        """提交槽位申请，有空闲槽位时立即取得；info为写入主机范围槽位文件的任务信息"""
+        with self._condition:
+            ticket = Ticket(self, next(self._ids), pool, priority, owner, label, info)
+            self._waiting.append(ticket)
+            self._dispatch(pool)
+            return ticket
+
+    def acquire(self, pool, priority=INTERACTIVE, owner=None, label='', timeout=None, info=None):
+        """提交并等待槽位；超时后取消排队并返回None"""
+        ticket = self.submit(pool, priority, owner, label, info)
+        if ticket.wait(timeout):
+            return ticket
+        ticket.cancel()
+        return None
+
+    def wait(self, ticket, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while ticket.state == 'waiting':
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                if self._registry is None:
+                    self._condition.wait(remaining)
+                else:
+                    # 其他进程释放槽位时不会通知本进程，定期重新尝试
+                    self._condition.wait(SLOT_POLL_INTERVAL if remaining is None else min(remaining, SLOT_POLL_INTERVAL))
+                    self._dispatch(ticket.pool)
+            if ticket.state == 'cancelled':
+                raise TicketCancelled(ticket.label)
+            return True
+
+    def cancel(self, ticket):
+        with self._condition:
+            if ticket.state == 'waiting':
+                self._waiting.remove(ticket)
+                ticket.state = 'cancelled'
+                self._totals['cancelled'] += 1
+                self._condition.notify_all()
+            elif ticket.state == 'running':
+                self._release(ticket)
+
+    def withdraw(self, ticket):
+        with self._condition:
+            if ticket.state != 'waiting':
+                return False
+            self._waiting.remove(ticket)
+            ticket.state = 'cancelled'
+            self._totals['cancelled'] += 1
+            self._condition.notify_all()
+            return True
+
+    def release(self, ticket):
+        """任务结束后释放槽位（可以重复调用）"""
+        with self._condition:
+            if ticket.state == 'running':
+                self._release(ticket)
+
+    def position(self, ticket):
+        """排队位置（从1开始），不在排队中时返回0"""
+        with self._condition:
+            if ticket.state != 'waiting':
+                return 0
+            queue = self._ordered(ticket.pool)
+            return queue.index(ticket) + 1
+
+    def holders(self, pool=None):
+        """整台主机上占用槽位的任务信息；没有主机范围的槽位时返回当前进程的运行任务"""
+        if self._registry is not None:
+            return self._registry.holders(pool)
+        with self._condition:
+            return [
+                {'pid': os.getpid(), 'pool': ticket.pool, 'label': ticket.label, 'owner': ticket.owner,
+                 'priority': ticket.priority, **ticket.info}
+                for running in self._running.values() for ticket in running.values()
+                if pool is None or ticket.pool == pool
+            ]
+
+    def stats(self):
+        """
+        各资源池的槽位、运行和排队数量，按优先级的排队数量，排队等待时间统计
+
+        running/queued为当前进程的数量，host_running为整台主机占用的槽位数
+        """
+        host_running = {}
+        for record in self.holders():
+            host_running[record.get('pool')] = host_running.get(record.get('pool'), 0) + 1
+        with self._condition:
+            pools = {}
+            for pool in set(self._running) | {ticket.pool for ticket in self._waiting} | set(host_running):
+                pools[pool] = {
+                    'slots': self._slots(pool),
+                    'running': len(self._running.get(pool, {})),
+                    'host_running': host_running.get(pool, 0),
+                    'queued': sum(1 for ticket in self._waiting if ticket.pool == pool),
+                }
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for ticket in self._waiting:
+                queued[PRIORITY_NAMES[ticket.priority]] += 1
+            now = time.monotonic()
+            waits = sorted(self._waits)
+            return {
+                'pools': pools,
+                'queued': queued,
+                'oldest_wait': round(max((now - ticket.submitted_at for ticket in self._waiting), default=0), 2),
+                'wait_avg': round(sum(waits) / len(waits), 3) if waits else 0,
+                'wait_p95': round(waits[int(len(waits) * 0.95)], 3) if waits else 0,
+                'wait_max': round(waits[-1], 3) if waits else 0,
+                **self._totals,
+            }
+
+    # ---------- 内部实现（需持有condition） ----------
+
+    def _release(self, ticket):
+        self._running[ticket.pool].pop(ticket.id, None)
+        if ticket.slot is not None:
+            self._registry.release(ticket.slot)
+            ticket.slot = None
+        ticket.state = 'done'
+        self._totals['released'] += 1
+        self._dispatch(ticket.pool)
+
+    def _ordered(self, pool):
+        """资源池的排队顺序：优先级、该用户最后一次获得槽位的时间、提交顺序"""
+        return sorted(
+            (ticket for ticket in self._waiting if ticket.pool == pool),
+            key=lambda ticket: (ticket.priority, self._last_grant.get((pool, ticket.owner), 0), ticket.id),
+        )
+
+    def _dispatch(self, pool):
+        running = self._running.setdefault(pool, {})
+        granted = False
+        while len(running) < self._slots(pool):
+            queue = self._ordered(pool)
+            if not queue:
+                break
+            ticket = queue[0]
+            if self._registry is not None:
+                ticket.slot = self._registry.claim(pool, self._slots(pool), ticket)
+                if ticket.slot is None:
+                    break
+            self._waiting.remove(ticket)
+            ticket.state = 'running'
+            ticket.granted_at = time.monotonic()
+            running[ticket.id] = ticket
+            self._last_grant[(pool, ticket.owner)] = ticket.granted_at
+            self._waits.append(ticket.waited)
+            self._totals['granted'] += 1
+            granted = True
+        if granted:
+            self._condition.notify_all()
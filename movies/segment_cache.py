@@ -0,0 +1,125 @@
+"""
+热点HLS片段的进程内缓存
+- 线程安全的LRU，按字节预算淘汰
+- 以 (路径, mtime, size) 判定缓存是否有效，文件被重写后不会命中旧内容
+- 只缓存已完成转码输出中的片段（见 hls.is_segment_final），仍在增长的输出直接读文件
+- 每个worker进程各自一份缓存，预算按进程计算
+"""
+
+import os
+import threading
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentCache:
+    """按字节预算淘汰的LRU片段缓存"""
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = OrderedDict()  # path -> (mtime_ns, size, data)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, path, stat_result):
+        """返回缓存的文件内容，未命中或文件已变化时返回None"""
+        path = str(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                mtime_ns, size, data = entry
+                if mtime_ns == stat_result.st_mtime_ns and size == stat_result.st_size:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return data
+                # 文件已被重写，丢弃旧内容
+                self._remove(path)
+            self.misses += 1
+            return None
+
+    def put(self, path, stat_result, data):
+        """放入缓存，超过单项上限的文件不缓存"""
+        if not self.enabled or len(data) > self.max_item_bytes:
+            return
+        path = str(path)
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            self._entries[path] = (stat_result.st_mtime_ns, stat_result.st_size, data)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def load(self, path, stat_result):
+        """
+        读取片段内容：命中直接返回，否则读文件并放入缓存
+
+        读取过程中文件发生变化（大小或mtime与stat_result不一致）时不缓存，返回None，
+        调用方应回退到直接发送文件。
+        """
+        data = self.get(path, stat_result)
+        if data is not None:
+            return data
+
+        if stat_result.st_size > self.max_item_bytes:
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+            current = os.fstat(f.fileno())
+        if (current.st_mtime_ns != stat_result.st_mtime_ns or current.st_size != stat_result.st_size
+                or len(data) != stat_result.st_size):
+            logger.debug(f"片段在读取过程中发生变化，不缓存: {path}")
+            return None
+
+        self.put(path, stat_result, data)
+        return data
+
+    def discard_prefix(self, directory):
+        """转码输出目录被删除时清理其中的片段"""
+        prefix = os.path.join(str(directory), '')
+        with self._lock:
+            for path in [path for path in self._entries if path.startswith(prefix)]:
+                self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _remove(self, path):
+        _, _, data = self._entries.pop(path)
+        self.current_bytes -= len(data)
+
+
+segment_cache = SegmentCache(
+    max_bytes=settings.HLS_SEGMENT_CACHE_BYTES,
+    max_item_bytes=settings.HLS_SEGMENT_CACHE_MAX_ITEM_BYTES,
+)
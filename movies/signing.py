@@ -0,0 +1,187 @@
+"""
+签名URL和播放令牌
+
+实时转码播放令牌：
+- realtime_transcode_request 签发，绑定转码会话ID和用户，带过期时间
+- 播放列表和片段请求只做签名校验（纯CPU），不读取数据库会话，
+  多个gunicorn worker之间通用，服务重启后依然有效
+
+媒体边缘服务器（run_media_edge）的签名URL：
+- Django在页面/接口中签发短时有效的HMAC签名URL
+- 边缘服务器只凭共享密钥校验签名和过期时间，不访问数据库和会话
+
+URL格式: {MEDIA_EDGE_URL}/s/<过期时间戳>/<签名>/<范围>/<文件>
+- 媒体库文件: lib/<根目录序号>/<相对路径>，签名覆盖到具体文件
+- 转码输出:   tx/<输出目录名>/<文件名>，签名只覆盖到目录，
+  播放列表中的相对片段地址会自动继承同一签名前缀
+"""
+
+import os
+import time
+import hmac
+import base64
+import hashlib
+import logging
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core import signing
+
+logger = logging.getLogger(__name__)
+
+SIGNED_PREFIX = '/s/'
+
+PLAYBACK_TOKEN_SALT = 'movies.realtime.playback'
+
+
+def issue_playback_token(session_id, user_id, quota_session=None):
+    """签发实时转码播放令牌；quota_session为占用配额的会话ID（与session_id不同时，例如即时分段转码）"""
+    payload = {'s': session_id, 'u': user_id}
+    if quota_session:
+        payload['q'] = quota_session
+    return signing.dumps(payload, salt=PLAYBACK_TOKEN_SALT)
+
+
+def load_playback_token(token, session_id, user_id=None):
+    """
+    校验播放令牌是否属于该转码会话（user_id不为None时同时校验用户），返回令牌内容
+
+    令牌缺失、签名无效、已过期或不匹配时返回None。
+    """
+    if not token:
+        return None
+    try:
+        payload = signing.loads(token, salt=PLAYBACK_TOKEN_SALT, max_age=settings.REALTIME_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        # 包括 SignatureExpired
+        return None
+    if payload.get('s') != session_id:
+        return None
+    if user_id is not None and payload.get('u') != user_id:
+        return None
+    return payload
+
+
+def verify_playback_token(token, session_id, user_id=None):
+    """校验播放令牌是否属于该转码会话，参数同 load_playback_token"""
+    return load_playback_token(token, session_id, user_id) is not None
+
+
+class EdgeSignatureError(Exception):
+    """签名URL无效或已过期"""
+
+
+class EdgeSignatureExpired(EdgeSignatureError):
+    """签名URL已过期"""
+
+
+def edge_enabled():
+    return bool(getattr(settings, 'MEDIA_EDGE_URL', ''))
+
+
+def library_roots():
+    return list(getattr(settings, 'MEDIA_EDGE_LIBRARY_ROOTS', []))
+
+
+def transcoded_root():
+    return os.path.join(settings.MEDIA_ROOT, 'transcoded')
+
+
+def edge_expiry(now=None):
+    """
+    签名过期时间
+
+    按TTL的1/10取整，同一时间段内签发的URL完全相同，浏览器和CDN缓存可以复用。
+    """
+    ttl = settings.MEDIA_EDGE_TTL
+    step = max(60, ttl // 10)
+    now = int(now if now is not None else time.time())
+    return (now + ttl + step - 1) // step * step
+
+
+def sign(scope, expires):
+    """计算签名：HMAC-SHA256(密钥, "过期时间/范围")，取前18字节做URL安全的base64"""
+    message = f'{expires}/{scope}'.encode('utf-8')
+    digest = hmac.new(settings.MEDIA_EDGE_SECRET.encode('utf-8'), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode('ascii')
+
+
+def _signed_url(scope, rest, expires):
+    expires = expires or edge_expiry()
+    signature = sign(scope, expires)
+    return f"{settings.MEDIA_EDGE_URL.rstrip('/')}{SIGNED_PREFIX}{expires}/{signature}/{quote(scope + rest)}"
+
+
+def _relative_to(path, root):
+    """path位于root内时返回使用'/'分隔的相对路径，否则返回None"""
+    real_path = os.path.realpath(path)
+    real_root = os.path.realpath(root)
+    try:
+        if os.path.commonpath([real_path, real_root]) != real_root:
+            return None
+    except ValueError:
+        # Windows下不同盘符无法比较
+        return None
+    return os.path.relpath(real_path, real_root).replace(os.sep, '/')
+
+
+def edge_library_url(file_path, expires=None):
+    """媒体库文件的签名URL；未启用边缘服务器或文件不在媒体库目录内时返回None"""
+    if not edge_enabled():
+        return None
+    for index, root in enumerate(library_roots()):
+        relative = _relative_to(file_path, root)
+        if relative:
+            return _signed_url(f'lib/{index}/{relative}', '', expires)
+    logger.debug(f"文件不在边缘服务器的媒体库目录内: {file_path}")
+    return None
+
+
+def edge_transcoded_url(output_name, filename='', expires=None):
+    """
+    转码输出目录（或其中文件）的签名URL；未启用边缘服务器时返回None
+
+    filename为空时返回以'/'结尾的目录前缀，可直接拼接片段文件名。
+    """
+    if not edge_enabled():
+        return None
+    return _signed_url(f'tx/{output_name}/', filename, expires)
+
+
+def verify_edge_path(path, now=None):
+    """
+    校验签名路径（已URL解码）
+
+    成功返回 (kind, 定位信息)：
+    - ('lib', (根目录序号, 相对路径))
+    - ('tx', (输出目录名, 目录内文件相对路径))
+    签名无效或已过期时抛出 EdgeSignatureError。
+    """
+    if not path.startswith(SIGNED_PREFIX):
+        raise EdgeSignatureError('不是签名路径')
+
+    try:
+        expires, signature, kind, rest = path[len(SIGNED_PREFIX):].split('/', 3)
+        expires = int(expires)
+    except ValueError:
+        raise EdgeSignatureError('签名路径格式错误')
+
+    if kind == 'lib':
+        index, _, relative = rest.partition('/')
+        if not index.isdigit() or not relative:
+            raise EdgeSignatureError('签名路径格式错误')
+        scope, located = f'lib/{index}/{relative}', (int(index), relative)
+    elif kind == 'tx':
+        output_name, sep, relative = rest.partition('/')
+        if not sep or output_name in ('', '.', '..'):
+            raise EdgeSignatureError('签名路径格式错误')
+        scope, located = f'tx/{output_name}/', (output_name, relative)
+    else:
+        raise EdgeSignatureError(f'未知的签名范围: {kind}')
+
+    if not hmac.compare_digest(sign(scope, expires), signature):
+        raise EdgeSignatureError('签名无效')
+    if expires < (now if now is not None else time.time()):
+        raise EdgeSignatureExpired('签名已过期')
+
+    return kind, located
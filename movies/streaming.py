@@ -0,0 +1,540 @@
+"""
+媒体文件流式传输引擎
+- 解析HTTP Range请求（普通区间、开放区间、后缀区间、多区间）
+- 单区间响应交给 wsgi.file_wrapper，由gunicorn通过os.sendfile零拷贝发送
+- 多区间返回 multipart/byteranges
+- 不可满足的区间返回416
+- 可选将传输卸载给nginx(X-Accel-Redirect)或Apache/lighttpd(X-Sendfile)
+- 基于 (inode, size, mtime) 的强ETag，支持304/412条件请求和If-Range断点续传
+- 提供ASGI异步版本，文件读取放到线程池，不阻塞事件循环
+- 已完成转码的热点片段可从进程内缓存发送（见 segment_cache）
+- 按目录策略发出posix_fadvise预读/丢弃建议（见 readahead）
+- 可按视频码率限速并受进程级出口带宽上限约束（见 pacing）：进程内限速只在ASGI版本中进行（等待不占用线程），
+  同步版本不在worker中等待，只通过 X-Accel-Limit-Rate 交给nginx限速
+- 热点文件的打开句柄和stat结果在进程内复用（见 fd_cache）
+"""
+
+import os
+import re
+import asyncio
+import uuid
+import hashlib
+import mimetypes
+import logging
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from .segment_cache import segment_cache
+from .readahead import Readahead
+from .pacing import open_stream, stream_rate, pacing_enabled
+from .fd_cache import file_handles
+
+logger = logging.getLogger(__name__)
+
+# 读取块大小：1MB，且与块边界对齐，便于内核预读和sendfile批量发送
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 单个请求允许的最大区间数，超过则忽略Range头直接返回整个文件（防止滥用）
+MAX_RANGES = 16
+
+_RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class RangeNotSatisfiable(Exception):
+    """请求的区间均无法满足（对应HTTP 416）"""
+
+
+def parse_range_header(range_header, file_size):
+    """
+    解析Range请求头
+
+    返回按起点排序并合并重叠部分后的 [(start, end), ...]（end为闭区间）；
+    请求头缺失、单位不是bytes或语法无效时返回None，表示按完整文件响应；
+    所有区间都不可满足时抛出 RangeNotSatisfiable。
+    """
+    if not range_header:
+        return None
+
+    unit, sep, specs = range_header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = _RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+
+        if not first:
+            # 后缀区间 bytes=-N：最后N个字节
+            if not last:
+                return None
+            suffix_length = int(last)
+            if suffix_length == 0:
+                continue
+            start = max(0, file_size - suffix_length)
+            end = file_size - 1
+        else:
+            start = int(first)
+            if last:
+                end = int(last)
+                if end < start:
+                    return None
+                end = min(end, file_size - 1)
+            else:
+                # 开放区间 bytes=N-
+                end = file_size - 1
+            if start >= file_size:
+                continue
+
+        if start <= end:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # 合并重叠或相邻的区间
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileWrapper:
+    """
+    限定区间的只读文件对象
+
+    - 暴露fileno()，gunicorn的wsgi.file_wrapper据此调用os.sendfile，
+      并以当前文件位置为起点、Content-Length为长度发送
+    - read()不会越过区间末尾，runserver等不支持sendfile的服务器按块读取时同样正确
+    - 首个块读取到块边界为止，之后每次读取都是对齐的整块
+    - 传入readahead时每次读取后更新预读窗口，关闭时按策略丢弃页缓存
+    """
+
+    def __init__(self, file_obj, offset, length, chunk_size=STREAM_CHUNK_SIZE, readahead=None):
+        self.file_obj = file_obj
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.name = getattr(file_obj, 'name', '')
+        self.file_obj.seek(offset)
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0:
+            size = self.remaining
+        # 对齐到块边界
+        position = self.file_obj.tell()
+        aligned = self.chunk_size - (position % self.chunk_size)
+        size = min(size, aligned, self.remaining)
+        data = self.file_obj.read(size)
+        self.remaining -= len(data)
+        if self.readahead is not None:
+            self.readahead.advance(position + len(data))
+        return data
+
+    def close(self):
+        if self.readahead is not None:
+            self.readahead.close(self.file_obj.tell())
+            self.readahead = None
+        self.file_obj.close()
+
+
+def file_validators(stat_result):
+    """根据文件状态生成 (强ETag, Last-Modified时间戳)"""
+    etag = f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+    return etag, int(stat_result.st_mtime)
+
+
+def if_range_matches(request, etag, last_modified):
+    """
+    判断If-Range条件是否成立
+
+    If-Range为ETag时要求强匹配（弱ETag永不匹配），为日期时要求与Last-Modified完全一致；
+    不成立时应忽略Range头返回完整文件。
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('W/'):
+        return False
+    if if_range.startswith('"'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and date == last_modified
+
+
+def vary_etag(etag, variant):
+    """响应内容除文件外还取决于variant（如URL中的令牌）时，把它的摘要并入ETag"""
+    digest = hashlib.sha1(str(variant).encode('utf-8')).hexdigest()[:12]
+    return f'{etag[:-1]}-{digest}"'
+
+
+def set_validators(response, etag, last_modified, cache_control=None):
+    """为响应设置ETag、Last-Modified和缓存策略"""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if cache_control:
+        response['Cache-Control'] = cache_control
+    return response
+
+
+def conditional_response(request, etag, last_modified, cache_control=None):
+    """
+    评估条件请求头（If-Match / If-Unmodified-Since / If-None-Match / If-Modified-Since）
+
+    需要返回304或412时返回对应响应，否则返回None。
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        return None
+    if response.status_code == 304:
+        set_validators(response, etag, last_modified, cache_control)
+    return response
+
+
+def guess_content_type(file_path, default='application/octet-stream'):
+    """根据文件名推断MIME类型"""
+    content_type, _ = mimetypes.guess_type(str(file_path))
+    return content_type or default
+
+
+def multipart_parts(ranges, file_size, content_type, boundary):
+    """
+    multipart/byteranges响应体的组成部分
+
+    依次产出分隔头（bytes）和文件区间（(start, end)元组），
+    同步、异步迭代器和边缘服务器（movies.edge）分别负责发送文件区间。
+    """
+    for start, end in ranges:
+        yield (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+        ).encode('latin-1')
+        yield (start, end)
+    yield f'\r\n--{boundary}--\r\n'.encode('latin-1')
+
+
+def parts_length(parts):
+    """预先计算响应体的总长度"""
+    return sum(len(part) if isinstance(part, bytes) else part[1] - part[0] + 1 for part in parts)
+
+
+def _open_readahead(f, parts):
+    """只有单个区间（完整文件或单区间请求）时使用预读策略"""
+    if len(parts) != 1 or isinstance(parts[0], bytes):
+        return None
+    start, end = parts[0]
+    return Readahead.open(f, start, end - start + 1)
+
+
+def _file_parts_iterator(f, parts, chunk_size):
+    """同步读取：逐个产出分隔头和文件区间数据，结束时关闭（归还）文件"""
+    readahead = None
+    try:
+        readahead = _open_readahead(f, parts)
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, end = part
+            reader = RangeFileWrapper(f, start, end - start + 1, chunk_size, readahead)
+            while True:
+                data = reader.read(chunk_size)
+                if not data:
+                    break
+                yield data
+    finally:
+        if readahead is not None:
+            readahead.close(f.tell())
+        f.close()
+
+
+async def _async_file_parts_iterator(f, parts, chunk_size, pacer=None):
+    """异步读取：文件IO放到线程池执行，不阻塞事件循环；限速等待使用asyncio.sleep，不占用线程"""
+    readahead = None
+    try:
+        readahead = await asyncio.to_thread(_open_readahead, f, parts)
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, end = part
+            reader = RangeFileWrapper(f, start, end - start + 1, chunk_size, readahead)
+            while True:
+                data = await asyncio.to_thread(reader.read, chunk_size)
+                if not data:
+                    break
+                yield data
+                if pacer is not None:
+                    delay = pacer.consume(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+    finally:
+        if pacer is not None:
+            pacer.close()
+        if readahead is not None:
+            await asyncio.to_thread(readahead.close, f.tell())
+        await asyncio.to_thread(f.close)
+
+
+def range_not_satisfiable_response(file_size):
+    """416响应"""
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{file_size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def resolve_ranges(request, stat_result):
+    """
+    根据Range和If-Range请求头确定要发送的区间
+
+    返回区间列表，None表示发送整个文件；不可满足时抛出 RangeNotSatisfiable。
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if not range_header:
+        return None
+    etag, last_modified = file_validators(stat_result)
+    if not if_range_matches(request, etag, last_modified):
+        return None
+    return parse_range_header(range_header, stat_result.st_size)
+
+
+def _range_response(request, handle, content_type, chunk_size, asynchronous, pacer=None):
+    """file_range_response / async_file_range_response 的公共实现，handle为从fd_cache借出的文件，pacer只用于异步版本"""
+    stat_result = handle.stat
+    file_size = stat_result.st_size
+    content_type = content_type or guess_content_type(handle.path)
+
+    try:
+        ranges = resolve_ranges(request, stat_result)
+    except RangeNotSatisfiable:
+        if pacer is not None:
+            pacer.close()
+        handle.close()
+        return range_not_satisfiable_response(file_size)
+
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        parts = list(multipart_parts(ranges, file_size, content_type, boundary))
+        status = 206
+        content_type = f'multipart/byteranges; boundary={boundary}'
+    elif ranges:
+        parts = ranges
+        status = 206
+    else:
+        parts = [(0, file_size - 1)] if file_size else []
+        status = 200
+
+    if asynchronous:
+        response = StreamingHttpResponse(
+            _async_file_parts_iterator(handle, parts, chunk_size, pacer),
+            status=status, content_type=content_type,
+        )
+    elif len(parts) == 1:
+        # 单区间：交给wsgi.file_wrapper，gunicorn会使用sendfile零拷贝发送
+        start, end = parts[0]
+        wrapper = RangeFileWrapper(handle, start, end - start + 1, chunk_size, _open_readahead(handle, parts))
+        response = FileResponse(wrapper, status=status, content_type=content_type)
+        response.block_size = chunk_size
+    else:
+        response = StreamingHttpResponse(
+            _file_parts_iterator(handle, parts, chunk_size),
+            status=status, content_type=content_type,
+        )
+
+    response['Content-Length'] = str(parts_length(parts))
+    response['Accept-Ranges'] = 'bytes'
+    if ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        response['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+    return response
+
+
+def file_range_response(request, file_path, content_type=None, chunk_size=STREAM_CHUNK_SIZE, handle=None):
+    """
+    构建支持Range请求的文件响应
+
+    - 无Range、Range无效或If-Range不成立：200，整个文件经wsgi.file_wrapper发送
+    - 单区间：206 + Content-Range
+    - 多区间：206 multipart/byteranges
+    - 不可满足：416
+    handle为调用方已从 fd_cache 借出的文件（响应结束时归还），未提供时自动借出。
+    同步版本不进行进程内限速（限速等待会一直占用同步worker），见 serve_file。
+    文件不存在时抛出FileNotFoundError，由调用方决定返回404的方式。
+    """
+    handle = handle or file_handles.checkout(file_path)
+    return _range_response(request, handle, content_type, chunk_size, False)
+
+
+async def async_file_range_response(request, file_path, content_type=None, chunk_size=STREAM_CHUNK_SIZE,
+                                    handle=None, pacer=None):
+    """
+    file_range_response的ASGI版本：响应体为异步迭代器，文件读取不阻塞事件循环；
+    pacer为 pacing.open_stream 创建的受控流，限速等待使用asyncio.sleep，响应结束时关闭
+    """
+    handle = handle or await asyncio.to_thread(file_handles.checkout, file_path)
+    return _range_response(request, handle, content_type, chunk_size, True, pacer)
+
+
+def bytes_range_response(request, data, content_type, stat_result):
+    """内存中文件内容（如片段缓存）的Range响应，行为与file_range_response一致"""
+    file_size = len(data)
+
+    try:
+        ranges = resolve_ranges(request, stat_result)
+    except RangeNotSatisfiable:
+        return range_not_satisfiable_response(file_size)
+
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        parts = multipart_parts(ranges, file_size, content_type, boundary)
+        body = b''.join(part if isinstance(part, bytes) else data[part[0]:part[1] + 1] for part in parts)
+        content_type = f'multipart/byteranges; boundary={boundary}'
+    elif ranges:
+        start, end = ranges[0]
+        body = data[start:end + 1]
+    else:
+        body = data
+
+    response = HttpResponse(body, status=206 if ranges else 200, content_type=content_type)
+    response['Content-Length'] = str(len(body))
+    response['Accept-Ranges'] = 'bytes'
+    if ranges and len(ranges) == 1:
+        response['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+    return response
+
+
+def _offload_target(file_path):
+    """在卸载映射中查找文件所属目录，返回 (目录, 内部location前缀)，找不到返回None"""
+    real_path = os.path.realpath(file_path)
+    for root, location in getattr(settings, 'MEDIA_OFFLOAD_LOCATIONS', {}).items():
+        real_root = os.path.realpath(root)
+        try:
+            if os.path.commonpath([real_path, real_root]) == real_root:
+                return real_root, location
+        except ValueError:
+            # Windows下不同盘符无法比较
+            continue
+    return None
+
+
+def offload_response(file_path, content_type=None, bitrate=None):
+    """
+    构建卸载响应：只返回头部，由前端Web服务器完成字节传输
+
+    未启用卸载或文件不在 MEDIA_OFFLOAD_LOCATIONS 映射的目录内时返回None，
+    调用方应回退到进程内发送。启用限速时nginx模式通过 X-Accel-Limit-Rate 按码率限速。
+    """
+    mode = getattr(settings, 'MEDIA_OFFLOAD_MODE', '')
+    if not mode:
+        return None
+
+    target = _offload_target(file_path)
+    if not target:
+        logger.debug(f"文件不在卸载目录内，回退到进程内发送: {file_path}")
+        return None
+    root, location = target
+
+    response = HttpResponse(content_type=content_type or guess_content_type(file_path))
+    if mode == 'nginx':
+        relative = os.path.relpath(os.path.realpath(file_path), root).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = location.rstrip('/') + '/' + quote(relative)
+        if bitrate and pacing_enabled():
+            response['X-Accel-Limit-Rate'] = str(stream_rate(bitrate))
+    elif mode in ('apache', 'lighttpd'):
+        # mod_xsendfile默认会对头部值做URL解码（XSendFileUnescape），非ASCII路径需先编码
+        response['X-Sendfile'] = quote(os.path.realpath(file_path), safe='/:\\')
+    else:
+        logger.warning(f"未知的MEDIA_OFFLOAD_MODE: {mode}")
+        return None
+    return response
+
+
+def serve_file(request, file_path, content_type=None, cache_control=None, cacheable=False, bitrate=None):
+    """
+    媒体视图统一入口
+
+    先评估条件请求（命中时直接返回304/412，不打开文件），
+    再优先卸载给前端Web服务器；cacheable为True时（内容不会再变化的片段）从进程内缓存发送，
+    否则由Range引擎发送。bitrate为视频码率（bit/s），启用限速（STREAM_PACING）时据此限制发送速率：
+    同步worker不在进程内限速（等待期间会一直占用worker），只设置 X-Accel-Limit-Rate 由nginx限速，
+    进程内的令牌桶限速和出口带宽上限只在 async_serve_file 中生效。
+    文件句柄和stat结果来自 fd_cache，文件不存在时抛出FileNotFoundError。
+    """
+    handle = file_handles.checkout(file_path)
+    stat_result = handle.stat
+    etag, last_modified = file_validators(stat_result)
+
+    response = conditional_response(request, etag, last_modified, cache_control)
+    if response is not None:
+        handle.close()
+        return response
+
+    content_type = content_type or guess_content_type(file_path)
+    response = offload_response(file_path, content_type, bitrate)
+    if response is None and cacheable and segment_cache.enabled:
+        data = segment_cache.load(file_path, stat_result)
+        if data is not None:
+            response = bytes_range_response(request, data, content_type, stat_result)
+    if response is None:
+        response = file_range_response(request, file_path, content_type, handle=handle)
+        limit_rate = stream_rate(bitrate) if bitrate and pacing_enabled() else None
+        if limit_rate:
+            # nginx反向代理时按该速率向客户端发送，worker把响应写入nginx缓冲后即可释放
+            response['X-Accel-Limit-Rate'] = str(limit_rate)
+    else:
+        handle.close()
+    if response.status_code != 416:
+        set_validators(response, etag, last_modified, cache_control)
+    return response
+
+
+async def async_serve_file(request, file_path, content_type=None, cache_control=None, cacheable=False,
+                           bitrate=None):
+    """serve_file的ASGI版本"""
+    handle = await asyncio.to_thread(file_handles.checkout, file_path)
+    stat_result = handle.stat
+    etag, last_modified = file_validators(stat_result)
+
+    response = conditional_response(request, etag, last_modified, cache_control)
+    if response is not None:
+        handle.close()
+        return response
+
+    content_type = content_type or guess_content_type(file_path)
+    response = offload_response(file_path, content_type, bitrate)
+    if response is None and cacheable and segment_cache.enabled:
+        data = await asyncio.to_thread(segment_cache.load, file_path, stat_result)
+        if data is not None:
+            response = bytes_range_response(request, data, content_type, stat_result)
+    if response is None:
+        response = await async_file_range_response(
+            request, file_path, content_type, handle=handle,
+            pacer=open_stream(request, file_path, bitrate),
+        )
+    else:
+        handle.close()
+    if response.status_code != 416:
+        set_validators(response, etag, last_modified, cache_control)
+    return response
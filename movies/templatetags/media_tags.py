@@ -0,0 +1,11 @@
+from django import template
+
+from movies.hashed_media import hashed_media_url
+
+register = template.Library()
+
+
+@register.filter
+def hashed_url(field_file):
+    """海报/缩略图的内容哈希URL，用法：{{ movie.poster_image|hashed_url }}"""
+    return hashed_media_url(field_file)
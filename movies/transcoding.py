@@ -8,18 +8,32 @@ import threading
 import time
 import hashlib
 import json
+import re
+import signal
 import logging
 import shutil
 import uuid
+from collections import deque
 from pathlib import Path
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
+from django.core.cache import cache
+from .hls import (
+    forget_output, hls_segment_args, playlist_segments, count_segments, byterange_index, range_start,
+)
+from .progress import ProgressTracker, PROGRESS_ARGS, PROGRESS_FILE, read_progress
+from .capabilities import capability_registry
+from .scheduler import TranscodeScheduler, SlotRegistry, TicketCancelled, INTERACTIVE, PREFETCH
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('transcoding')
 
+# ffprobe结果缓存时间（秒），文件变化后缓存键随之变化
+VIDEO_INFO_CACHE_TIMEOUT = 7 * 24 * 3600
+
 # 转码配置
 TRANSCODING_CONFIG = {
     # 输出分辨率和码率
@@ -39,22 +53,26 @@ TRANSCODING_CONFIG = {
         'nvidia': {
             'h264': 'h264_nvenc',
             'hevc': 'hevc_nvenc',
-            'options': '-preset p4 -tune ll -rc cbr -profile:v high'
+            'options': '-preset p4 -tune ll -rc cbr -profile:v high',
+            'slots': 3,  # 同时运行的转码进程数（消费级显卡有NVENC会话数限制）
         },
         'intel': {
             'h264': 'h264_qsv',
             'hevc': 'hevc_qsv',
-            'options': '-preset faster -global_quality 23'
+            'options': '-preset faster -global_quality 23',
+            'slots': 4,
         },
         'amd': {
             'h264': 'h264_amf',
             'hevc': 'hevc_amf',
-            'options': '-quality balanced -rc cbr'
+            'options': '-quality balanced -rc cbr',
+            'slots': 4,
         },
         'software': {
             'h264': 'libx264',
             'hevc': 'libx265',
-            'options': '-preset faster -crf 23'
+            'options': '-preset faster -crf 23',
+            'slots': 2,
         }
     },
     
@@ -64,8 +82,9 @@ TRANSCODING_CONFIG = {
         'playlist_type': 'event',
         'hls_time': 6,
         'hls_list_size': 0,
-        'hls_segment_type': 'mpegts',
-        'hls_flags': 'independent_segments'
+        'hls_segment_type': 'mpegts',  # mpegts / fmp4（fMP4/CMAF片段）
+        'hls_flags': 'independent_segments',
+        'single_file': False,  # 每个档位的片段写入同一个文件，用EXT-X-BYTERANGE寻址
     },
     
     # 实时转码参数
@@ -73,7 +92,7 @@ TRANSCODING_CONFIG = {
         'enabled': True,
         'buffer_size': '2M',        # 减小缓冲区提高响应速度
         'max_delay': '200000',      # 200ms最大延迟，更低的延迟
-        'segment_time': 1,          # 1秒片段，更快的响应时间
+        'segment_time': 2,          # 2秒片段，首片段快速生成
         'zerolatency': True,        # 零延迟模式
         'tune': 'zerolatency',      # 低延迟调优
         'nvidia_options': '-preset fast -rc vbr -cq 23', # RTX 3070兼容性优化
@@ -81,7 +100,60 @@ TRANSCODING_CONFIG = {
         'gpu_index': '0',           # 使用RTX 3070 (GPU 0)
         'gpu_thread_count': 2,      # 最佳GPU线程数
         'preferred_encoder': 'nvidia', # 优先使用NVIDIA
-    }
+        'max_ahead_segments': 15,   # 转码领先播放器已请求片段超过该数量时暂停FFmpeg
+        'resume_ahead_segments': 5, # 领先数量回落到该值以下时恢复
+        'idle_timeout': 120,        # 超过该时间(秒)没有播放列表或片段请求的会话被停止并删除输出目录
+        'paused_timeout': 600,      # 节流暂停超过该时间(秒)的会话被停止并释放执行槽位
+        'hls_segment_type': 'mpegts',  # 片段格式，含义同 hls 中的同名参数
+        'hls_flags': 'independent_segments',
+        'single_file': False,
+    },
+    
+    # 转码任务调度（movies.scheduler）：每种编码器的槽位见 encoders[...]['slots']
+    'scheduler': {
+        'copy_slots': 8,            # 直接复制视频的任务不占用编码器，单独计算槽位
+    },
+    
+    # 实时转码准入控制（movies.admission），负载以720p实时转码为1个单位
+    'admission': {
+        'enabled': True,
+        'headroom': 0.9,            # 只使用估计容量的这一比例，保证每个会话不低于1.0x
+        'capacity_window': 600,     # 按最近多少秒内观测到的最大吞吐估计容量
+        'min_height': 360,          # 降档的最低档位
+        # 容量基线（同时转码的720p实时单位），观测到更高的吞吐量时使用观测值
+        'default_capacity': {'nvidia': 8.0, 'intel': 4.0, 'amd': 4.0, 'software': 1.5},
+    },
+
+    # 实时转码配额：用户和用户组可以在后台单独配置（TranscodeQuota），未配置时使用这里的默认值
+    'quotas': {
+        'enabled': True,
+        'max_sessions': 2,          # 同时运行的实时转码会话数
+        'encoder_seconds': 4 * 3600,  # 时间窗口内可以消耗的编码器时间（秒），0为不限制
+        'window': 24 * 3600,        # 编码器时间的统计窗口（秒）
+        'idle_seconds': 30,         # 超过该时间没有被访问的会话可以被同一用户的新会话淘汰
+        'sync_interval': 10,        # 运行中的会话写回用量的间隔（秒）
+    },
+    
+    # 直接复制（remux）：源编码可以直接播放时把轨道原样复制到HLS片段，只转码不兼容的轨道
+    'remux': {
+        'enabled': True,
+        'allow_hevc': False,        # 是否复制HEVC视频（需要客户端支持HEVC解码）
+    },
+    
+    # 自适应码率（ABR）：一次解码，同时输出分辨率阶梯中不超过源分辨率的所有档位
+    'abr': {
+        'min_height': 360,          # 阶梯中最低档位的高度
+    },
+    
+    # 即时分段转码参数（movies.ondemand）
+    'ondemand': {
+        'segment_time': 4,          # 片段时长(秒)，也是拖动后重新开始转码的粒度
+        'lookahead_segments': 3,    # 请求的片段在运行中的进程前方不超过该数量时等待，而不是重新定位
+        'max_ahead_segments': 30,   # 进程领先最后一次请求超过该数量时停止
+        'max_workers': 2,           # 同一输出同时运行的转码进程数
+        'segment_timeout': 30,      # 等待单个片段的最长时间(秒)
+        'request_timeout': 5,       # 同步视图中等待片段的最长时间(秒)，远小于worker超时，超时返回503让播放器重试
+    },
 }
 
 # 转码缓存目录
@@ -90,6 +162,103 @@ os.makedirs(TRANSCODED_DIR, exist_ok=True)
 
 # 实时转码会话存储
 REALTIME_SESSIONS = {}
+# 排队等待转码容量或执行槽位的实时转码会话：会话ID -> 开始排队的时间
+REALTIME_PENDING = {}
+
+# 实时转码：FFmpeg启动后等待第一个片段的最长时间（秒），保留的FFmpeg输出行数
+REALTIME_FIRST_SEGMENT_TIMEOUT = 30
+REALTIME_STDERR_LINES = 50
+# 实时转码的排队/启动状态保存在缓存中，任意进程都可以查询；状态的保留时间（秒）
+REALTIME_STATUS_TTL = 3600
+
+# 实时转码节流：检查间隔（秒）；其他worker进程记录播放位置的文件
+REALTIME_THROTTLE_INTERVAL = 1.0
+REALTIME_PLAYHEAD_FILE = 'playhead'
+# 其他worker进程要求停止会话（配额淘汰）时写入输出目录的标记文件
+REALTIME_STOP_FILE = 'stop'
+# 访问标记文件：任意进程提供播放列表或片段时更新修改时间，用于判断会话是否空闲
+REALTIME_ACCESS_FILE = 'access'
+# 空闲会话清理线程的检查间隔（秒），每个进程在第一个实时转码会话启动时启动
+REALTIME_REAPER_INTERVAL = 30
+_realtime_reaper_lock = threading.Lock()
+_realtime_reaper_started = False
+
+# 暂停/恢复进程依赖SIGSTOP/SIGCONT，Windows下不节流
+THROTTLE_SUPPORTED = hasattr(signal, 'SIGSTOP')
+
+_SEGMENT_INDEX_RE = re.compile(r'(\d+)\.(?:ts|m4s)$')
+
+# 自适应码率输出：转码ID使用的伪分辨率、主播放列表文件名、每个档位的音频码率（bit/s）
+ABR_RESOLUTION = 'abr'
+ABR_MASTER_PLAYLIST = 'master.m3u8'
+ABR_RENDITION_PLAYLIST = 'index.m3u8'
+ABR_AUDIO_BITRATE = 128000
+# 自适应码率单文件输出时每个档位的媒体文件名（不含扩展名）
+ABR_SINGLE_FILE = 'media'
+
+# 直接复制：保持源分辨率的伪分辨率；可以不经转码写入MPEG-TS片段的编码
+REMUX_RESOLUTION = 'remux'
+REMUX_VIDEO_CODECS = ('h264',)
+REMUX_HEVC_CODECS = ('hevc',)
+REMUX_AUDIO_CODECS = ('aac', 'mp3')
+
+# 直接复制视频的任务所在的调度资源池
+COPY_POOL = 'copy'
+
+
+def scheduler_slots(pool):
+    """调度资源池的槽位数：编码器类型或直接复制"""
+    if pool == COPY_POOL:
+        return TRANSCODING_CONFIG['scheduler']['copy_slots']
+    return TRANSCODING_CONFIG['encoders'][pool]['slots']
+
+
+def scheduler_pool(encoder, plan=None):
+    """任务所在的资源池：视频直接复制时不占用编码器"""
+    if plan and plan['video'] == 'copy':
+        return COPY_POOL
+    return encoder['type']
+
+
+# 所有FFmpeg进程共用的调度器：槽位文件放在转码缓存目录下，整台主机的所有worker进程共享槽位数
+SLOT_DIR = os.path.join(TRANSCODED_DIR, '.slots')
+transcode_scheduler = TranscodeScheduler(scheduler_slots, SlotRegistry(SLOT_DIR))
+
+# 点播转码缓存：源文件指纹为完整内容的SHA-1，按块读取
+FINGERPRINT_CHUNK_SIZE = 4 * 1024 * 1024
+# 同时在后台计算指纹的文件数（每个进程），以及其他进程声明正在计算后的有效期（秒）
+FINGERPRINT_WORKERS = 1
+FINGERPRINT_CLAIM_SECONDS = 1800
+# 转码锁文件，持有者每隔 TRANSCODE_LOCK_HEARTBEAT 秒刷新一次
+TRANSCODE_LOCK_FILE = 'transcoding.lock'
+TRANSCODE_LOCK_HEARTBEAT = 30
+# 锁文件和播放列表都超过该时间未更新时，视为持有锁的进程已退出
+TRANSCODE_LOCK_STALE_SECONDS = 120
+
+
+def is_transcode_locked(output_dir):
+    """输出目录中有仍在刷新的转码锁（可能属于其他worker进程）"""
+    newest = 0
+    for name in os.listdir(output_dir) if os.path.isdir(output_dir) else []:
+        if name == TRANSCODE_LOCK_FILE or name.endswith('.m3u8'):
+            try:
+                newest = max(newest, os.path.getmtime(os.path.join(output_dir, name)))
+            except OSError:
+                continue
+    has_lock = os.path.exists(os.path.join(output_dir, TRANSCODE_LOCK_FILE))
+    return has_lock and time.time() - newest < TRANSCODE_LOCK_STALE_SECONDS
+
+class FingerprintPending(Exception):
+    """源文件的内容指纹尚未计算完成（已在后台计算），稍后重试"""
+
+
+def parse_bitrate(value):
+    """'1.5M' / '800k' -> bit/s"""
+    units = {'k': 1000, 'K': 1000, 'm': 1000 ** 2, 'M': 1000 ** 2}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
 
 class TranscodingService:
     """
@@ -103,52 +272,37 @@ class TranscodingService:
     
     @staticmethod
     def detect_gpu_encoders():
-        """检测系统支持的GPU硬件编码器"""
+        """
+        系统中可用的硬件编码器（FFmpeg列出且测试编码成功），软件编码器始终作为备选
+        
+        结果来自主机的FFmpeg能力注册表，不会启动FFmpeg。
+        """
         encoders = []
         
         try:
-            # 检查FFmpeg版本和可用编码器
-            ffmpeg_cmd = ['ffmpeg', '-encoders']
-            result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            output = result.stdout
-            
-            # 检测NVIDIA
-            if 'h264_nvenc' in output:
-                encoders.append('nvidia')
-                logger.info("检测到NVIDIA硬件编码器")
-            
-            # 检测Intel QSV
-            if 'h264_qsv' in output:
-                encoders.append('intel')
-                logger.info("检测到Intel Quick Sync硬件编码器")
-            
-            # 检测AMD
-            if 'h264_amf' in output:
-                encoders.append('amd')
-                logger.info("检测到AMD硬件编码器")
-                
-            # 始终添加软件编码器作为备选
-            encoders.append('software')
-            logger.info("添加软件编码器作为备选")
-            
+            for encoder_type in ('nvidia', 'intel', 'amd'):
+                if capability_registry.encoder_works(TRANSCODING_CONFIG['encoders'][encoder_type]['h264']):
+                    encoders.append(encoder_type)
         except Exception as e:
             logger.error(f"检测GPU编码器时出错: {str(e)}")
-            encoders.append('software')  # 出错时默认使用软件编码
         
+        # 始终添加软件编码器作为备选
+        encoders.append('software')
         return encoders
     
     @staticmethod
     def get_best_encoder(codec='h264'):
-        """获取最佳的可用编码器"""
+        """获取最佳的可用编码器（该编码格式测试编码成功的第一个硬件编码器，否则为软件编码器）"""
         available_encoders = TranscodingService.detect_gpu_encoders()
         encoders_config = TRANSCODING_CONFIG['encoders']
         
         for encoder_type in available_encoders:
-            if encoder_type in encoders_config and codec in encoders_config[encoder_type]:
+            config = encoders_config.get(encoder_type, {})
+            if codec in config and (encoder_type == 'software' or capability_registry.encoder_works(config[codec])):
                 return {
                     'type': encoder_type,
-                    'name': encoders_config[encoder_type][codec],
-                    'options': encoders_config[encoder_type]['options']
+                    'name': config[codec],
+                    'options': config['options']
                 }
         
         # 默认返回软件编码器
@@ -160,14 +314,26 @@ class TranscodingService:
     
     @staticmethod
     def get_video_info(video_path):
-        """获取视频文件信息"""
+        """
+        获取视频文件信息
+
+        结果按 (路径, 大小, mtime) 缓存，文件未变化时不再重复调用ffprobe；
+        bitrate为整体码率（bit/s），未知时为0；audio_codec为第一条音轨的编码，没有音轨时为None。
+        """
         try:
+            stat_result = os.stat(video_path)
+            cache_key = 'video_info:v2:' + hashlib.md5(
+                f"{video_path}:{stat_result.st_size}:{stat_result.st_mtime_ns}".encode('utf-8')
+            ).hexdigest()
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+
             cmd = [
                 'ffprobe', 
                 '-v', 'error', 
-                '-select_streams', 'v:0', 
-                '-show_entries', 'stream=width,height,codec_name,duration', 
-                '-show_entries', 'format=duration', 
+                '-show_entries', 'stream=codec_type,width,height,codec_name,duration,bit_rate', 
+                '-show_entries', 'format=duration,bit_rate', 
                 '-of', 'json', 
                 video_path
             ]
@@ -175,15 +341,22 @@ class TranscodingService:
             result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
             info = json.loads(result.stdout)
             
-            stream_info = info.get('streams', [{}])[0]
+            streams = info.get('streams', [])
+            stream_info = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+            audio_info = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
             format_info = info.get('format', {})
             
-            return {
+            video_info = {
                 'width': int(stream_info.get('width', 0)),
                 'height': int(stream_info.get('height', 0)),
                 'codec': stream_info.get('codec_name', 'unknown'),
                 'duration': float(stream_info.get('duration') or format_info.get('duration', 0)),
+                # 整体码率包含音轨，更接近实际传输速率；容器未记录时退回视频流码率
+                'bitrate': int(format_info.get('bit_rate') or stream_info.get('bit_rate') or 0),
+                'audio_codec': audio_info.get('codec_name'),
             }
+            cache.set(cache_key, video_info, VIDEO_INFO_CACHE_TIMEOUT)
+            return video_info
         except Exception as e:
             logger.error(f"获取视频信息失败: {str(e)}")
             return None
@@ -207,98 +380,257 @@ class TranscodingService:
         return available_resolutions
     
     @staticmethod
-    def start_cached_transcoding(video_path, resolution):
-        """开始转码任务，转码完成后保存到缓存目录"""
-        try:
-            # 检查分辨率是否有效
-            if resolution not in TRANSCODING_CONFIG['resolutions']:
-                return {'success': False, 'error': f"不支持的分辨率: {resolution}"}
-            
-            # 创建唯一的转码ID和输出目录
-            transcode_id = str(uuid.uuid4())
-            output_dir = os.path.join(TRANSCODED_DIR, transcode_id)
-            os.makedirs(output_dir, exist_ok=True)
-            
+    def stream_plan(video_info, resolution, allow_hevc=None):
+        """
+        决定每条轨道直接复制还是转码：{'video': 'copy'/'encode', 'audio': 'copy'/'encode'/None}
+        
+        视频编码可以直接播放、且源分辨率和码率都不超过目标档位时复制视频（REMUX_RESOLUTION不限制）；
+        音频编码可以直接播放时复制音频，没有音轨时audio为None。
+        """
+        remux_config = TRANSCODING_CONFIG['remux']
+        plan = {'video': 'encode', 'audio': 'encode' if video_info and video_info['audio_codec'] else None}
+        if not video_info or not remux_config['enabled']:
+            return plan
+        
+        if allow_hevc is None:
+            allow_hevc = remux_config['allow_hevc']
+        video_codecs = REMUX_VIDEO_CODECS + (REMUX_HEVC_CODECS if allow_hevc else ())
+        if video_info['codec'] in video_codecs:
+            if resolution == REMUX_RESOLUTION:
+                plan['video'] = 'copy'
+            else:
+                res_config = TRANSCODING_CONFIG['resolutions'][resolution]
+                # 码率未知时按分辨率判断
+                if video_info['height'] <= res_config['height'] and video_info['bitrate'] <= parse_bitrate(res_config['maxrate']):
+                    plan['video'] = 'copy'
+        if plan['audio'] and video_info['audio_codec'] in REMUX_AUDIO_CODECS:
+            plan['audio'] = 'copy'
+        return plan
+    
+    @staticmethod
+    def audio_codec_args(plan):
+        """音频轨道的编码参数"""
+        if plan['audio'] == 'copy':
+            return ['-c:a', 'copy']
+        return [
+            '-c:a', 'aac',  # 音频编码器
+            '-b:a', '128k',  # 音频码率
+            '-ac', '2',  # 双声道
+            '-ar', '44100',  # 采样率
+        ]
+    
+    @staticmethod
+    def build_hls_command(video_path, resolution, output_dir, encoder, plan=None):
+        """构建点播HLS转码的FFmpeg命令，plan为stream_plan的结果（默认全部转码）"""
+        plan = plan or {'video': 'encode', 'audio': 'encode'}
+        
+        # HLS参数
+        hls_config = TRANSCODING_CONFIG['hls']
+        segment_time = hls_config['segment_time']
+        
+        # 输出文件路径
+        output_path = os.path.join(output_dir, f"{resolution}.m3u8")
+        
+        if plan['video'] == 'copy':
+            # 直接复制视频流，片段在源关键帧处切分
+            video_args = ['-c:v', 'copy']
+        else:
             # 获取分辨率配置
             res_config = TRANSCODING_CONFIG['resolutions'][resolution]
             width, height = res_config['width'], res_config['height']
             bitrate = res_config['bitrate']
             maxrate = res_config['maxrate']
-            
-            # 获取最佳编码器
-            encoder = TranscodingService.get_best_encoder()
-            encoder_name = encoder['name']
-            encoder_options = encoder['options']
-            
-            # HLS参数
-            hls_config = TRANSCODING_CONFIG['hls']
-            segment_time = hls_config['segment_time']
-            
-            # 输出文件路径
-            output_path = os.path.join(output_dir, f"{resolution}.m3u8")
-            
-            # 构建FFmpeg命令
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-y',  # 覆盖输出文件
-                '-i', video_path,  # 输入文件
-                '-c:v', encoder_name,  # 视频编码器
-                *encoder_options.split(),  # 编码器选项
+            video_args = [
+                '-c:v', encoder['name'],  # 视频编码器
+                *encoder['options'].split(),  # 编码器选项
                 '-b:v', bitrate,  # 视频码率
                 '-maxrate', maxrate,  # 最大码率
-                '-bufsize', f"{int(bitrate[:-1]) * 2}M",  # 缓冲区大小
+                '-bufsize', f"{float(bitrate[:-1]) * 2:g}{bitrate[-1]}",  # 缓冲区大小（码率的2倍，保留单位）
                 '-vf', f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",  # 缩放并保持宽高比
-                '-c:a', 'aac',  # 音频编码器
-                '-b:a', '128k',  # 音频码率
-                '-ac', '2',  # 双声道
-                '-ar', '44100',  # 采样率
-                '-f', 'hls',  # 输出格式
-                '-hls_time', str(segment_time),  # 片段时长
-                '-hls_playlist_type', hls_config['playlist_type'],  # 播放列表类型
-                '-hls_list_size', str(hls_config['hls_list_size']),  # 列表大小(0表示全部保留)
-                '-hls_segment_type', hls_config['hls_segment_type'],  # 片段类型
-                '-hls_flags', hls_config['hls_flags'],  # HLS标志
-                output_path  # 输出文件
             ]
-            
-            # 启动转码进程
-            process = subprocess.Popen(
-                ffmpeg_cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE, 
-                text=True
+        
+        return [
+            'ffmpeg',
+            '-y',  # 覆盖输出文件
+            *PROGRESS_ARGS,  # 机器可读的进度输出到stdout
+            '-i', video_path,  # 输入文件
+            *video_args,
+            *TranscodingService.audio_codec_args(plan),
+            '-f', 'hls',  # 输出格式
+            '-hls_time', str(segment_time),  # 片段时长
+            '-hls_playlist_type', hls_config['playlist_type'],  # 播放列表类型
+            '-hls_list_size', str(hls_config['hls_list_size']),  # 列表大小(0表示全部保留)
+            # 片段格式和HLS标志；单文件输出时媒体文件为 <分辨率>.m4s / .ts
+            *hls_segment_args(hls_config, os.path.join(output_dir, resolution) if hls_config['single_file'] else None),
+            output_path  # 输出文件
+        ]
+    
+    @staticmethod
+    def abr_ladder(video_path):
+        """自适应码率的档位（从高到低），不超过源视频高度，也不低于 min_height"""
+        video_info = TranscodingService.get_video_info(video_path)
+        if not video_info:
+            return []
+        min_height = TRANSCODING_CONFIG['abr']['min_height']
+        return [
+            name for name, res_config in TRANSCODING_CONFIG['resolutions'].items()
+            if min_height <= res_config['height'] <= video_info['height']
+        ]
+    
+    @staticmethod
+    def scaled_size(video_info, res_config):
+        """按源宽高比缩放到档位高度后的实际尺寸（与 scale=-2:height 一致，宽度取偶数）"""
+        height = res_config['height']
+        if not video_info['width'] or not video_info['height']:
+            return res_config['width'], height
+        return round(height * video_info['width'] / video_info['height'] / 2) * 2, height
+    
+    @staticmethod
+    def build_abr_command(video_path, ladder, output_dir, encoder, has_audio=True):
+        """
+        构建自适应码率转码的FFmpeg命令
+        
+        源视频只解码一次，split后分别缩放和编码；所有档位按相同的时间点强制关键帧，
+        片段边界对齐，播放器可以在片段之间无缝切换档位。每个档位写入 <档位>/index.m3u8。
+        """
+        hls_config = TRANSCODING_CONFIG['hls']
+        segment_time = hls_config['segment_time']
+        
+        # [0:v]split=N[s0][s1]...;[s0]scale=-2:1080[v0];...
+        splits = ''.join(f'[s{i}]' for i in range(len(ladder)))
+        filters = [f"[0:v]split={len(ladder)}{splits}"]
+        for i, name in enumerate(ladder):
+            filters.append(f"[s{i}]scale=-2:{TRANSCODING_CONFIG['resolutions'][name]['height']}[v{i}]")
+        
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-y',  # 覆盖输出文件
+            *PROGRESS_ARGS,  # 机器可读的进度输出到stdout
+            '-i', video_path,  # 输入文件
+            '-filter_complex', ';'.join(filters),
+        ]
+        for i in range(len(ladder)):
+            ffmpeg_cmd.extend(['-map', f'[v{i}]'])
+            if has_audio:
+                ffmpeg_cmd.extend(['-map', '0:a:0'])
+        
+        ffmpeg_cmd.extend([
+            '-c:v', encoder['name'],  # 视频编码器
+            *encoder['options'].split(),  # 编码器选项
+        ])
+        for i, name in enumerate(ladder):
+            res_config = TRANSCODING_CONFIG['resolutions'][name]
+            bitrate = res_config['bitrate']
+            ffmpeg_cmd.extend([
+                f'-b:v:{i}', bitrate,  # 视频码率
+                f'-maxrate:v:{i}', res_config['maxrate'],  # 最大码率
+                f'-bufsize:v:{i}', f"{float(bitrate[:-1]) * 2:g}{bitrate[-1]}",  # 缓冲区大小
+            ])
+        
+        var_stream_map = ' '.join(
+            f"v:{i},a:{i},name:{name}" if has_audio else f"v:{i},name:{name}"
+            for i, name in enumerate(ladder)
+        )
+        ffmpeg_cmd.extend([
+            # 所有档位的关键帧对齐到片段边界
+            '-force_key_frames', f"expr:gte(t,n_forced*{segment_time})",
+            '-c:a', 'aac',  # 音频编码器
+            '-b:a', f"{ABR_AUDIO_BITRATE // 1000}k",  # 音频码率
+            '-ac', '2',  # 双声道
+            '-ar', '44100',  # 采样率
+            '-f', 'hls',  # 输出格式
+            '-hls_time', str(segment_time),  # 片段时长
+            '-hls_playlist_type', hls_config['playlist_type'],  # 播放列表类型
+            '-hls_list_size', str(hls_config['hls_list_size']),  # 列表大小(0表示全部保留)
+            # 片段格式和HLS标志；每个档位的片段为 <档位>/seg_00000.ts，单文件输出时为 <档位>/media.ts
+            *hls_segment_args(
+                hls_config, os.path.join(output_dir, '%v', ABR_SINGLE_FILE if hls_config['single_file'] else 'seg_%05d')
+            ),
+            '-var_stream_map', var_stream_map,
+            os.path.join(output_dir, '%v', ABR_RENDITION_PLAYLIST),
+        ])
+        return ffmpeg_cmd
+    
+    @staticmethod
+    def measure_rendition(playlist_path):
+        """
+        根据实际片段大小计算档位码率
+        
+        返回 (峰值, 平均值)，单位bit/s；峰值为单个片段的最大码率，即HLS规范中BANDWIDTH的定义。
+        单文件输出时片段大小取自EXT-X-BYTERANGE。
+        """
+        playlist_path = Path(playlist_path)
+        peak = total_bits = total_duration = 0.0
+        for duration, uri, byterange in playlist_segments(playlist_path):
+            if not duration:
+                continue
+            size = byterange[1] if byterange else (playlist_path.parent / uri).stat().st_size
+            bits = size * 8
+            peak = max(peak, bits / duration)
+            total_bits += bits
+            total_duration += duration
+        if not total_duration:
+            return None
+        return int(peak), int(total_bits / total_duration)
+    
+    @staticmethod
+    def write_master_playlist(output_dir, ladder, video_info, measured=False):
+        """
+        写入主播放列表
+        
+        转码过程中BANDWIDTH按配置的最大码率估算；measured为True时（转码完成后）按实际片段大小计算。
+        """
+        has_audio = bool(video_info.get('audio_codec'))
+        audio_bitrate = ABR_AUDIO_BITRATE if has_audio else 0
+        # fMP4片段（EXT-X-MAP）需要版本7，EXT-X-BYTERANGE需要版本4
+        hls_config = TRANSCODING_CONFIG['hls']
+        version = 7 if hls_config['hls_segment_type'] == 'fmp4' else 4 if hls_config['single_file'] else 3
+        lines = ['#EXTM3U', f'#EXT-X-VERSION:{version}', '#EXT-X-INDEPENDENT-SEGMENTS']
+        for name in ladder:
+            res_config = TRANSCODING_CONFIG['resolutions'][name]
+            playlist = f"{name}/{ABR_RENDITION_PLAYLIST}"
+            rates = None
+            if measured:
+                try:
+                    rates = TranscodingService.measure_rendition(os.path.join(output_dir, playlist))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"无法统计档位码率: {playlist} - {e}")
+            if rates is None:
+                rates = (
+                    parse_bitrate(res_config['maxrate']) + audio_bitrate,
+                    parse_bitrate(res_config['bitrate']) + audio_bitrate,
+                )
+            width, height = TranscodingService.scaled_size(video_info, res_config)
+            lines.append(
+                f"#EXT-X-STREAM-INF:BANDWIDTH={rates[0]},AVERAGE-BANDWIDTH={rates[1]},"
+                f"RESOLUTION={width}x{height},NAME=\"{name}\""
             )
-            
-            # 在后台线程中监控进程
-            def monitor_process():
-                process.wait()
-                return_code = process.poll()
-                
-                if return_code == 0:
-                    logger.info(f"转码成功完成: {resolution}, ID: {transcode_id}")
-                    # 添加完成标记文件
-                    with open(os.path.join(output_dir, 'completed'), 'w') as f:
-                        f.write(str(int(time.time())))
-                else:
-                    error_output = process.stderr.read()
-                    logger.error(f"转码失败: {resolution}, ID: {transcode_id}, 错误: {error_output}")
-                    # 添加失败标记文件
-                    with open(os.path.join(output_dir, 'failed'), 'w') as f:
-                        f.write(error_output)
-            
-            threading.Thread(target=monitor_process, daemon=True).start()
-            
-            return {
-                'success': True, 
-                'transcode_id': transcode_id,
-                'status': 'started',
-                'resolution': resolution,
-                'encoder': encoder['type']
-            }
+            lines.append(playlist)
         
-        except Exception as e:
-            logger.error(f"启动转码任务失败: {str(e)}")
-            return {'success': False, 'error': str(e)}
+        # 先写临时文件再替换，播放器不会读到写了一半的主播放列表
+        master_path = os.path.join(output_dir, ABR_MASTER_PLAYLIST)
+        with open(master_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(master_path + '.tmp', master_path)
+    
+    @staticmethod
+    def start_cached_transcoding(video_path, resolution):
+        """
+        开始转码任务，转码完成后保存到缓存目录
+        
+        输出目录由内容寻址的 transcoding_service 决定，同一内容同一分辨率只会转码一次。
+        """
+        transcode_id, status = transcoding_service.start_transcoding_file(video_path, resolution)
+        if not transcode_id:
+            return {'success': False, 'error': status}
+        
+        return {
+            'success': True, 
+            'transcode_id': transcode_id,
+            'status': status,
+            'resolution': resolution,
+            'encoder': transcoding_service.get_best_encoder()['type']
+        }
     
     @staticmethod
     def get_transcoding_status(transcode_id):
@@ -320,7 +652,10 @@ class TranscodingService:
         # 检查m3u8文件和分片情况
         m3u8_files = [f for f in os.listdir(output_dir) if f.endswith('.m3u8')]
         if m3u8_files:
-            return {'success': True, 'status': 'transcoding', 'progress': 'unknown'}
+            progress = read_progress(output_dir)
+            if progress:
+                progress.pop('samples', None)
+            return {'success': True, 'status': 'transcoding', 'progress': progress or 'unknown'}
         
         return {'success': True, 'status': 'pending'}
     
@@ -352,8 +687,12 @@ class TranscodingService:
             for item in os.listdir(TRANSCODED_DIR):
                 item_path = os.path.join(TRANSCODED_DIR, item)
                 
-                # 跳过文件和实时转码会话
-                if not os.path.isdir(item_path) or item in REALTIME_SESSIONS:
+                # 跳过文件、调度槽位目录和实时转码会话
+                if not os.path.isdir(item_path) or item.startswith('.') or item in REALTIME_SESSIONS:
+                    continue
+                
+                # 跳过仍在转码中的点播缓存（锁文件由转码进程定期刷新）
+                if is_transcode_locked(item_path):
                     continue
                 
                 # 检查目录修改时间
@@ -365,7 +704,8 @@ class TranscodingService:
                                   for root, _, files in os.walk(item_path) 
                                   for file in files)
                     
-                    # 删除目录
+                    # 删除目录（先释放缓存的文件句柄）
+                    forget_output(item_path)
                     shutil.rmtree(item_path)
                     
                     count += 1
@@ -384,223 +724,536 @@ class TranscodingService:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def start_realtime_transcoding(video_path, resolution, session_id=None):
-        """开始实时转码流会话 - 针对RTX 3070优化"""
+    def build_realtime_command(video_path, resolution, output_dir, encoder, plan=None):
+        """
+        构建实时转码的FFmpeg命令：转码完整视频，EVENT播放列表随片段生成不断增长
+        
+        plan为stream_plan的结果（默认全部转码），复制的轨道不经过解码和编码。
+        """
+        plan = plan or {'video': 'encode', 'audio': 'encode'}
+        realtime_config = TRANSCODING_CONFIG['realtime']
+        segment_time = realtime_config['segment_time']
+        
+        # 使用完整路径避免Python库冲突
+        ffmpeg_path = shutil.which('ffmpeg') or 'ffmpeg'
+        
+        ffmpeg_cmd = [
+            ffmpeg_path,
+            '-y',  # 覆盖输出文件
+            *PROGRESS_ARGS,  # 机器可读的进度输出到stdout
+            '-i', video_path,  # 输入文件
+        ]
+        
+        if plan['video'] == 'copy':
+            # 直接复制视频流：不缩放、不强制关键帧，片段在源关键帧处切分
+            ffmpeg_cmd.extend(['-c:v', 'copy'])
+        else:
+            res_config = TRANSCODING_CONFIG['resolutions'][resolution]
+            width, height = res_config['width'], res_config['height']
+            ffmpeg_cmd.extend(['-c:v', encoder['name']])  # 视频编码器
+            
+            if encoder['type'] == 'nvidia':
+                ffmpeg_cmd.extend([
+                    '-preset', 'fast',  # 使用fast预设
+                    '-gpu', realtime_config['gpu_index'],  # 指定GPU
+                ])
+            elif encoder['type'] == 'software':
+                ffmpeg_cmd.extend(['-preset', 'veryfast', '-tune', realtime_config['tune']])
+            
+            ffmpeg_cmd.extend([
+                '-vf', f"scale={width}:{height}",  # 简化缩放
+                # 按片段时长强制关键帧，第一个片段在segment_time秒后即可写出
+                '-force_key_frames', f"expr:gte(t,n_forced*{segment_time})",
+            ])
+        
+        ffmpeg_cmd.extend([
+            '-c:a', 'copy' if plan['audio'] == 'copy' else 'aac',  # 音频编码器
+            '-f', 'hls',  # 输出格式
+            '-hls_time', str(segment_time),  # 片段时长
+            '-hls_playlist_type', 'event',  # EVENT播放列表：只追加，转码结束时写入ENDLIST
+            '-hls_list_size', '0',  # 保留所有片段，可以从头播放到结尾
+            *hls_segment_args(
+                realtime_config,
+                os.path.abspath(os.path.join(output_dir, resolution)) if realtime_config['single_file'] else None,
+            ),
+            os.path.abspath(os.path.join(output_dir, f"{resolution}.m3u8")),
+        ])
+        return ffmpeg_cmd
+    
+    @staticmethod
+    def start_realtime_transcoding(video_path, resolution, session_id=None, allow_hevc=None, plan=None,
+                                   owner=None, priority=INTERACTIVE, wait_for_capacity=False):
+        """
+        开始实时转码流会话
+        
+        在调度器中提交槽位申请后立即返回，不等待槽位和第一个片段：有空闲槽位时status为starting，
+        否则为queued（带排队位置）。取得槽位后由后台线程启动FFmpeg，监控线程负责收集输出和记录结束状态，
+        播放列表随片段生成不断增长；播放器轮询 realtime_status（realtime_hls_stream）直到播放列表出现。
+        源编码可以直接播放的轨道原样复制（见stream_plan，也可以由plan指定），
+        resolution为 REMUX_RESOLUTION 时要求视频可以复制。owner为用户，用于公平排队。
+        wait_for_capacity为True时（准入控制判断转码负载已满）先等待整台主机有足够的转码容量再申请槽位，
+        状态为queued并带预计等待时间eta。
+        """
         try:
             # 如果未提供会话ID，创建新的唯一ID
             if not session_id:
                 session_id = str(uuid.uuid4())
             
             # 检查分辨率是否有效
-            if resolution not in TRANSCODING_CONFIG['resolutions']:
+            if resolution not in TRANSCODING_CONFIG['resolutions'] and resolution != REMUX_RESOLUTION:
                 return {'success': False, 'error': f"不支持的分辨率: {resolution}"}
             
-            # 创建输出目录
-            output_dir = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}")
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # 获取分辨率配置
-            res_config = TRANSCODING_CONFIG['resolutions'][resolution]
-            width, height = res_config['width'], res_config['height']
-            bitrate = res_config['bitrate']
-            maxrate = res_config['maxrate']
+            video_info = TranscodingService.get_video_info(video_path)
+            plan = plan or TranscodingService.stream_plan(video_info, resolution, allow_hevc=allow_hevc)
+            if resolution == REMUX_RESOLUTION and plan['video'] != 'copy':
+                return {'success': False, 'error': '视频编码不能直接复制，需要转码'}
             
             # 获取最佳编码器 - 优先尝试使用NVIDIA
             realtime_config = TRANSCODING_CONFIG['realtime']
-            preferred_encoder = realtime_config.get('preferred_encoder', None)
-            
-            if preferred_encoder == 'nvidia':
-                # 直接尝试使用NVIDIA编码器
-                encoder_config = TRANSCODING_CONFIG['encoders'].get('nvidia', None)
-                if encoder_config and 'h264_nvenc' in subprocess.run(['ffmpeg', '-encoders'], 
-                                            stdout=subprocess.PIPE, text=True).stdout:
-                    encoder = {
-                        'type': 'nvidia',
-                        'name': encoder_config['h264'],
-                        'options': realtime_config.get('nvidia_options', encoder_config['options'])
-                    }
-                    logger.info("使用NVIDIA RTX编码器进行实时转码")
-                else:
-                    # 如果无法使用NVIDIA，回退到常规选择
-                    encoder = TranscodingService.get_best_encoder()
-            else:
-                encoder = TranscodingService.get_best_encoder()
+            encoder = transcoding_service.get_best_encoder('h264')
+            if realtime_config.get('preferred_encoder') == 'nvidia' and encoder['type'] == 'nvidia':
+                encoder = dict(encoder, options=realtime_config.get('nvidia_options', encoder['options']))
+                logger.info("使用NVIDIA RTX编码器进行实时转码")
             
-            encoder_name = encoder['name']
+            # 创建输出目录（排队期间播放器的轮询也会更新其中的访问标记）
+            output_dir = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}")
+            os.makedirs(output_dir, exist_ok=True)
             
-            # 实时转码参数
-            segment_time = realtime_config['segment_time']
-            keyint_min = realtime_config.get('keyint_min', 15)
+            # 提交槽位申请，不等待；转码负载已满时由启动线程在容量足够后再提交
+            pool = scheduler_pool(encoder, plan)
             
-            # 输出HLS文件路径 - 使用绝对路径
-            output_path = os.path.abspath(os.path.join(output_dir, f"{resolution}.m3u8"))
+            def submit():
+                return transcode_scheduler.submit(
+                    pool, priority, owner, label=f"realtime:{os.path.basename(video_path)}:{resolution}",
+                    info={'session_id': session_id, 'resolution': resolution, 'video': plan['video']},
+                )
             
-            # 极简FFmpeg命令 - 使用完整路径避免Python库冲突
-            import shutil
-            ffmpeg_path = shutil.which('ffmpeg') or 'ffmpeg'
-            logger.info(f"🔍 使用FFmpeg路径: {ffmpeg_path}")
+            REALTIME_PENDING[session_id] = time.time()
+            ticket = None
+            position = 0
+            eta = None
+            if wait_for_capacity:
+                from .admission import check_capacity
+                eta = check_capacity(resolution, plan, pool)['eta']
+                status = 'queued'
+                logger.info(f"⏳ 转码负载已满，实时转码排队等待容量: {session_id}, 预计等待: {eta}")
+            else:
+                ticket = submit()
+                position = transcode_scheduler.position(ticket)
+                status = 'queued' if position else 'starting'
+                if position:
+                    logger.info(f"⏳ 实时转码排队中: {session_id}, 位置: {position}")
+            TranscodingService.set_realtime_status(session_id, status, queue_position=position, eta=eta)
             
-            ffmpeg_cmd = [
-                ffmpeg_path,  # 使用完整路径
-                '-y',  # 覆盖输出文件
-                '-i', video_path,  # 输入文件
-                '-c:v', encoder_name,  # 视频编码器
-            ]
+            TranscodingService._start_realtime_reaper()
+            threading.Thread(
+                target=TranscodingService._launch_realtime,
+                args=(session_id, ticket, submit, video_path, resolution, output_dir, encoder, plan, video_info),
+                daemon=True,
+            ).start()
             
-            # 为NVIDIA编码器添加最基础参数
-            if encoder['type'] == 'nvidia':
-                ffmpeg_cmd.extend([
-                    '-preset', 'fast',   # 使用fast预设
-                    '-gpu', '0',         # 指定GPU 0 (RTX 3070)
-                ])
-            
-            # 极简实时转码参数 - 立即生效
-            ffmpeg_cmd.extend([
-                '-vf', f"scale={width}:{height}",  # 简化缩放
-                '-c:a', 'aac',  # 音频编码器
-                '-f', 'hls',  # 输出格式
-                '-hls_time', '2',  # 2秒片段，极快生成
-                '-hls_list_size', '3',  # 只保留3个片段（6秒内容）
-                '-hls_flags', 'append_list',  # 简化标志
-                '-t', '30',  # 🔥 极短时间：只转码前10秒，立即生效
-            ])
+            return {
+                'success': True,
+                'session_id': session_id,
+                'status': status,
+                'queue_position': position,
+                'eta': eta,
+                'resolution': resolution,
+                'encoder': encoder['type'],
+                'plan': plan,
+                'realtime': True,
+                'streaming': True,
+                'rtx_optimized': encoder['type'] == 'nvidia'
+            }
             
-            # 删除不兼容的GPU线程配置参数
+        except Exception as e:
+            logger.error(f"启动实时转码失败: {str(e)}")
+            return {'success': False, 'error': str(e)}
+    
+    @staticmethod
+    def set_realtime_status(session_id, status, **extra):
+        """记录会话的排队/启动状态（queued、starting、active、failed、stopped），任意进程都可以查询"""
+        cache.set(f"realtime_status:{session_id}", {'status': status, **extra}, REALTIME_STATUS_TTL)
+    
+    @staticmethod
+    def realtime_status(session_id):
+        """会话的排队/启动状态，没有记录时返回None"""
+        return cache.get(f"realtime_status:{session_id}")
+    
+    @staticmethod
+    def _launch_realtime(session_id, ticket, submit, video_path, resolution, output_dir, encoder, plan, video_info):
+        """
+        等待转码容量（ticket为None时，容量足够后调用submit提交槽位申请）和执行槽位后启动FFmpeg；
+        排队期间会话被停止（停止请求或标记）或者播放器不再轮询（空闲）时取消排队
+        """
+        from .quotas import release
+        stop_path = os.path.join(output_dir, REALTIME_STOP_FILE)
+        idle_timeout = TRANSCODING_CONFIG['realtime']['idle_timeout']
+        queued_at = time.time()
+        
+        def abandoned():
+            last_access = max(queued_at, TranscodingService.realtime_last_access(output_dir))
+            return session_id not in REALTIME_PENDING or os.path.exists(stop_path) or time.time() - last_access > idle_timeout
+        
+        try:
+            if ticket is None:
+                from .admission import check_capacity
+                eta = None
+                while not abandoned():
+                    check = check_capacity(resolution, plan, scheduler_pool(encoder, plan))
+                    if check['fits']:
+                        ticket = submit()
+                        break
+                    if check['eta'] != eta:
+                        eta = check['eta']
+                        TranscodingService.set_realtime_status(session_id, 'queued', queue_position=0, eta=eta)
+                    time.sleep(REALTIME_THROTTLE_INTERVAL)
             
-            # 输出文件路径
-            ffmpeg_cmd.append(output_path)
+            position = None
+            try:
+                while ticket is not None and not ticket.wait(REALTIME_THROTTLE_INTERVAL):
+                    if abandoned():
+                        ticket.cancel()
+                        break
+                    current = transcode_scheduler.position(ticket)
+                    if current != position:
+                        position = current
+                        TranscodingService.set_realtime_status(session_id, 'queued', queue_position=position)
+            except TicketCancelled:
+                pass
+            if ticket is None or ticket.state != 'running':
+                logger.info(f"🚫 实时转码排队已取消: {session_id}")
+                REALTIME_PENDING.pop(session_id, None)
+                TranscodingService.set_realtime_status(session_id, 'stopped')
+                forget_output(output_dir)
+                shutil.rmtree(output_dir, ignore_errors=True)
+                release(session_id, 'stopped')
+                return
             
+            TranscodingService.set_realtime_status(session_id, 'starting', queue_position=0)
+            ffmpeg_cmd = TranscodingService.build_realtime_command(video_path, resolution, output_dir, encoder, plan)
             logger.info(f"实时转码命令: {' '.join(ffmpeg_cmd)}")
             
-            # 确保输出目录存在
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir, exist_ok=True)
-                logger.info(f"📁 创建输出目录: {output_dir}")
-            
-            # 使用同步方式启动转码进程 - 修复异步问题
-            logger.info("🚀 启动FFmpeg快速转码（前10秒）...")
+            start_time = time.time()
             try:
-                # 🔥 回到同步方式，确保能工作
-                start_time = time.time()
-                
-                # 确保输出目录存在
-                os.makedirs(output_dir, exist_ok=True)
-                
-                logger.info(f"🔍 执行转码命令...")
-                logger.info(f"🔍 输出目录: {output_dir}")
-                
-                # 使用同步方式，但时间很短（10秒）
-                result = subprocess.run(
-                    ffmpeg_cmd, 
+                process = subprocess.Popen(
+                    ffmpeg_cmd,
                     stdin=subprocess.DEVNULL,  # 防止等待输入
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.PIPE, 
+                    stdout=subprocess.PIPE,  # 进度输出
+                    stderr=subprocess.PIPE,
                     text=True,
                     encoding='utf-8',
                     errors='replace',  # 替换无法解码的字符
-                    timeout=60,  # 30秒超时，足够转码10秒内容
                 )
-                
-                duration = time.time() - start_time
-                logger.info(f"✅ FFmpeg转码完成，返回码: {result.returncode}, 耗时: {duration:.1f}秒")
-                
-                if result.stderr:
-                    logger.info(f"📄 FFmpeg输出: {result.stderr[:300]}")
-                
-                if result.returncode != 0:
-                    logger.error(f"❌ FFmpeg转码失败，返回码: {result.returncode}")
-                    return {'success': False, 'error': f'FFmpeg转码失败，返回码: {result.returncode}'}
-                
-                # 检查输出文件
-                if not os.path.exists(output_path):
-                    logger.error(f"❌ HLS文件未生成: {output_path}")
-                    return {'success': False, 'error': 'HLS文件未生成'}
-                
-                # 检查片段文件
-                files_in_dir = os.listdir(output_dir) if os.path.exists(output_dir) else []
-                segment_files = [f for f in files_in_dir if f.endswith('.ts')]
-                
-                if not segment_files:
-                    logger.error(f"❌ 没有生成HLS片段文件")
-                    return {'success': False, 'error': '没有生成HLS片段文件'}
-                
-                logger.info(f"✅ HLS转码成功，生成片段: {segment_files}")
-                
-                # 创建假进程对象用于会话管理（因为真实进程已经结束）
-                class FakeProcess:
-                    def __init__(self):
-                        self.pid = None
-                        self.returncode = 0
-                    
-                    def poll(self):
-                        return 0  # 总是返回已完成
-                    
-                    def terminate(self):
-                        pass
-                    
-                    def wait(self, timeout=None):
-                        pass
-                
-                # 存储会话信息
-                REALTIME_SESSIONS[session_id] = {
-                    'process': FakeProcess(),  # 假进程对象，因为转码已完成
-                    'video_path': video_path,
-                    'resolution': resolution,
-                    'output_dir': output_dir,
-                    'start_time': start_time,
-                    'encoder': encoder['type'],
-                    'last_access': time.time(),
-                    'command': ' '.join(ffmpeg_cmd),
-                    'completed': True,  # 标记为已完成
-                    'streaming': False,   # 不是流式模式，是快速完整转码
-                }
-                
-                logger.info(f"✅ 快速转码会话完成: {session_id}, 分辨率: {resolution}, 编码器: {encoder['type']}")
-                
-            except subprocess.TimeoutExpired:
-                logger.error(f"❌ FFmpeg转码超时")
-                return {'success': False, 'error': 'FFmpeg转码超时'}
-            except Exception as e:
-                logger.error(f"❌ 启动FFmpeg转码失败: {str(e)}")
-                return {'success': False, 'error': f'启动FFmpeg转码失败: {str(e)}'}
+            except OSError as e:
+                ticket.release()
+                REALTIME_PENDING.pop(session_id, None)
+                logger.error(f"❌ 启动FFmpeg失败: {session_id} - {e}")
+                TranscodingService.set_realtime_status(session_id, 'failed', error=f'启动FFmpeg失败: {e}')
+                shutil.rmtree(output_dir, ignore_errors=True)
+                release(session_id, 'failed')
+                return
             
-            logger.info(f"🎉 快速转码成功: {session_id}, 分辨率: {resolution}")
-            return {
-                'success': True,
-                'session_id': session_id,
-                'status': 'completed',  # 已完成状态
+            session = {
+                'process': process,
+                'video_path': video_path,
                 'resolution': resolution,
+                'output_dir': output_dir,
+                'start_time': start_time,
                 'encoder': encoder['type'],
-                'realtime': True,
-                'streaming': False,  # 非流式模式，已完成
-                'rtx_optimized': encoder['type'] == 'nvidia'
+                'plan': plan,
+                'ticket': ticket,
+                'pool': ticket.pool,
+                'last_access': time.time(),
+                'command': ' '.join(ffmpeg_cmd),
+                'completed': False,
+                'streaming': True,
+                'stderr_tail': deque(maxlen=REALTIME_STDERR_LINES),
+                'playhead': -1,  # 播放器请求过的最大片段序号
+                'segments_ready': 0,
+                'paused_at': None,
+                'paused_seconds': 0.0,
+                'pause_count': 0,
+                # FFmpeg报告的转码速度、已输出时间等，写入输出目录供其他进程的准入控制读取
+                'progress': ProgressTracker(
+                    video_info['duration'] if video_info else None, path=os.path.join(output_dir, PROGRESS_FILE)
+                ).start(process.stdout),
             }
-            
-        except Exception as e:
-            logger.error(f"启动实时转码失败: {str(e)}")
-            return {'success': False, 'error': str(e)}
+            REALTIME_SESSIONS[session_id] = session
+            REALTIME_PENDING.pop(session_id, None)
+            threading.Thread(
+                target=TranscodingService._supervise_realtime, args=(session_id, session), daemon=True
+            ).start()
+            threading.Thread(
+                target=TranscodingService._watch_realtime, args=(session_id, session), daemon=True
+            ).start()
+            logger.info(f"🎬 实时转码已启动: {session_id}, 分辨率: {resolution}, 编码器: {encoder['type']}, 视频: {plan['video']}, 音频: {plan['audio']}, 排队: {start_time - queued_at:.1f}秒")
+        finally:
+            connection.close()
+    
+    @staticmethod
+    def _supervise_realtime(session_id, session):
+        """监控实时转码进程：持续读取stderr（避免管道写满阻塞FFmpeg），结束后记录状态"""
+        process = session['process']
+        try:
+            for line in process.stderr:
+                line = line.rstrip()
+                if line:
+                    session['stderr_tail'].append(line)
+        except (OSError, ValueError):
+            pass
+        process.wait()
+        session['ticket'].release()
+        
+        TranscodingService._mark_resumed(session)
+        session['completed'] = process.returncode == 0
+        session['streaming'] = False
+        duration = time.time() - session['start_time']
+        if process.returncode == 0:
+            reason = 'completed'
+            logger.info(f"✅ 实时转码完成: {session_id}, 耗时: {duration:.1f}秒")
+        elif session_id in REALTIME_SESSIONS:
+            reason = 'failed'
+            error = '\n'.join(list(session['stderr_tail'])[-5:])
+            logger.error(f"❌ 实时转码异常退出: {session_id}, 返回码: {process.returncode}, 输出: {error}")
+            TranscodingService.set_realtime_status(
+                session_id, 'failed', error=f'FFmpeg转码失败，返回码: {process.returncode}'
+            )
+        else:
+            # 会话被停止时进程会被终止，不视为失败
+            reason = 'stopped'
+        
+        from .quotas import finish_session
+        finish_session(session_id, session, reason)
+    
+    @staticmethod
+    def _watch_realtime(session_id, session):
+        """
+        会话的后台检查：按播放位置节流，响应其他worker进程写入的停止标记，
+        定期把编码器时间和最后访问时间写回数据库（配额统计）
+        """
+        from .quotas import sync_session
+        process = session['process']
+        stop_path = os.path.join(session['output_dir'], REALTIME_STOP_FILE)
+        sync_interval = TRANSCODING_CONFIG['quotas']['sync_interval']
+        paused_timeout = TRANSCODING_CONFIG['realtime']['paused_timeout']
+        last_sync = time.time()
+        
+        playlist_path = os.path.join(session['output_dir'], f"{session['resolution']}.m3u8")
+        first_segment = False
+        
+        try:
+            while process.poll() is None:
+                time.sleep(REALTIME_THROTTLE_INTERVAL)
+                # FFmpeg在第一个片段写完后才生成播放列表
+                if not first_segment:
+                    if os.path.exists(playlist_path):
+                        first_segment = True
+                        TranscodingService.set_realtime_status(session_id, 'active')
+                        logger.info(f"🎉 实时转码已就绪: {session_id}, 首片段耗时: {time.time() - session['start_time']:.1f}秒")
+                    elif time.time() - session['start_time'] > REALTIME_FIRST_SEGMENT_TIMEOUT:
+                        logger.error(f"❌ 等待第一个片段超时: {session_id}")
+                        TranscodingService.set_realtime_status(session_id, 'failed', error='等待第一个片段超时')
+                        TranscodingService.stop_realtime_session(session_id)
+                        break
+                if os.path.exists(stop_path):
+                    logger.info(f"🛑 收到停止标记，停止实时转码会话: {session_id}")
+                    TranscodingService.stop_realtime_session(session_id)
+                    break
+                if THROTTLE_SUPPORTED:
+                    TranscodingService._throttle_realtime(session_id, session)
+                    # 暂停的进程仍然占用执行槽位，播放器长时间不继续时结束会话
+                    paused_at = session['paused_at']
+                    if paused_at is not None and time.time() - paused_at > paused_timeout:
+                        logger.info(f"⏹️ 实时转码暂停超过 {paused_timeout} 秒，停止会话并释放槽位: {session_id}")
+                        TranscodingService.stop_realtime_session(session_id)
+                        break
+                if time.time() - last_sync >= sync_interval:
+                    last_sync = time.time()
+                    sync_session(session_id, session)
+        finally:
+            connection.close()
+    
+    @staticmethod
+    def _throttle_realtime(session_id, session):
+        """
+        按播放位置节流：转码领先播放器已请求的片段过多时暂停FFmpeg（SIGSTOP），
+        播放器追上后恢复（SIGCONT）；观众中途离开时不会继续转码没人看的内容
+        """
+        realtime_config = TRANSCODING_CONFIG['realtime']
+        playhead_path = os.path.join(session['output_dir'], REALTIME_PLAYHEAD_FILE)
+        # 按播放列表计数，不列出输出目录（单文件输出时只有一个媒体文件）
+        session['segments_ready'] = count_segments(
+            os.path.join(session['output_dir'], f"{session['resolution']}.m3u8")
+        )
+        try:
+            with open(playhead_path) as f:
+                session['playhead'] = max(session['playhead'], int(f.read() or -1))
+        except (OSError, ValueError):
+            pass
+        
+        ahead = session['segments_ready'] - 1 - session['playhead']
+        try:
+            if session['paused_at'] is None and ahead > realtime_config['max_ahead_segments']:
+                session['process'].send_signal(signal.SIGSTOP)
+                session['paused_at'] = time.time()
+                session['pause_count'] += 1
+                logger.info(f"⏸️ 实时转码领先播放位置 {ahead} 个片段，暂停: {session_id}")
+            elif session['paused_at'] is not None and ahead <= realtime_config['resume_ahead_segments']:
+                TranscodingService._resume_realtime(session)
+                logger.info(f"▶️ 播放器追上转码位置，恢复: {session_id}")
+        except ProcessLookupError:
+            pass
+    
+    @staticmethod
+    def _mark_resumed(session):
+        """结束暂停计时"""
+        paused_at = session['paused_at']
+        if paused_at is not None:
+            session['paused_seconds'] += time.time() - paused_at
+            session['paused_at'] = None
+    
+    @staticmethod
+    def _resume_realtime(session):
+        """恢复被暂停的FFmpeg进程"""
+        if session['paused_at'] is None:
+            return
+        try:
+            session['process'].send_signal(signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+        TranscodingService._mark_resumed(session)
+    
+    @staticmethod
+    def note_realtime_access(session_id):
+        """
+        记录会话被访问（播放列表或片段请求）：更新输出目录中访问标记文件的修改时间，
+        会话由其他worker或ASGI进程提供时，所在进程也能据此判断会话是否空闲
+        """
+        session = REALTIME_SESSIONS.get(session_id)
+        if session is not None:
+            session['last_access'] = time.time()
+        access_path = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}", REALTIME_ACCESS_FILE)
+        try:
+            os.utime(access_path)
+        except FileNotFoundError:
+            try:
+                open(access_path, 'a').close()
+            except OSError:
+                # 输出目录不存在（会话已结束）
+                pass
+        except OSError:
+            pass
+    
+    @staticmethod
+    def realtime_last_access(output_dir, session=None):
+        """会话最后一次被访问的时间：进程内记录和访问标记文件中较新的一个"""
+        last_access = session['last_access'] if session else 0
+        try:
+            last_access = max(last_access, os.path.getmtime(os.path.join(output_dir, REALTIME_ACCESS_FILE)))
+        except OSError:
+            pass
+        return last_access
+    
+    @staticmethod
+    def note_realtime_playhead(session_id, filename, range_header=None):
+        """
+        记录播放器请求的片段序号，供节流判断播放位置
+        
+        单文件输出（EXT-X-BYTERANGE）时片段序号由Range请求的起始字节在播放列表中查找；
+        会话不在当前进程时（片段由其他worker或ASGI进程提供）写入输出目录中的playhead文件。
+        同时记录会话被访问（见note_realtime_access）。
+        """
+        TranscodingService.note_realtime_access(session_id)
+        output_dir = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}")
+        match = _SEGMENT_INDEX_RE.search(filename)
+        if match:
+            index = int(match.group(1))
+        else:
+            # 单文件输出：媒体文件与播放列表同名（<分辨率>.m4s / .ts），初始化片段的区间不计入
+            stem, extension = os.path.splitext(filename)
+            offset = range_start(range_header)
+            if extension not in ('.ts', '.m4s') or offset is None:
+                return
+            index = byterange_index(os.path.join(output_dir, f"{stem}.m3u8"), offset)
+            if index is None:
+                return
+        
+        session = REALTIME_SESSIONS.get(session_id)
+        if session is not None:
+            session['playhead'] = max(session['playhead'], index)
+            return
+        
+        playhead_path = os.path.join(output_dir, REALTIME_PLAYHEAD_FILE)
+        try:
+            with open(playhead_path) as f:
+                if int(f.read() or -1) >= index:
+                    return
+        except (OSError, ValueError):
+            pass
+        try:
+            tmp_path = f"{playhead_path}.{os.getpid()}"
+            with open(tmp_path, 'w') as f:
+                f.write(str(index))
+            os.replace(tmp_path, playhead_path)
+        except OSError:
+            # 输出目录不存在（会话已结束）
+            pass
+    
+    @staticmethod
+    def realtime_throttle_stats(session):
+        """会话的运行/暂停时间统计和转码进度"""
+        paused_seconds = session['paused_seconds']
+        if session['paused_at'] is not None:
+            paused_seconds += time.time() - session['paused_at']
+        return {
+            'throttled': session['paused_at'] is not None,
+            'playhead': session['playhead'],
+            'segments_ready': session['segments_ready'],
+            'paused_seconds': round(paused_seconds, 1),
+            'running_seconds': round(max(0.0, time.time() - session['start_time'] - paused_seconds), 1),
+            'pause_count': session['pause_count'],
+            'progress': session['progress'].snapshot(),
+        }
     
     @staticmethod
     def stop_realtime_session(session_id):
-        """停止实时转码会话"""
+        """停止实时转码会话；排队中的会话由启动线程取消排队并删除输出目录"""
+        if session_id in REALTIME_PENDING:
+            REALTIME_PENDING.pop(session_id, None)
+            logger.info(f"已停止排队中的实时转码会话: {session_id}")
+            return {'success': True}
         if session_id not in REALTIME_SESSIONS:
             return {'success': False, 'error': f"实时转码会话不存在: {session_id}"}
         
         try:
             session = REALTIME_SESSIONS[session_id]
             
-            # 关闭FFmpeg进程
+            # 先从会话字典中移除，监控线程据此区分主动停止和异常退出
+            del REALTIME_SESSIONS[session_id]
+            
+            # 关闭FFmpeg进程（暂停中的进程要恢复后才能响应SIGTERM，无论节流线程是否已记录暂停都发送SIGCONT）
             if session['process'].poll() is None:  # 如果进程还在运行
                 session['process'].terminate()
-                session['process'].wait(timeout=5)
+                TranscodingService._mark_resumed(session)
+                if THROTTLE_SUPPORTED:
+                    try:
+                        session['process'].send_signal(signal.SIGCONT)
+                    except ProcessLookupError:
+                        pass
+                try:
+                    session['process'].wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    session['process'].kill()
+                    session['process'].wait()
+            # 立即释放执行槽位（监控线程结束时还会释放一次，可以重复调用）
+            session['ticket'].release()
             
-            # 删除输出目录
+            # 删除输出目录（先释放缓存的文件句柄）
+            forget_output(session['output_dir'])
             if os.path.exists(session['output_dir']):
                 shutil.rmtree(session['output_dir'])
             
-            # 从会话字典中移除
-            del REALTIME_SESSIONS[session_id]
-            
             logger.info(f"已停止实时转码会话: {session_id}")
             return {'success': True}
         
@@ -608,6 +1261,25 @@ class TranscodingService:
             logger.error(f"停止实时转码会话失败: {str(e)}")
             return {'success': False, 'error': str(e)}
     
+    @staticmethod
+    def request_stop_realtime(session_id):
+        """
+        停止任意worker进程中的实时转码会话：会话在当前进程时直接停止，
+        否则在输出目录写入停止标记，由会话所在进程的检查线程停止
+        """
+        if session_id in REALTIME_SESSIONS or session_id in REALTIME_PENDING:
+            return TranscodingService.stop_realtime_session(session_id)
+        
+        output_dir = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}")
+        try:
+            with open(os.path.join(output_dir, REALTIME_STOP_FILE), 'w'):
+                pass
+        except OSError:
+            # 输出目录不存在（会话已结束或所在进程已退出）
+            return {'success': False, 'error': f"实时转码会话不存在: {session_id}"}
+        logger.info(f"🛑 已请求停止其他进程中的实时转码会话: {session_id}")
+        return {'success': True}
+    
     @staticmethod
     def get_realtime_session(session_id):
         """获取实时转码会话信息"""
@@ -625,13 +1297,14 @@ class TranscodingService:
         return {
             'success': True,
             'session_id': session_id,
-            'status': 'active' if is_active else 'stopped',
+            'status': 'active' if is_active else ('completed' if session['completed'] else 'stopped'),
             'resolution': session['resolution'],
             'encoder': session['encoder'],
             'start_time': session['start_time'],
             'duration': time.time() - session['start_time'],
             'last_access': session['last_access'],
-            'realtime': True
+            'realtime': True,
+            **TranscodingService.realtime_throttle_stats(session),
         }
     
     @staticmethod
@@ -662,128 +1335,69 @@ class TranscodingService:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def cleanup_inactive_sessions(inactive_minutes=30):
-        """清理不活跃的实时转码会话"""
+    def cleanup_inactive_sessions(inactive_minutes=None):
+        """
+        清理不活跃的实时转码会话
+        
+        当前进程中最后一次被访问（任意进程提供播放列表或片段，见note_realtime_access）
+        超过空闲时间的会话被停止并删除输出目录，包括已经转码完成的会话；
+        不属于任何运行中进程的输出目录（所在worker已退出）超过两倍空闲时间未更新时直接删除。
+        未指定inactive_minutes时使用 TRANSCODING_CONFIG['realtime']['idle_timeout']。
+        """
         try:
+            if inactive_minutes is None:
+                idle_seconds = TRANSCODING_CONFIG['realtime']['idle_timeout']
+            else:
+                idle_seconds = inactive_minutes * 60
             count = 0
+            orphaned = 0
             now = time.time()
-            inactive_cutoff = now - (inactive_minutes * 60)
             
-            sessions_to_stop = []
-            
-            for session_id, session in REALTIME_SESSIONS.items():
-                if session['last_access'] < inactive_cutoff:
-                    sessions_to_stop.append(session_id)
+            for session_id, session in list(REALTIME_SESSIONS.items()):
+                if now - TranscodingService.realtime_last_access(session['output_dir'], session) > idle_seconds:
+                    logger.info(f"💤 实时转码会话空闲超过 {idle_seconds} 秒，停止: {session_id}")
+                    TranscodingService.stop_realtime_session(session_id)
+                    count += 1
             
-            for session_id in sessions_to_stop:
-                TranscodingService.stop_realtime_session(session_id)
-                count += 1
+            # 其他进程中的会话由所在进程在空闲时间后清理，超过两倍空闲时间仍然存在的目录已无人负责
+            for name in os.listdir(TRANSCODED_DIR):
+                session_id = name[len('realtime_'):]
+                if not name.startswith('realtime_') or session_id in REALTIME_SESSIONS or session_id in REALTIME_PENDING:
+                    continue
+                output_dir = os.path.join(TRANSCODED_DIR, name)
+                try:
+                    last_update = max(os.path.getmtime(output_dir), TranscodingService.realtime_last_access(output_dir))
+                except OSError:
+                    continue
+                if now - last_update > idle_seconds * 2:
+                    forget_output(output_dir)
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    orphaned += 1
+            if orphaned:
+                logger.info(f"🧹 已删除 {orphaned} 个无人负责的实时转码目录")
             
-            return {'success': True, 'stopped_count': count}
+            return {'success': True, 'stopped_count': count, 'orphaned_count': orphaned}
         
         except Exception as e:
             logger.error(f"清理不活跃会话失败: {str(e)}")
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def start_background_continuation(session_id, video_path, resolution, output_dir):
-        """在后台继续转码剩余部分"""
-        try:
-            import threading
-            
-            def continue_transcoding():
-                try:
-                    # 等待一段时间，让用户开始播放
-                    time.sleep(20)
-                    
-                    # 检查会话是否还存在
-                    if session_id not in REALTIME_SESSIONS:
-                        logger.info(f"会话{session_id}已结束，取消后台转码")
-                        return
-                    
-                    session = REALTIME_SESSIONS[session_id]
-                    
-                    # 检查用户是否还在观看（最近3分钟内有访问）
-                    if time.time() - session['last_access'] > 180:
-                        logger.info(f"用户长时间未访问会话{session_id}，停止后台转码")
-                        return
-                    
-                    logger.info(f"🔄 开始后台转码剩余内容: {session_id}")
-                    
-                    # 获取编码器信息
-                    encoder = TranscodingService.get_best_encoder('h264')
-                    gpu_index = 0 if encoder['type'] == 'nvidia' else None
-                    
-                    # 获取分辨率配置
-                    resolution_configs = {
-                        '2160p': (3840, 2160), '1440p': (2560, 1440),
-                        '1080p': (1920, 1080), '720p': (1280, 720),
-                        '480p': (854, 480), '360p': (640, 360),
-                        '240p': (426, 240), '144p': (256, 144)
-                    }
-                    
-                    if resolution not in resolution_configs:
-                        logger.error(f"未知分辨率: {resolution}")
-                        return
-                    
-                    width, height = resolution_configs[resolution]
-                    
-                    # 完整转码命令 - 转码整个视频
-                    ffmpeg_path = shutil.which('ffmpeg') or 'C:\\Windows\\system32\\ffmpeg.EXE'
-                    
-                    full_output_path = os.path.join(output_dir, f"{resolution}_full.m3u8")
-                    
-                    ffmpeg_cmd = [ffmpeg_path, '-y', '-i', video_path]
-                    
-                    # 添加编码器参数
-                    if encoder['type'] == 'nvidia':
-                        ffmpeg_cmd.extend(['-c:v', 'h264_nvenc', '-preset', 'fast'])
-                        if gpu_index is not None:
-                            ffmpeg_cmd.extend(['-gpu', str(gpu_index)])
-                    else:
-                        ffmpeg_cmd.extend(['-c:v', 'libx264', '-preset', 'fast'])
-                    
-                    # 完整转码参数
-                    ffmpeg_cmd.extend([
-                        '-vf', f"scale={width}:{height}",
-                        '-c:a', 'aac',
-                        '-f', 'hls',
-                        '-hls_time', '6',  # 标准6秒片段
-                        '-hls_list_size', '0',  # 保留所有片段
-                        '-hls_flags', 'append_list',
-                        '-hls_segment_filename', os.path.join(output_dir, f"{resolution}_full_%03d.ts"),
-                        full_output_path
-                    ])
-                    
-                    logger.info(f"🎬 后台开始完整转码: {resolution}")
-                    
-                    # 执行完整转码
-                    result = subprocess.run(
-                        ffmpeg_cmd,
-                        stdin=subprocess.DEVNULL,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        timeout=3600,  # 1小时超时
-                    )
-                    
-                    if result.returncode == 0:
-                        logger.info(f"✅ 后台完整转码成功: {resolution}")
-                        # 更新会话状态
-                        if session_id in REALTIME_SESSIONS:
-                            REALTIME_SESSIONS[session_id]['completed'] = True
-                            REALTIME_SESSIONS[session_id]['full_file'] = full_output_path
-                    else:
-                        logger.error(f"❌ 后台完整转码失败: {resolution}")
-                        
-                except Exception as e:
-                    logger.error(f"后台转码异常: {str(e)}")
-            
-            # 启动后台线程
-            thread = threading.Thread(target=continue_transcoding, daemon=True)
-            thread.start()
-            
-        except Exception as e:
-            logger.error(f"启动后台转码失败: {str(e)}")
+    def _start_realtime_reaper():
+        """启动当前进程的空闲会话清理线程（只启动一次）"""
+        global _realtime_reaper_started
+        with _realtime_reaper_lock:
+            if _realtime_reaper_started:
+                return
+            _realtime_reaper_started = True
+        
+        def reap():
+            while True:
+                time.sleep(REALTIME_REAPER_INTERVAL)
+                TranscodingService.cleanup_inactive_sessions()
+        
+        threading.Thread(target=reap, daemon=True).start()
+        logger.info("已启动实时转码空闲会话清理线程")
     
     @staticmethod
     def get_active_sessions():
@@ -801,10 +1415,534 @@ class TranscodingService:
                     'start_time': session['start_time'],
                     'duration': time.time() - session['start_time'],
                     'last_access': session['last_access'],
+                    **TranscodingService.realtime_throttle_stats(session),
                 })
         
         return {'success': True, 'sessions': active_sessions}
 
+class CachedTranscodingService:
+    """
+    内容寻址的点播转码缓存
+    - 转码ID由 (源文件指纹, 分辨率, 编码配置) 决定，同一内容的同一分辨率只转码一次，
+      不同路径下内容相同的文件共用同一份输出
+    - 源文件指纹 = 完整内容的SHA-1，内容完全相同才共用输出；按 (真实路径, 大小, mtime) 缓存在进程内和
+      共享缓存中。计算需要读完整个文件，不在请求中进行：未缓存时交给后台线程，请求得到 'preparing' 状态
+    - 同一ID的并发请求附加到正在进行的任务：进程内通过 active_jobs 去重，
+      worker进程之间通过输出目录中的锁文件去重
+    - 输出目录中的 job.json 记录任务信息，completed / failed 标记与 start_cached_transcoding 一致
+    """
+    
+    JOB_FILE = 'job.json'
+    LOG_FILE = 'ffmpeg.log'
+    
+    def __init__(self, transcode_dir):
+        self.transcode_dir = Path(transcode_dir)
+        self.active_jobs = {}  # transcode_id -> 任务信息
+        self._lock = threading.Lock()
+        self._encoders = {}  # codec -> 编码器，检测一次后在进程内复用
+        self._fingerprints = {}  # 真实路径 -> (size, mtime_ns, 指纹)
+        self._hashing = set()  # 正在后台计算指纹的真实路径
+        self._hash_slots = threading.Semaphore(FINGERPRINT_WORKERS)
+    
+    # ---------- 转码ID ----------
+    
+    def get_best_encoder(self, codec='h264'):
+        """获取最佳编码器（每个进程只检测一次）"""
+        codec = 'hevc' if codec in ('h265', 'hevc') else codec
+        encoder = self._encoders.get(codec)
+        if encoder is None:
+            encoder = TranscodingService.get_best_encoder(codec)
+            self._encoders[codec] = encoder
+        return encoder
+    
+    def encoder_profile(self, resolution):
+        """编码配置摘要：编码器、码率或HLS参数变化时生成新的输出；直接复制视频时只取决于HLS参数"""
+        # 未启用单文件输出时不计入，已有的缓存输出保持原来的转码ID
+        profile = {'hls': {
+            key: value for key, value in TRANSCODING_CONFIG['hls'].items() if key != 'single_file' or value
+        }}
+        if resolution != REMUX_RESOLUTION:
+            encoder = self.get_best_encoder()
+            profile.update({
+                'encoder': encoder['name'],
+                'options': encoder['options'],
+                'resolution': TRANSCODING_CONFIG['resolutions'][resolution],
+            })
+        return hashlib.sha1(json.dumps(profile, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    
+    def source_fingerprint(self, video_path, wait=False):
+        """
+        源文件指纹：完整内容的SHA-1，内容相同的文件（不论路径）得到相同的指纹
+        
+        已缓存时直接返回；否则wait为False时在后台线程中计算并抛出FingerprintPending，
+        wait为True时在当前线程计算（管理命令使用）。
+        """
+        real_path = os.path.realpath(video_path)
+        stat_result = os.stat(real_path)
+        cached = self._fingerprints.get(real_path)
+        if cached and cached[:2] == (stat_result.st_size, stat_result.st_mtime_ns):
+            return cached[2]
+        
+        cache_key = self._fingerprint_cache_key(real_path, stat_result)
+        fingerprint = cache.get(cache_key)
+        if fingerprint is None:
+            if not wait:
+                self._hash_in_background(real_path)
+                raise FingerprintPending(video_path)
+            fingerprint = self._compute_fingerprint(real_path, stat_result, cache_key)
+        
+        self._fingerprints[real_path] = (stat_result.st_size, stat_result.st_mtime_ns, fingerprint)
+        return fingerprint
+    
+    def source_identity(self, video_path):
+        """源文件身份：真实路径、大小和mtime的摘要，不读取文件内容（即时分段转码使用）"""
+        real_path = os.path.realpath(video_path)
+        stat_result = os.stat(real_path)
+        return hashlib.sha1(
+            f"{real_path}:{stat_result.st_size}:{stat_result.st_mtime_ns}".encode('utf-8')
+        ).hexdigest()
+    
+    def generate_transcode_id(self, movie, resolution):
+        """转码ID，movie可以是Movie对象或ID"""
+        return self.transcode_id_for_file(self._get_movie(movie).file_path, resolution)
+    
+    def transcode_id_for_file(self, video_path, resolution, source=None):
+        """
+        resolution为 ABR_RESOLUTION 时对应自适应码率输出，ID同时由档位阶梯决定；
+        为 REMUX_RESOLUTION 时对应直接复制视频的输出；直接复制的轨道也计入ID
+        
+        source为源文件的标识，默认为内容指纹（尚未计算完成时抛出FingerprintPending）。
+        """
+        if resolution == ABR_RESOLUTION:
+            ladder = TranscodingService.abr_ladder(video_path)
+            if not ladder:
+                raise ValueError("无法确定自适应码率档位")
+            profile = ':'.join(f"{name}={self.encoder_profile(name)}" for name in ladder)
+        elif resolution in TRANSCODING_CONFIG['resolutions'] or resolution == REMUX_RESOLUTION:
+            plan = TranscodingService.stream_plan(TranscodingService.get_video_info(video_path), resolution)
+            if resolution == REMUX_RESOLUTION:
+                if plan['video'] != 'copy':
+                    raise ValueError("视频编码不能直接复制，需要转码")
+                profile = f"{self.encoder_profile(resolution)}:{plan['audio']}"
+            else:
+                profile = self.encoder_profile(resolution)
+                if 'copy' in plan.values():
+                    # 直接复制轨道的输出与完整转码的输出不同
+                    profile += f":{plan['video']}:{plan['audio']}"
+        else:
+            raise ValueError(f"不支持的分辨率: {resolution}")
+        key = f"{source or self.source_fingerprint(video_path)}:{resolution}:{profile}"
+        return f"{resolution}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]}"
+    
+    def get_hls_path(self, movie, resolution):
+        """转码输出的播放列表路径（不保证已存在），自适应码率输出为主播放列表"""
+        transcode_id = self.generate_transcode_id(movie, resolution)
+        if resolution == ABR_RESOLUTION:
+            return self.transcode_dir / transcode_id / ABR_MASTER_PLAYLIST
+        return self.transcode_dir / transcode_id / f"{resolution}.m3u8"
+    
+    def is_abr_ready(self, transcode_id):
+        """自适应码率输出是否可以开始播放：主播放列表中的每个档位都已生成第一个片段"""
+        output_dir = self.transcode_dir / transcode_id
+        try:
+            master = (output_dir / ABR_MASTER_PLAYLIST).read_text(encoding='utf-8')
+        except OSError:
+            return False
+        playlists = [line for line in master.splitlines() if line and not line.startswith('#')]
+        return bool(playlists) and all((output_dir / playlist).exists() for playlist in playlists)
+    
+    # ---------- 转码任务 ----------
+    
+    def start_transcoding(self, movie, resolution, priority=PREFETCH, owner=None, user=None):
+        """
+        开始（或附加到）转码任务
+        
+        返回 (transcode_id, status)，status为 completed / transcoding / started / queued（排队等待执行槽位）；
+        源文件指纹正在后台计算时返回 (None, 'preparing')，稍后重试；失败时返回 (None, 错误信息)。
+        priority和owner（用户ID）用于调度排队。指定user时新启动的任务占用该用户的转码配额
+        （附加到已有任务或命中缓存时不占用），超出配额时抛出 quotas.QuotaExceeded。
+        """
+        movie = self._get_movie(movie)
+        return self.start_transcoding_file(movie.file_path, resolution, movie, priority, owner, user)
+    
+    def start_transcoding_file(self, video_path, resolution, movie=None, priority=PREFETCH, owner=None, user=None):
+        """start_transcoding的文件路径版本，movie仅用于记录任务信息"""
+        if resolution not in TRANSCODING_CONFIG['resolutions'] and resolution not in (ABR_RESOLUTION, REMUX_RESOLUTION):
+            return None, f"不支持的分辨率: {resolution}"
+        
+        try:
+            transcode_id = self.transcode_id_for_file(video_path, resolution)
+        except FingerprintPending:
+            return None, 'preparing'
+        except OSError as e:
+            logger.error(f"无法读取源文件: {video_path} - {e}")
+            return None, f"无法读取源文件: {e}"
+        except ValueError as e:
+            return None, str(e)
+        
+        output_dir = self.transcode_dir / transcode_id
+        
+        with self._lock:
+            if transcode_id in self.active_jobs:
+                logger.info(f"🔗 附加到进行中的转码任务: {transcode_id}")
+                job = self.active_jobs[transcode_id]
+                return transcode_id, 'queued' if job['ticket'].state == 'waiting' else 'transcoding'
+            
+            if (output_dir / 'completed').exists():
+                logger.info(f"✅ 命中转码缓存: {transcode_id}")
+                return transcode_id, 'completed'
+            
+            output_dir.mkdir(parents=True, exist_ok=True)
+            if not self._acquire_lock(output_dir):
+                logger.info(f"🔗 其他进程正在转码: {transcode_id}")
+                return transcode_id, 'transcoding'
+            
+            # 其他进程可能在上面的检查之后完成转码并释放了锁，此时不能删除已完成的输出重新转码
+            if (output_dir / 'completed').exists():
+                self._release_lock(output_dir)
+                logger.info(f"✅ 命中转码缓存: {transcode_id}")
+                return transcode_id, 'completed'
+        
+        # 锁文件已由本进程持有，占用配额期间同一任务的其他请求返回transcoding
+        quota_session = None
+        if user is not None:
+            from .quotas import reserve, QuotaExceeded
+            reservation = reserve(user, movie, resolution, kind='cached')
+            if not reservation['success']:
+                self._release_lock(output_dir)
+                raise QuotaExceeded(reservation)
+            quota_session = reservation['session_id']
+        
+        with self._lock:
+            pool = scheduler_pool(self.get_best_encoder(), self._stream_plan(video_path, resolution))
+            ticket = transcode_scheduler.submit(pool, priority, owner, label=f"cached:{transcode_id}")
+            job = {
+                'transcode_id': transcode_id, 'output_dir': output_dir, 'ticket': ticket,
+                'started_at': time.time(), 'quota_session': quota_session,
+            }
+            self.active_jobs[transcode_id] = job
+        
+        threading.Thread(target=self._run, args=(job, video_path, resolution, movie), daemon=True).start()
+        if ticket.state == 'waiting':
+            logger.info(f"⏳ 转码任务排队中: {transcode_id}, 位置: {transcode_scheduler.position(ticket)}")
+            return transcode_id, 'queued'
+        return transcode_id, 'started'
+    
+    def cancel_transcoding(self, transcode_id):
+        """
+        取消转码任务：排队中的任务移出队列，运行中的任务终止FFmpeg；
+        取消后不留下完成或失败标记，下次请求会重新转码。任务不存在时返回False
+        
+        已取得槽位但FFmpeg尚未启动时只做标记，由 _run 在启动后终止进程并释放槽位
+        """
+        with self._lock:
+            job = self.active_jobs.get(transcode_id)
+            if job is None:
+                return False
+            job['cancelled'] = True
+            process = job.get('process')
+        if process is None:
+            job['ticket'].withdraw()
+        elif process.poll() is None:
+            process.terminate()
+        logger.info(f"🚫 取消转码任务: {transcode_id}")
+        return True
+    
+    def get_transcode_status(self, transcode_id):
+        """转码任务状态，任务不存在时返回None"""
+        if not re.fullmatch(r'[\w-]+', transcode_id or ''):
+            return None
+        output_dir = self.transcode_dir / transcode_id
+        if not output_dir.is_dir():
+            return None
+        
+        job = self.active_jobs.get(transcode_id) or self._read_job(output_dir)
+        started_at = job.get('started_at', time.time())
+        finished_at = time.time()
+        
+        if transcode_id in self.active_jobs:
+            status = 'queued' if job.get('process') is None else 'transcoding'
+        elif (output_dir / 'completed').exists():
+            status = 'completed'
+            try:
+                finished_at = float((output_dir / 'completed').read_text().strip())
+            except (OSError, ValueError):
+                pass
+        elif (output_dir / 'failed').exists():
+            status = 'failed'
+        elif is_transcode_locked(output_dir):
+            status = 'transcoding'
+        else:
+            # 转码进程已退出但没有留下结果，下次请求会重新转码
+            status = 'interrupted'
+        
+        result = {
+            'transcode_id': transcode_id,
+            'status': status,
+            'elapsed': round(max(0.0, finished_at - started_at), 1),
+            'movie': job.get('movie', ''),
+            'resolution': job.get('resolution', ''),
+        }
+        if status == 'queued':
+            result['queue_position'] = transcode_scheduler.position(job['ticket'])
+        
+        # 转码进度：本进程的任务直接读取，其他进程的任务和已结束的任务读取进度文件（不含采样）
+        progress = job['progress'].snapshot() if job.get('progress') else read_progress(output_dir)
+        if progress:
+            progress.pop('samples', None)
+            result['progress'] = progress
+        return result
+    
+    def get_video_info(self, video_path):
+        return TranscodingService.get_video_info(video_path)
+    
+    def get_available_resolutions(self, movie):
+        return TranscodingService.get_available_resolutions(self._get_movie(movie).file_path)
+    
+    def cleanup_old_transcodes(self, max_age_hours=24):
+        return TranscodingService.cleanup_old_transcodes(max_age_hours)
+    
+    # ---------- 内部实现 ----------
+    
+    def _get_movie(self, movie):
+        if hasattr(movie, 'file_path'):
+            return movie
+        from .models import Movie
+        return Movie.objects.get(pk=movie)
+    
+    def _fingerprint_cache_key(self, real_path, stat_result):
+        return 'source_fingerprint:' + hashlib.md5(
+            f"{real_path}:{stat_result.st_size}:{stat_result.st_mtime_ns}".encode('utf-8')
+        ).hexdigest()
+    
+    def _compute_fingerprint(self, real_path, stat_result, cache_key):
+        """读取完整文件计算SHA-1；读取过程中文件发生变化时不缓存"""
+        started = time.time()
+        sha1 = hashlib.sha1()
+        with open(real_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK_SIZE), b''):
+                sha1.update(chunk)
+            current = os.fstat(f.fileno())
+        fingerprint = sha1.hexdigest()
+        if (current.st_size, current.st_mtime_ns) == (stat_result.st_size, stat_result.st_mtime_ns):
+            cache.set(cache_key, fingerprint, None)
+            logger.info(f"🔑 源文件指纹计算完成，耗时 {time.time() - started:.1f}秒: {real_path}")
+        else:
+            logger.warning(f"⚠️ 计算指纹过程中源文件发生变化: {real_path}")
+        return fingerprint
+    
+    def _hash_in_background(self, real_path):
+        """在后台线程中计算指纹；同一文件在进程内只计算一次，其他进程已在计算时不重复计算"""
+        with self._lock:
+            if real_path in self._hashing:
+                return
+            self._hashing.add(real_path)
+        
+        def run():
+            try:
+                with self._hash_slots:
+                    stat_result = os.stat(real_path)
+                    cache_key = self._fingerprint_cache_key(real_path, stat_result)
+                    if cache.get(cache_key) is not None:
+                        return
+                    if not cache.add(f"{cache_key}:hashing", os.getpid(), FINGERPRINT_CLAIM_SECONDS):
+                        return
+                    try:
+                        self._compute_fingerprint(real_path, stat_result, cache_key)
+                    finally:
+                        cache.delete(f"{cache_key}:hashing")
+            except OSError as e:
+                logger.error(f"计算源文件指纹失败: {real_path} - {e}")
+            finally:
+                with self._lock:
+                    self._hashing.discard(real_path)
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def _acquire_lock(self, output_dir):
+        """创建锁文件；已被其他进程持有时返回False，持有者已退出时接管"""
+        lock_path = output_dir / TRANSCODE_LOCK_FILE
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if is_transcode_locked(output_dir):
+                    return False
+                logger.warning(f"⚠️ 转码锁已过期，接管任务: {output_dir.name}")
+                try:
+                    os.unlink(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps({'pid': os.getpid(), 'created_at': time.time()}))
+            return True
+        return False
+    
+    def _release_lock(self, output_dir):
+        try:
+            os.unlink(output_dir / TRANSCODE_LOCK_FILE)
+        except FileNotFoundError:
+            pass
+    
+    def _read_job(self, output_dir):
+        try:
+            return json.loads((output_dir / self.JOB_FILE).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+    
+    def _stream_plan(self, video_path, resolution):
+        """非自适应码率输出的轨道处理方式"""
+        if resolution == ABR_RESOLUTION:
+            return None
+        return TranscodingService.stream_plan(TranscodingService.get_video_info(video_path), resolution)
+    
+    def _run(self, job, video_path, resolution, movie):
+        """排队等待执行槽位（期间刷新锁文件，其他worker进程不会接管），取得后启动FFmpeg并监控到结束"""
+        ticket = job['ticket']
+        output_dir = job['output_dir']
+        try:
+            while not ticket.wait(TRANSCODE_LOCK_HEARTBEAT):
+                try:
+                    os.utime(output_dir / TRANSCODE_LOCK_FILE)
+                except OSError:
+                    pass
+            if job.get('cancelled'):
+                raise TicketCancelled(job['transcode_id'])
+            launched = self._launch(video_path, resolution, job['transcode_id'], output_dir, movie)
+            with self._lock:
+                job.update(launched)
+                cancelled = job.get('cancelled')
+            if cancelled:
+                # 启动期间收到取消：立即终止，由 _monitor 释放槽位且不写完成标记
+                launched['process'].terminate()
+        except TicketCancelled:
+            ticket.release()
+            self._finish(job)
+            return
+        except Exception as e:
+            logger.error(f"启动转码任务失败: {str(e)}")
+            ticket.release()
+            try:
+                (output_dir / 'failed').write_text(str(e), encoding='utf-8')
+            except OSError:
+                pass
+            self._finish(job)
+            return
+        self._monitor(job)
+    
+    def _finish(self, job):
+        """释放锁文件并移出进行中的任务，结束任务占用的用户配额"""
+        self._release_lock(job['output_dir'])
+        with self._lock:
+            self.active_jobs.pop(job['transcode_id'], None)
+        if job.get('quota_session'):
+            from .quotas import finish_job
+            if job.get('cancelled'):
+                reason = 'stopped'
+            elif (job['output_dir'] / 'completed').exists():
+                reason = 'completed'
+            else:
+                reason = 'failed'
+            # FFmpeg启动后 started_at 为启动时间，没有启动时不消耗编码器时间
+            encoder_seconds = time.time() - job['started_at'] if job.get('process') else 0.0
+            finish_job(job['quota_session'], reason, round(encoder_seconds, 1))
+    
+    def _launch(self, video_path, resolution, transcode_id, output_dir, movie):
+        """清理上次失败或中断留下的输出，启动FFmpeg，返回任务信息"""
+        forget_output(output_dir)
+        for item in output_dir.iterdir():
+            if item.is_dir():
+                # 自适应码率的档位目录
+                forget_output(item)
+                shutil.rmtree(item)
+            elif item.name != TRANSCODE_LOCK_FILE:
+                item.unlink()
+        
+        encoder = self.get_best_encoder()
+        job = {
+            'transcode_id': transcode_id,
+            'movie_id': getattr(movie, 'pk', None),
+            'movie': getattr(movie, 'title', os.path.basename(video_path)),
+            'resolution': resolution,
+            'encoder': encoder['type'],
+            'source': video_path,
+            'started_at': time.time(),
+        }
+        
+        if resolution == ABR_RESOLUTION:
+            # 主播放列表先按配置码率写好，档位播放列表随转码生成
+            video_info = TranscodingService.get_video_info(video_path)
+            job['renditions'] = TranscodingService.abr_ladder(video_path)
+            for name in job['renditions']:
+                (output_dir / name).mkdir(exist_ok=True)
+            TranscodingService.write_master_playlist(output_dir, job['renditions'], video_info)
+            ffmpeg_cmd = TranscodingService.build_abr_command(
+                video_path, job['renditions'], str(output_dir), encoder, has_audio=bool(video_info['audio_codec'])
+            )
+        else:
+            job['plan'] = self._stream_plan(video_path, resolution)
+            ffmpeg_cmd = TranscodingService.build_hls_command(video_path, resolution, str(output_dir), encoder, job['plan'])
+        (output_dir / self.JOB_FILE).write_text(json.dumps(job, ensure_ascii=False), encoding='utf-8')
+        
+        # stderr写入日志文件，stdout为进度输出，由读取线程持续消费（管道无人读取时会被写满而阻塞）
+        with open(output_dir / self.LOG_FILE, 'wb') as log:
+            process = subprocess.Popen(
+                ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log,
+                text=True, encoding='utf-8', errors='replace',
+            )
+        video_info = TranscodingService.get_video_info(video_path)
+        progress = ProgressTracker(
+            video_info['duration'] if video_info else None, path=output_dir / PROGRESS_FILE
+        ).start(process.stdout)
+        
+        logger.info(f"🚀 开始转码: {job['movie']} -> {resolution}, ID: {transcode_id}, 编码器: {encoder['name']}")
+        return dict(job, process=process, progress=progress)
+    
+    def _monitor(self, job):
+        """等待FFmpeg结束，期间定期刷新锁文件，结束后写入完成/失败标记"""
+        process = job['process']
+        output_dir = job['output_dir']
+        lock_path = output_dir / TRANSCODE_LOCK_FILE
+        try:
+            while True:
+                try:
+                    process.wait(timeout=TRANSCODE_LOCK_HEARTBEAT)
+                    break
+                except subprocess.TimeoutExpired:
+                    try:
+                        os.utime(lock_path)
+                    except OSError:
+                        pass
+            # 等待读取线程处理完剩余的进度输出并写入最终结果
+            job['progress'].wait(5)
+            
+            if job.get('cancelled'):
+                logger.info(f"🚫 转码任务已取消: {job['resolution']}, ID: {job['transcode_id']}")
+            elif process.returncode == 0:
+                if job.get('renditions'):
+                    # 按实际片段大小更新主播放列表中的码率
+                    video_info = TranscodingService.get_video_info(job['source'])
+                    TranscodingService.write_master_playlist(output_dir, job['renditions'], video_info, measured=True)
+                (output_dir / 'completed').write_text(str(int(time.time())))
+                logger.info(f"✅ 转码成功完成: {job['resolution']}, ID: {job['transcode_id']}")
+            else:
+                try:
+                    error_output = (output_dir / self.LOG_FILE).read_text(encoding='utf-8', errors='replace')[-4000:]
+                except OSError:
+                    error_output = ''
+                (output_dir / 'failed').write_text(error_output, encoding='utf-8')
+                logger.error(f"❌ 转码失败: {job['resolution']}, ID: {job['transcode_id']}, 返回码: {process.returncode}")
+        except Exception as e:
+            logger.error(f"监控转码任务失败: {str(e)}")
+        finally:
+            job['ticket'].release()
+            self._finish(job)
+
+
+transcoding_service = CachedTranscodingService(TRANSCODED_DIR)
+
+
 # 启动清理任务线程
 def start_cleanup_thread():
     """启动后台清理线程"""
@@ -814,8 +1952,8 @@ def start_cleanup_thread():
                 # 每小时清理一次旧的转码缓存
                 TranscodingService.cleanup_old_transcodes(max_age_hours=24)
                 
-                # 每10分钟清理一次不活跃的实时会话
-                TranscodingService.cleanup_inactive_sessions(inactive_minutes=30)
+                # 清理不活跃的实时会话
+                TranscodingService.cleanup_inactive_sessions()
                 
             except Exception as e:
                 logger.error(f"清理任务失败: {str(e)}")
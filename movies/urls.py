@@ -11,13 +11,21 @@ urlpatterns = [
     path('movie/<int:pk>/progress/', views.update_progress, name='update_progress'),
     path('history/', views.watch_history_view, name='watch_history'),
     
+    # 海报和缩略图（内容哈希URL，生产环境可用）
+    path('media-v/<path:path>', views.serve_hashed_media, name='serve_hashed_media'),
+    
     # GPU硬解转码相关路由
     path('movie/<int:pk>/resolutions/', views.get_video_resolutions, name='get_video_resolutions'),
     path('movie/<int:pk>/transcode/', views.start_transcoding, name='start_transcoding'),
     path('transcode/status/<str:transcode_id>/', views.get_transcode_status, name='get_transcode_status'),
     path('movie/<int:pk>/hls/<str:resolution>/', views.serve_hls_video, name='serve_hls_video'),
     path('movie/<int:pk>/hls/<str:resolution>/<str:filename>', views.serve_hls_segment, name='serve_hls_segment'),
+    path('movie/<int:pk>/abr/', views.abr_playback, name='abr_playback'),
+    path('movie/<int:pk>/abr/master.m3u8', views.serve_abr_file, {'filename': 'master.m3u8'}, name='serve_abr_master'),
+    path('movie/<int:pk>/abr/<str:rendition>/<str:filename>', views.serve_abr_file, name='serve_abr_file'),
     path('management/cleanup-transcodes/', views.cleanup_transcodes, name='cleanup_transcodes'),
+    path('management/streaming-stats/', views.streaming_stats, name='streaming_stats'),
+    path('management/transcodes/<str:transcode_id>/cancel/', views.cancel_transcode, name='cancel_transcode'),
     
     # 视频扫描管理路由
     path('management/scan-videos/', views.scan_videos_page, name='scan_videos_page'),
@@ -27,11 +35,17 @@ urlpatterns = [
     # 新增实时转码相关API
     path('api/test/', views.test_api, name='test_api'),
     path('api/<int:pk>/resolutions/', views.get_available_resolutions, name='get_available_resolutions'),
+    path('api/<int:pk>/playback/', views.negotiate_playback, name='negotiate_playback'),
     path('api/<int:pk>/realtime/<str:resolution>/', views.realtime_transcode_request, name='realtime_transcode_request'),
     path('api/<int:pk>/realtime/<str:resolution>/<str:session_id>/', views.realtime_hls_stream, name='realtime_hls_stream'),
     path('api/realtime/segment/<str:session_id>/<str:segment_name>', views.realtime_segment, name='realtime_segment'),
     path('api/realtime/stop/', views.stop_realtime_session, name='stop_realtime_session'),
     
+    # 即时分段转码
+    path('api/<int:pk>/ondemand/<str:resolution>/', views.ondemand_transcode_request, name='ondemand_transcode_request'),
+    path('api/<int:pk>/ondemand/<str:resolution>/index.m3u8', views.ondemand_playlist, name='ondemand_playlist'),
+    path('api/<int:pk>/ondemand/<str:resolution>/<int:index>.ts', views.ondemand_segment, name='ondemand_segment'),
+    
     # HLS文件直接访问
     path('api/realtime/<str:session_id>/hls/<str:filename>', views.serve_realtime_hls, name='serve_realtime_hls'),
     path('api/realtime/<str:session_id>/ts/<str:filename>', views.serve_realtime_segment, name='serve_realtime_segment'),
@@ -4,15 +4,45 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.paginator import Paginator
 from django.db.models import Q, Count, Avg
-from django.http import JsonResponse, FileResponse, Http404, StreamingHttpResponse, HttpResponseNotFound, HttpResponse
+from django.http import JsonResponse, FileResponse, Http404, StreamingHttpResponse, HttpResponseNotFound, HttpResponse, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
 from django.utils import timezone
 from django.db import transaction
 from django.views.generic import ListView
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
 from .models import Movie, WatchHistory, MovieRating, Series
 from .forms import MovieRatingForm
-from .transcoding import TranscodingService
+from .transcoding import (
+    TranscodingService, transcoding_service,
+    TRANSCODING_CONFIG, ABR_RESOLUTION, ABR_MASTER_PLAYLIST, ABR_RENDITION_PLAYLIST, REMUX_RESOLUTION,
+    transcode_scheduler, FingerprintPending,
+)
+from .scheduler import INTERACTIVE, PREFETCH
+from .ondemand import get_ondemand, playback_scope, SegmentUnavailable, ondemand_stats
+from .admission import evaluate as evaluate_admission
+from .quotas import reserve as reserve_quota, release as release_quota, playback_session_active, QuotaExceeded
+from .playback import parse_capabilities, decide_playback, choose_resolution, DIRECT, TRANSCODE
+from .streaming import (
+    serve_file, guess_content_type,
+    file_validators, conditional_response, set_validators, vary_etag,
+)
+from .hls import (
+    segment_cache_control, playlist_cache_control, IMMUTABLE_CACHE_CONTROL,
+    realtime_output_path, render_playlist, playlist_cache, PLAYLIST_CONTENT_TYPE, segment_content_type,
+)
+from .segment_cache import segment_cache
+from .pacing import pacing_enabled, registry as pacing_registry
+from .fd_cache import file_handles
+from .hashed_media import parse_hashed_name, resolve_hashable, content_hash, hashed_name
+from .signing import (
+    edge_library_url, edge_transcoded_url, edge_expiry, edge_enabled,
+    issue_playback_token, verify_playback_token, load_playback_token,
+)
+from django.urls import reverse
+from urllib.parse import urlencode
 import json
 import mimetypes
 from pathlib import Path
@@ -24,6 +54,15 @@ from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 
+# 自适应码率：档位尚未就绪时建议客户端再次请求的间隔（秒）
+ABR_RETRY_AFTER = 1
+# 源文件指纹在后台计算时建议客户端再次请求的间隔（秒）
+TRANSCODE_RETRY_AFTER = 2
+# 实时转码排队或等待第一个片段时建议客户端再次查询的间隔（秒）
+REALTIME_RETRY_AFTER = 2
+# 档位目录中的片段：seg_00000.ts / .m4s、单文件输出的media.ts / .m4s、fMP4初始化片段
+ABR_SEGMENT_RE = re.compile(r'(?:seg_\d+|media)\.(?:ts|m4s)|init(?:_\d+)?\.mp4')
+
 
 class MovieListView(ListView):
     model = Movie
@@ -331,6 +370,8 @@ def movie_detail(request, pk):
         'rating_form': MovieRatingForm(),
         'related_episodes': related_episodes,
         'recommended_movies': recommended_movies,
+        # 启用边缘服务器时使用签名URL，否则由serve_video提供
+        'video_url': edge_library_url(movie.file_path) or reverse('serve_video', args=[movie.pk]),
     }
     
     return render(request, 'movies/movie_detail.html', context)
@@ -340,83 +381,30 @@ def serve_video(request, pk):
     """提供视频文件流服务，支持HTTP Range请求"""
     movie = get_object_or_404(Movie, pk=pk)
     
-    if not os.path.exists(movie.file_path):
-        raise Http404("视频文件不存在")
-    
     try:
-        import mimetypes
-        from django.http import StreamingHttpResponse
-        
-        # 获取文件信息
-        file_path = movie.file_path
-        file_size = os.path.getsize(file_path)
-        
-        # 确定MIME类型
-        content_type, _ = mimetypes.guess_type(file_path)
-        if not content_type:
-            content_type = 'video/mp4'
-        
-        # 检查是否是Range请求
-        range_header = request.META.get('HTTP_RANGE')
-        
-        if range_header:
-            # 解析Range头
-            range_match = range_header.replace('bytes=', '').split('-')
-            start = int(range_match[0]) if range_match[0] else 0
-            end = int(range_match[1]) if range_match[1] else file_size - 1
-            
-            # 确保范围有效
-            start = max(0, start)
-            end = min(file_size - 1, end)
-            content_length = end - start + 1
-            
-            # 创建文件迭代器
-            def file_iterator(file_path, start, chunk_size=8192):
-                with open(file_path, 'rb') as f:
-                    f.seek(start)
-                    remaining = content_length
-                    while remaining > 0:
-                        chunk_size = min(chunk_size, remaining)
-                        data = f.read(chunk_size)
-                        if not data:
-                            break
-                        remaining -= len(data)
-                        yield data
-            
-            # 创建206 Partial Content响应
-            response = StreamingHttpResponse(
-                file_iterator(file_path, start),
-                status=206,
-                content_type=content_type
-            )
-            response['Content-Length'] = str(content_length)
-            response['Content-Range'] = f'bytes {start}-{end}/{file_size}'
-            response['Accept-Ranges'] = 'bytes'
-            
-        else:
-            # 普通请求，返回整个文件
-            def file_iterator(file_path, chunk_size=8192):
-                with open(file_path, 'rb') as f:
-                    while True:
-                        data = f.read(chunk_size)
-                        if not data:
-                            break
-                        yield data
-            
-            response = StreamingHttpResponse(
-                file_iterator(file_path),
-                content_type=content_type
-            )
-            response['Content-Length'] = str(file_size)
-            response['Accept-Ranges'] = 'bytes'
+        # 卸载给前端Web服务器，或由流式引擎处理区间解析、416和sendfile零拷贝发送
+        # ETag/Last-Modified由文件状态生成，过期后通过条件请求重新验证
+        # 启用限速时按视频码率限制发送速率（ffprobe结果有缓存）
+        bitrate = None
+        if pacing_enabled():
+            video_info = TranscodingService.get_video_info(movie.file_path)
+            bitrate = video_info['bitrate'] if video_info else None
+
+        response = serve_file(
+            request, movie.file_path,
+            content_type=guess_content_type(movie.file_path, default='video/mp4'),
+            cache_control='public, max-age=86400',
+            bitrate=bitrate,
+        )
         
-        # 设置缓存和其他头
+        # 设置其他头
         response['Content-Disposition'] = f'inline; filename="{movie.file_name}"'
-        response['Cache-Control'] = 'no-cache'
         response['X-Content-Type-Options'] = 'nosniff'
         
         return response
         
+    except FileNotFoundError:
+        raise Http404("视频文件不存在")
     except Exception as e:
         raise Http404(f"无法播放视频: {str(e)}")
 
@@ -569,6 +557,8 @@ def play_movie(request, pk):
         'has_prev': playlist and current_index > 0 if playlist else False,
         'next_movie': playlist[current_index + 1] if playlist and current_index < len(playlist) - 1 else None,
         'prev_movie': playlist[current_index - 1] if playlist and current_index > 0 else None,
+        # 启用边缘服务器时使用签名URL，否则由serve_video提供
+        'video_url': edge_library_url(movie.file_path) or reverse('serve_video', args=[movie.pk]),
     }
     
     return render(request, 'movies/play.html', context)
@@ -586,6 +576,51 @@ def watch_history_view(request):
     return render(request, 'movies/watch_history.html', {'page_obj': page_obj})
 
 
+def serve_media(request, path):
+    """提供上传的媒体文件（海报、背景图、缩略图），支持ETag和条件请求"""
+    try:
+        file_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("文件不存在")
+    
+    if not os.path.isfile(file_path):
+        raise Http404("文件不存在")
+    
+    return serve_file(request, file_path, cache_control='public, max-age=86400')
+
+
+def serve_hashed_media(request, path):
+    """
+    提供内容哈希URL的海报和缩略图（生产环境可用）
+
+    URL中的哈希与文件内容一致时使用一年的不可变缓存；图片已被替换时跳转到新URL。
+    """
+    parsed = parse_hashed_name(path)
+    if not parsed:
+        raise Http404("文件不存在")
+    name, digest = parsed
+    
+    # 只提供允许目录中的图片，不接受 ".." 和指向目录外的符号链接
+    file_path = resolve_hashable(name)
+    if file_path is None:
+        raise Http404("文件不存在")
+    try:
+        current = content_hash(file_path)
+    except OSError:
+        raise Http404("文件不存在")
+    
+    if current != digest:
+        # 旧URL可能仍留在页面缓存中，跳转本身不缓存
+        response = redirect('serve_hashed_media', hashed_name(name, current))
+        response['Cache-Control'] = 'no-cache'
+        return response
+    
+    try:
+        return serve_file(request, file_path, cache_control=IMMUTABLE_CACHE_CONTROL)
+    except FileNotFoundError:
+        raise Http404("文件不存在")
+
+
 # ==================== GPU硬解转码相关视图 ====================
 
 def get_video_resolutions(request, pk):
@@ -607,9 +642,10 @@ def get_video_resolutions(request, pk):
         })
 
 
+@login_required
 @require_POST
 def start_transcoding(request, pk):
-    """开始转码"""
+    """开始转码（新启动的转码任务占用用户的转码配额）"""
     movie = get_object_or_404(Movie, pk=pk)
     
     try:
@@ -624,11 +660,26 @@ def start_transcoding(request, pk):
                 'success': True,
                 'message': '原画无需转码',
                 'status': 'completed',
-                'url': f'/movies/{pk}/video/'
+                'url': reverse('serve_video', args=[pk])
             })
         
         # 开始转码
-        transcode_id, status = transcoding_service.start_transcoding(movie, resolution)
+        # 同一内容同一分辨率只转码一次：已完成直接返回，进行中则附加到已有任务
+        try:
+            transcode_id, status = transcoding_service.start_transcoding(
+                movie, resolution, priority=PREFETCH, owner=request.user.id, user=request.user
+            )
+        except QuotaExceeded as e:
+            return JsonResponse({'success': False, 'quota': True, 'error': str(e)})
+        
+        if status == 'preparing':
+            # 源文件指纹在后台计算，客户端稍后重新请求
+            return JsonResponse({
+                'success': True,
+                'status': status,
+                'message': '正在校验源文件',
+                'retry_after': TRANSCODE_RETRY_AFTER,
+            })
         
         if not transcode_id:
             return JsonResponse({
@@ -637,11 +688,17 @@ def start_transcoding(request, pk):
                 'status': status
             })
         
+        messages_by_status = {
+            'started': '转码已开始',
+            'queued': '转码排队中',
+            'transcoding': '转码进行中',
+            'completed': '转码已完成',
+        }
         return JsonResponse({
             'success': True,
             'transcode_id': transcode_id,
             'status': status,
-            'message': '转码已开始' if status == 'started' else '转码已完成'
+            'message': messages_by_status.get(status, status)
         })
         
     except json.JSONDecodeError:
@@ -666,7 +723,8 @@ def get_transcode_status(request, transcode_id):
             'status': status['status'],
             'elapsed': status['elapsed'],
             'movie': status['movie'],
-            'resolution': status['resolution']
+            'resolution': status['resolution'],
+            'progress': status.get('progress'),
         })
         
     except Exception as e:
@@ -678,40 +736,44 @@ def serve_hls_video(request, pk, resolution):
     movie = get_object_or_404(Movie, pk=pk)
     
     try:
-        # 获取HLS文件路径
-        hls_path = transcoding_service.get_hls_path(movie.id, resolution)
+        # 获取HLS文件路径（源文件指纹尚未计算完成时也还没有转码输出）
+        try:
+            hls_path = transcoding_service.get_hls_path(movie, resolution)
+        except FingerprintPending:
+            hls_path = None
         
-        if not hls_path.exists():
+        if hls_path is None or not hls_path.exists():
             return JsonResponse({
                 'success': False,
                 'error': f'转码文件不存在: {resolution}',
                 'need_transcode': True
             })
         
-        # 读取并返回m3u8文件
-        with open(hls_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        # 播放列表未变化时直接返回304
+        cache_control = playlist_cache_control(hls_path)
+        stat_result = hls_path.stat()
+        etag, last_modified = file_validators(stat_result)
         
-        # 修改相对路径为绝对URL
-        lines = content.split('\n')
-        modified_lines = []
+        # 启用边缘服务器时片段地址指向签名目录，ETag需要随签名过期时间变化
+        segment_prefix = reverse('serve_hls_video', args=[pk, resolution])
+        if edge_enabled():
+            expires = edge_expiry()
+            segment_prefix = edge_transcoded_url(hls_path.parent.name, expires=expires)
+            etag = vary_etag(etag, expires)
         
-        for line in lines:
-            if line.endswith('.ts'):
-                # 将.ts文件路径转换为URL
-                ts_filename = line
-                ts_url = f'/movies/{pk}/hls/{resolution}/{ts_filename}'
-                modified_lines.append(ts_url)
-            else:
-                modified_lines.append(line)
+        not_modified = conditional_response(request, etag, last_modified, cache_control)
+        if not_modified is not None:
+            return not_modified
         
-        modified_content = '\n'.join(modified_lines)
+        # 读取m3u8文件并将相对路径改写为绝对URL（带缓存，只解析新增部分）
+        modified_content = render_playlist(hls_path, stat_result, segment_prefix)
         
         response = JsonResponse({
             'success': True,
             'content': modified_content,
             'content_type': 'application/vnd.apple.mpegurl'
         })
+        set_validators(response, etag, last_modified, cache_control)
         
         return response
         
@@ -727,36 +789,111 @@ def serve_hls_segment(request, pk, resolution, filename):
     movie = get_object_or_404(Movie, pk=pk)
     
     try:
+        # 输出目录中还有任务信息和日志，只提供片段文件（含fMP4初始化片段和单文件输出的媒体文件）
+        content_type = segment_content_type(filename)
+        if content_type is None:
+            raise Http404(f"视频片段不存在: {filename}")
+        
         # 构建文件路径
-        transcode_id = transcoding_service.generate_transcode_id(movie.id, resolution)
+        transcode_id = transcoding_service.generate_transcode_id(movie, resolution)
         segment_path = transcoding_service.transcode_dir / transcode_id / filename
         
-        if not segment_path.exists():
-            raise Http404(f"视频片段不存在: {filename}")
-        
-        # 流式返回视频片段
-        def file_iterator(file_path, chunk_size=8192):
-            with open(file_path, 'rb') as f:
-                while True:
-                    data = f.read(chunk_size)
-                    if not data:
-                        break
-                    yield data
-        
-        response = StreamingHttpResponse(
-            file_iterator(segment_path),
-            content_type='video/mp2t'
+        # 已完成的转码片段不可变，长期缓存并放入热点片段缓存
+        cache_control = segment_cache_control(segment_path)
+        response = serve_file(
+            request, segment_path, content_type=content_type, cache_control=cache_control,
+            cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
         )
-        response['Content-Length'] = str(segment_path.stat().st_size)
-        response['Accept-Ranges'] = 'bytes'
-        response['Cache-Control'] = 'public, max-age=3600'  # 缓存1小时
         
         return response
         
+    except Http404:
+        raise
+    except FileNotFoundError:
+        raise Http404(f"视频片段不存在: {filename}")
     except Exception as e:
         raise Http404(f"无法提供视频片段: {str(e)}")
 
 
+@login_required
+@require_GET
+def abr_playback(request, pk):
+    """
+    开始（或附加到）自适应码率转码
+    
+    立即返回，不在请求中等待：所有档位都生成第一个片段后ready为True，播放器加载主播放列表地址，
+    在档位之间自动切换；尚未就绪时客户端在retry_after秒后再次请求（附加到同一任务）。
+    """
+    movie = get_object_or_404(Movie, pk=pk)
+    
+    try:
+        transcode_id, status = transcoding_service.start_transcoding(
+            movie, ABR_RESOLUTION, priority=INTERACTIVE, owner=request.user.id, user=request.user
+        )
+    except QuotaExceeded as e:
+        return JsonResponse({'success': False, 'quota': True, 'error': str(e)})
+    if status == 'preparing':
+        return JsonResponse({'success': True, 'status': status, 'ready': False, 'retry_after': TRANSCODE_RETRY_AFTER})
+    if not transcode_id:
+        return JsonResponse({'success': False, 'error': status})
+    
+    ready = transcoding_service.is_abr_ready(transcode_id)
+    if not ready:
+        job_status = transcoding_service.get_transcode_status(transcode_id)
+        if job_status and job_status['status'] in ('failed', 'interrupted'):
+            return JsonResponse({'success': False, 'error': '自适应码率转码失败'})
+    
+    return JsonResponse({
+        'success': True,
+        'status': status,
+        'ready': ready,
+        'retry_after': ABR_RETRY_AFTER,
+        'transcode_id': transcode_id,
+        'hls_url': reverse('serve_abr_master', args=[pk]),
+    })
+
+
+@require_GET
+def serve_abr_file(request, pk, filename, rendition=''):
+    """
+    提供自适应码率输出的文件：主播放列表、各档位播放列表和片段
+    
+    主播放列表和档位播放列表中使用相对地址，不需要改写。
+    """
+    movie = get_object_or_404(Movie, pk=pk)
+    
+    # 输出目录中还有任务信息和日志，只提供播放列表和片段
+    if rendition:
+        if rendition not in TRANSCODING_CONFIG['resolutions'] or not (
+            filename == ABR_RENDITION_PLAYLIST or ABR_SEGMENT_RE.fullmatch(filename)
+        ):
+            raise Http404(f"视频片段不存在: {filename}")
+    elif filename != ABR_MASTER_PLAYLIST:
+        raise Http404(f"视频片段不存在: {filename}")
+    
+    try:
+        output_dir = transcoding_service.transcode_dir / transcoding_service.generate_transcode_id(movie, ABR_RESOLUTION)
+    except (OSError, ValueError, FingerprintPending):
+        raise Http404("视频文件不存在")
+    file_path = output_dir / rendition / filename
+    
+    content_type = segment_content_type(filename)
+    if content_type is not None:
+        cache_control = segment_cache_control(file_path)
+    else:
+        # 转码过程中播放列表不断增长；主播放列表在转码完成后会按实际码率更新，始终重新验证
+        cache_control = playlist_cache_control(file_path)
+        content_type = PLAYLIST_CONTENT_TYPE
+    
+    try:
+        return serve_file(
+            request, file_path, content_type=content_type, cache_control=cache_control,
+            cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+        )
+    except FileNotFoundError:
+        raise Http404(f"视频片段不存在: {filename}")
+
+
 def cleanup_transcodes(request):
     """清理旧的转码文件（管理员功能）"""
     if not request.user.is_superuser:
@@ -896,6 +1033,38 @@ def cleanup_transcodes(request):
         return JsonResponse({'success': False, 'error': str(e)})
 
 
+@login_required
+@require_GET
+def streaming_stats(request):
+    """流媒体服务统计（管理员功能），统计数据属于处理本次请求的worker进程"""
+    if not request.user.is_superuser:
+        return JsonResponse({'success': False, 'error': '权限不足'})
+    
+    return JsonResponse({
+        'success': True,
+        'pid': os.getpid(),
+        'segment_cache': segment_cache.stats(),
+        'playlist_cache': playlist_cache.stats(),
+        'file_handles': file_handles.stats(),
+        'pacing': pacing_registry.snapshot(),
+        'realtime_sessions': TranscodingService.get_active_sessions()['sessions'],
+        'ondemand': ondemand_stats(),
+        'scheduler': transcode_scheduler.stats(),
+    })
+
+
+@login_required
+@require_POST
+def cancel_transcode(request, transcode_id):
+    """取消排队中或进行中的点播转码任务（管理员功能），只对处理本次请求的worker进程中的任务有效"""
+    if not request.user.is_superuser:
+        return JsonResponse({'success': False, 'error': '权限不足'})
+    
+    if not transcoding_service.cancel_transcoding(transcode_id):
+        return JsonResponse({'success': False, 'error': '转码任务不存在或不在本进程中'})
+    return JsonResponse({'success': True, 'message': '转码任务已取消'})
+
+
 # ==================== 实时转码相关视图 ====================
 
 def test_api(request):
@@ -903,6 +1072,34 @@ def test_api(request):
     print("🔍 [DEBUG] 测试API被调用")
     return JsonResponse({'success': True, 'message': 'API可以正常访问'})
 
+def resolution_menu(video_path, available_resolutions):
+    """清晰度菜单：原画、有多个档位时的自适应码率（自动），以及可用的转码分辨率"""
+    menu = ['原画']
+    if len(TranscodingService.abr_ladder(video_path)) > 1:
+        menu.append('自动')
+    return menu + list(available_resolutions)
+
+
+def realtime_playlist_url(session_id, resolution, token):
+    """实时转码播放列表地址；启用边缘服务器时播放列表和片段都由边缘服务器提供"""
+    return (
+        edge_transcoded_url(f'realtime_{session_id}', f'{resolution}.m3u8')
+        or f'/api/realtime/{session_id}/hls/{resolution}.m3u8?{urlencode({"token": token})}'
+    )
+
+
+def start_realtime_session(request, movie, resolution, **kwargs):
+    """占用用户的转码配额后开始实时转码，返回值与start_realtime_transcoding一致，超出配额时带quota标记"""
+    reservation = reserve_quota(request.user, movie, resolution)
+    if not reservation['success']:
+        return reservation
+    result = TranscodingService.start_realtime_transcoding(
+        movie.file_path, resolution, session_id=reservation['session_id'], owner=request.user.id, **kwargs
+    )
+    if not result['success']:
+        release_quota(reservation['session_id'])
+    return result
+
 @login_required
 @require_GET
 def get_available_resolutions(request, pk):
@@ -918,12 +1115,9 @@ def get_available_resolutions(request, pk):
         return JsonResponse({'success': False, 'error': '视频文件不存在'})
     
     print(f"✅ [DEBUG] 开始获取可用分辨率...")
-    available_resolutions = TranscodingService.get_available_resolutions(movie.file_path)
+    available_resolutions = resolution_menu(movie.file_path, TranscodingService.get_available_resolutions(movie.file_path))
     print(f"📊 [DEBUG] 可用分辨率: {available_resolutions}")
     
-    # 添加原画质量选项
-    available_resolutions.insert(0, '原画')
-    
     # 获取视频原始信息
     video_info = TranscodingService.get_video_info(movie.file_path)
     print(f"📺 [DEBUG] 视频信息: {video_info}")
@@ -937,6 +1131,116 @@ def get_available_resolutions(request, pk):
     
     return JsonResponse(result)
 
+@login_required
+@require_POST
+def negotiate_playback(request, pk):
+    """
+    播放协商：客户端上报播放能力，服务端选择直接播放、封装转换、只转码音频或完整转码，
+    启动需要的转码并返回可以直接加载的URL，同时返回清晰度菜单
+    """
+    movie = get_object_or_404(Movie, pk=pk)
+    if not movie.file_path or not os.path.exists(movie.file_path):
+        return JsonResponse({'success': False, 'error': '视频文件不存在'})
+    
+    try:
+        capabilities = parse_capabilities(json.loads(request.body))
+    except (ValueError, TypeError) as e:
+        return JsonResponse({'success': False, 'error': f'无效的播放能力: {e}'}, status=400)
+    
+    video_info = TranscodingService.get_video_info(movie.file_path)
+    if not video_info:
+        return JsonResponse({'success': False, 'error': '无法获取视频信息'})
+    available_resolutions = TranscodingService.get_available_resolutions(movie.file_path)
+    try:
+        decision = decide_playback(movie.file_path, video_info, capabilities, available_resolutions)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+    
+    response = {
+        'success': True,
+        'method': decision['method'],
+        'reason': decision['reason'],
+        'plan': decision['plan'],
+        'resolutions': resolution_menu(movie.file_path, available_resolutions),
+        'original_info': video_info,
+    }
+    
+    if decision['method'] == DIRECT:
+        response.update({
+            'url': edge_library_url(movie.file_path) or reverse('serve_video', args=[pk]),
+            'hls': False,
+            'quality': '原画',
+        })
+        logger.info(f"▶️ 播放协商: {movie.title} -> 直接播放（{decision['reason']}）")
+        return JsonResponse(response)
+    
+    if decision['method'] != TRANSCODE:
+        # 直接复制视频流，实时转码几乎立即产出第一个片段
+        result = start_realtime_session(
+            request, movie, REMUX_RESOLUTION, allow_hevc=decision['allow_hevc'], plan=decision['plan'],
+        )
+        if result['success']:
+            token = issue_playback_token(result['session_id'], request.user.id)
+            response.update({
+                'url': realtime_playlist_url(result['session_id'], REMUX_RESOLUTION, token),
+                'hls': True,
+                'quality': '原画',
+                'session_id': result['session_id'],
+                'token': token,
+                'status': result['status'],
+            })
+            logger.info(f"📦 播放协商: {movie.title} -> {decision['method']}（{decision['reason']}）")
+            return JsonResponse(response)
+        logger.warning(f"⚠️ 直接复制失败，改为完整转码: {movie.title} - {result.get('error')}")
+        if not available_resolutions:
+            return JsonResponse({'success': False, 'error': result.get('error', '转码失败')})
+        decision = {
+            'method': TRANSCODE,
+            'resolution': choose_resolution(capabilities, available_resolutions),
+            'reason': '直接复制失败',
+        }
+        response.update({'method': TRANSCODE, 'reason': decision['reason'], 'plan': None})
+    
+    # 准入控制（与 realtime_transcode_request 相同）：负载已满时降档，仍然不够时排队等待容量
+    admission = evaluate_admission(movie.file_path, decision['resolution'], available_resolutions)
+    resolution = admission['resolution']
+    response.update({
+        'hls': True,
+        'quality': resolution,
+        'downgraded_from': admission.get('downgraded_from'),
+        'alternative': admission.get('alternative'),
+        'eta': admission.get('eta'),
+    })
+    if not admission.get('queued'):
+        try:
+            # 即时分段转码：播放列表立即可用，从任意位置开始只转码需要的片段
+            get_ondemand(movie.file_path, resolution)
+        except (FileNotFoundError, ValueError, SegmentUnavailable) as e:
+            logger.warning(f"⚠️ 即时分段转码不可用，改用实时转码: {movie.title} - {e}")
+        else:
+            token = ondemand_token(request, movie, resolution)
+            if isinstance(token, dict):
+                return JsonResponse(token)
+            response['url'] = f"{reverse('ondemand_playlist', args=[pk, resolution])}?{urlencode({'token': token})}"
+            logger.info(f"🔥 播放协商: {movie.title} -> 转码 {resolution}（{decision['reason']}）")
+            return JsonResponse(response)
+    
+    # 即时分段转码的进程不能等待容量：排队时使用实时转码会话，容量足够后才启动，前端轮询排队状态
+    result = start_realtime_session(request, movie, resolution, wait_for_capacity=admission.get('queued', False))
+    if not result['success']:
+        return JsonResponse({'success': False, 'error': result.get('error', '转码失败'), 'quota': result.get('quota', False)})
+    token = issue_playback_token(result['session_id'], request.user.id)
+    response.update({
+        'url': realtime_playlist_url(result['session_id'], resolution, token),
+        'session_id': result['session_id'],
+        'token': token,
+        'status': result['status'],
+        'queue_position': result.get('queue_position', 0),
+        'eta': result.get('eta') or admission.get('eta'),
+    })
+    logger.info(f"🔥 播放协商: {movie.title} -> 实时转码 {resolution}（{decision['reason']}）")
+    return JsonResponse(response)
+
 @login_required
 @require_GET
 def realtime_transcode_request(request, pk, resolution):
@@ -956,8 +1260,8 @@ def realtime_transcode_request(request, pk, resolution):
     available_resolutions = TranscodingService.get_available_resolutions(movie.file_path)
     print(f"📊 [DEBUG] 可用分辨率: {available_resolutions}")
     
-    # 检查请求的分辨率是否有效
-    if resolution != '原画' and resolution not in available_resolutions:
+    # 检查请求的分辨率是否有效（remux保持源分辨率，是否可以直接复制由转码服务判断）
+    if resolution not in ('原画', REMUX_RESOLUTION) and resolution not in available_resolutions:
         print(f"❌ [DEBUG] 不支持的分辨率: {resolution}")
         return JsonResponse({'success': False, 'error': f'不支持的分辨率: {resolution}'})
     
@@ -971,138 +1275,167 @@ def realtime_transcode_request(request, pk, resolution):
             'message': '使用原始视频质量'
         })
     
+    # 准入控制：转码负载已满时降档，仍然不够时排队等待容量（给出预计等待时间和不需要编码的播放方式）
+    admission = evaluate_admission(movie.file_path, resolution, available_resolutions)
+    resolution = admission['resolution']
+    
     # 开始实时转码
     print(f"🔥 [DEBUG] 开始实时转码: {resolution}")
-    result = TranscodingService.start_realtime_transcoding(movie.file_path, resolution)
+    result = start_realtime_session(request, movie, resolution, wait_for_capacity=admission.get('queued', False))
     print(f"🔥 [DEBUG] 转码结果: {result}")
     
     if result['success']:
-        # 记录会话ID到用户会话
-        if 'realtime_sessions' not in request.session:
-            request.session['realtime_sessions'] = []
-        
-        # 添加新会话并确保不重复
-        if result['session_id'] not in request.session['realtime_sessions']:
-            request.session['realtime_sessions'].append(result['session_id'])
-            request.session.modified = True
-        
+        # 签发播放令牌，后续播放列表和片段请求只校验令牌，不再读取数据库会话
+        # 转码在后台排队和启动，前端轮询realtime_hls_stream直到播放列表出现
         return JsonResponse({
             'success': True,
-            'status': 'active',
+            'status': result['status'],
+            'queue_position': result.get('queue_position', 0),
+            'eta': result.get('eta'),
+            'alternative': admission.get('alternative'),
+            'retry_after': REALTIME_RETRY_AFTER,
             'realtime': True,
             'session_id': result['session_id'],
+            'token': issue_playback_token(result['session_id'], request.user.id),
             'resolution': resolution,
             'encoder': result.get('encoder', 'unknown'),
+            'plan': result.get('plan'),
+            'downgraded_from': admission.get('downgraded_from'),
             'rtx_optimized': result.get('rtx_optimized', False),
             'message': f'实时转码已开始: {resolution}'
         })
     else:
         return JsonResponse({
             'success': False,
-            'error': result.get('error', '未知错误')
+            'error': result.get('error', '未知错误'),
+            'quota': result.get('quota', False),
         })
 
-@login_required
 @require_GET
 def realtime_hls_stream(request, pk, resolution, session_id):
     """获取实时HLS流"""
+    # 验证播放令牌是否属于该会话
+    token = request.GET.get('token')
+    if not verify_playback_token(token, session_id):
+        return JsonResponse({'success': False, 'error': '无效的转码会话'})
+    
     movie = get_object_or_404(Movie, pk=pk)
     
     if not movie.file_path or not os.path.exists(movie.file_path):
         return JsonResponse({'success': False, 'error': '视频文件不存在'})
     
-    # 验证会话是否属于当前用户
-    if 'realtime_sessions' not in request.session or session_id not in request.session['realtime_sessions']:
-        return JsonResponse({'success': False, 'error': '无效的转码会话'})
-    
-    # 获取HLS内容
-    result = TranscodingService.get_realtime_hls_content(session_id, resolution)
-    
-    if result['success']:
-        # 返回HLS文件的URL而不是内容
-        hls_url = f'/api/realtime/{session_id}/hls/{resolution}.m3u8'
-        return JsonResponse({
-            'success': True,
-            'hls_url': hls_url,
-            'realtime': True
-        })
-    else:
+    # 只检查输出目录中的播放列表，不依赖进程内会话：会话可能由其他worker进程启动
+    TranscodingService.note_realtime_access(session_id)
+    if not os.path.exists(realtime_output_path(session_id, f"{resolution}.m3u8")):
+        # 排队/启动状态记录在缓存中，任意进程都可以查询
+        status = TranscodingService.realtime_status(session_id) or {}
+        if status.get('status') == 'failed':
+            return JsonResponse({'success': False, 'status': 'failed', 'error': status.get('error', '实时转码失败')})
+        if status.get('status') in ('queued', 'starting'):
+            return JsonResponse({
+                'success': False,
+                'status': status['status'],
+                'queue_position': status.get('queue_position', 0),
+                'eta': status.get('eta'),
+                'retry_after': REALTIME_RETRY_AFTER,
+            })
         return JsonResponse({
             'success': False,
-            'error': result.get('error', '未知错误'),
+            'error': f"HLS播放列表不存在: {resolution}",
             'need_transcode': True  # 提示前端可能需要重新请求转码
         })
+    
+    # 返回HLS文件的URL而不是内容
+    return JsonResponse({
+        'success': True,
+        'hls_url': realtime_playlist_url(session_id, resolution, token),
+        'realtime': True
+    })
 
-@login_required
 @require_GET
 def realtime_segment(request, session_id, segment_name):
     """获取实时HLS视频片段"""
-    # 验证会话是否属于当前用户
-    if 'realtime_sessions' not in request.session or session_id not in request.session['realtime_sessions']:
-        return HttpResponseNotFound('无效的转码会话')
+    # 只校验播放令牌，不依赖进程内会话，片段按文件是否存在提供
+    if not verify_playback_token(request.GET.get('token'), session_id):
+        return HttpResponseForbidden('无效的播放令牌')
+    
+    content_type = segment_content_type(segment_name)
+    if content_type is None:
+        return HttpResponseNotFound('视频片段不存在')
     
-    # 检查会话是否存在
-    session_info = TranscodingService.get_realtime_session(session_id)
-    if not session_info['success']:
-        return HttpResponseNotFound('转码会话不存在')
+    # 记录播放位置，转码领先过多时暂停
+    TranscodingService.note_realtime_playhead(session_id, segment_name, request.META.get('HTTP_RANGE'))
     
     # 组装片段文件路径
-    from django.conf import settings
-    TRANSCODED_DIR = os.path.join(settings.MEDIA_ROOT, 'transcoded')
-    segment_path = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}", segment_name)
+    segment_path = realtime_output_path(session_id, segment_name)
+    cache_control = segment_cache_control(segment_path)
     
-    if not os.path.exists(segment_path):
+    # 文件句柄和stat结果来自句柄缓存，不再单独检查文件是否存在
+    try:
+        response = serve_file(
+            request, segment_path, content_type=content_type, cache_control=cache_control,
+            cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+        )
+    except FileNotFoundError:
         return HttpResponseNotFound('视频片段不存在')
     
-    # 使用StreamingHttpResponse减少内存占用
-    def file_iterator(file_path, chunk_size=8192):
-        with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                yield chunk
-    
-    response = StreamingHttpResponse(file_iterator(segment_path), content_type='video/MP2T')
-    response['Cache-Control'] = 'max-age=300'  # 缓存5分钟
-    
     return response
 
 @require_GET  
 def serve_realtime_hls(request, session_id, filename):
     """直接提供实时HLS文件"""
-    # 简化版本：直接尝试访问文件，不检查会话（适用于重启后的情况）
+    # 只校验播放令牌，不依赖进程内会话，服务重启后依然可用
+    token = request.GET.get('token')
+    if not verify_playback_token(token, session_id):
+        return HttpResponseForbidden('无效的播放令牌')
     
     # 组装HLS文件路径
-    from django.conf import settings
-    TRANSCODED_DIR = os.path.join(settings.MEDIA_ROOT, 'transcoded')
-    hls_path = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}", filename)
+    # 输出目录中只提供播放列表和片段
+    content_type = segment_content_type(filename)
+    if content_type is None and not filename.endswith('.m3u8'):
+        return HttpResponseNotFound('HLS文件不存在')
+
+    hls_path = realtime_output_path(session_id, filename)
+    
+    if content_type is not None:
+        TranscodingService.note_realtime_playhead(session_id, filename, request.META.get('HTTP_RANGE'))
+        cache_control = segment_cache_control(hls_path)
+        try:
+            return serve_file(
+                request, hls_path, content_type=content_type, cache_control=cache_control,
+                cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+            )
+        except FileNotFoundError:
+            return HttpResponseNotFound('HLS文件不存在')
     
-    if not os.path.exists(hls_path):
+    # 播放器刷新播放列表即视为会话仍在使用
+    TranscodingService.note_realtime_access(session_id)
+    
+    # 增长中的播放列表必须重新验证，已结束的播放列表不可变
+    cache_control = playlist_cache_control(hls_path)
+    
+    # 播放列表未变化时直接返回304；改写后的片段URL带有令牌，ETag随令牌变化
+    # 播放列表需要改写，因此不卸载给前端Web服务器（片段仍会卸载）
+    try:
+        stat_result = os.stat(hls_path)
+    except FileNotFoundError:
         return HttpResponseNotFound('HLS文件不存在')
+    etag, last_modified = file_validators(stat_result)
+    etag = vary_etag(etag, token)
+    not_modified = conditional_response(request, etag, last_modified, cache_control)
+    if not_modified is not None:
+        not_modified['Access-Control-Allow-Origin'] = '*'
+        return not_modified
     
     try:
-        # 读取HLS文件内容
-        with open(hls_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # 修改.ts文件路径为完整URL
-        lines = content.split('\n')
-        modified_lines = []
-        
-        for line in lines:
-            if line.endswith('.ts'):
-                # 将.ts文件路径转换为URL
-                ts_url = f'/api/realtime/{session_id}/ts/{line}'
-                modified_lines.append(ts_url)
-            else:
-                modified_lines.append(line)
-        
-        modified_content = '\n'.join(modified_lines)
+        # 读取HLS文件并将片段路径改写为完整URL（带缓存，只解析新增部分）
+        modified_content = render_playlist(
+            hls_path, stat_result, f'/api/realtime/{session_id}/ts/', urlencode({'token': token})
+        )
         
         # 返回HLS播放列表
-        response = HttpResponse(modified_content, content_type='application/vnd.apple.mpegurl')
-        response['Cache-Control'] = 'no-cache'  # HLS文件不应缓存
+        response = HttpResponse(modified_content, content_type=PLAYLIST_CONTENT_TYPE)
+        set_validators(response, etag, last_modified, cache_control)
         response['Access-Control-Allow-Origin'] = '*'  # 允许跨域访问
         
         return response
@@ -1113,28 +1446,28 @@ def serve_realtime_hls(request, session_id, filename):
 @require_GET
 def serve_realtime_segment(request, session_id, filename):
     """直接提供实时HLS片段文件"""  
-    # 简化版本：直接尝试访问文件，不检查会话（适用于重启后的情况）
+    # 只校验播放令牌，不依赖进程内会话，服务重启后依然可用
+    if not verify_playback_token(request.GET.get('token'), session_id):
+        return HttpResponseForbidden('无效的播放令牌')
+    
+    content_type = segment_content_type(filename)
+    if content_type is None:
+        return HttpResponseNotFound('视频片段不存在')
+    
+    # 记录播放位置，转码领先过多时暂停
+    TranscodingService.note_realtime_playhead(session_id, filename, request.META.get('HTTP_RANGE'))
     
     # 组装片段文件路径
-    from django.conf import settings
-    TRANSCODED_DIR = os.path.join(settings.MEDIA_ROOT, 'transcoded')
-    segment_path = os.path.join(TRANSCODED_DIR, f"realtime_{session_id}", filename)
+    segment_path = realtime_output_path(session_id, filename)
+    cache_control = segment_cache_control(segment_path)
     
-    if not os.path.exists(segment_path):
+    try:
+        response = serve_file(
+            request, segment_path, content_type=content_type, cache_control=cache_control,
+            cacheable=cache_control == IMMUTABLE_CACHE_CONTROL
+        )
+    except FileNotFoundError:
         return HttpResponseNotFound('视频片段不存在')
-    
-    # 使用StreamingHttpResponse减少内存占用
-    def file_iterator(file_path, chunk_size=8192):
-        with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                yield chunk
-    
-    response = StreamingHttpResponse(file_iterator(segment_path), content_type='video/MP2T')
-    response['Content-Length'] = str(os.path.getsize(segment_path))
-    response['Cache-Control'] = 'max-age=300'  # 缓存5分钟
     response['Access-Control-Allow-Origin'] = '*'  # 允许跨域访问
     
     return response
@@ -1142,26 +1475,29 @@ def serve_realtime_segment(request, session_id, filename):
 @login_required
 @require_POST
 def stop_realtime_session(request):
-    """停止实时转码会话"""
+    """
+    停止实时转码会话
+    
+    请求体为JSON，或者表单（页面关闭时navigator.sendBeacon发送，CSRF令牌放在csrfmiddlewaretoken字段）
+    """
     try:
-        data = json.loads(request.body)
+        if request.content_type == 'application/json':
+            data = json.loads(request.body)
+        else:
+            data = request.POST
         session_id = data.get('session_id')
         
         if not session_id:
             return JsonResponse({'success': False, 'error': '缺少会话ID'})
         
-        # 验证会话是否属于当前用户
-        if 'realtime_sessions' not in request.session or session_id not in request.session['realtime_sessions']:
+        # 验证播放令牌是否属于该会话和当前用户
+        if not verify_playback_token(data.get('token'), session_id, request.user.id):
             return JsonResponse({'success': False, 'error': '无效的转码会话'})
         
-        # 停止会话
-        result = TranscodingService.stop_realtime_session(session_id)
+        # 停止会话：会话可能在其他worker进程中，由所在进程根据停止标记停止
+        result = TranscodingService.request_stop_realtime(session_id)
         
         if result['success']:
-            # 从用户会话中移除
-            request.session['realtime_sessions'].remove(session_id)
-            request.session.modified = True
-            
             return JsonResponse({
                 'success': True,
                 'message': '实时转码会话已停止'
@@ -1176,4 +1512,109 @@ def stop_realtime_session(request):
         return JsonResponse({
             'success': False,
             'error': str(e)
-        }) 
\ No newline at end of file
+        }) 
+
+
+@login_required
+@require_GET
+def ondemand_transcode_request(request, pk, resolution):
+    """请求即时分段转码：立即返回覆盖完整时长的播放列表地址，片段在播放时按需转码"""
+    movie = get_object_or_404(Movie, pk=pk)
+    
+    try:
+        transcode = get_ondemand(movie.file_path, resolution)
+    except FileNotFoundError:
+        return JsonResponse({'success': False, 'error': '视频文件不存在'})
+    except (ValueError, SegmentUnavailable) as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+    
+    if resolution not in TranscodingService.get_available_resolutions(movie.file_path):
+        return JsonResponse({'success': False, 'error': f'不支持的分辨率: {resolution}'})
+    
+    # 视频可以直接复制时使用实时转码：复制几乎不占CPU，首片段立即可用；
+    # 即时分段需要精确的片段边界，只能重新编码
+    plan = TranscodingService.stream_plan(TranscodingService.get_video_info(movie.file_path), resolution)
+    if plan['video'] == 'copy':
+        return JsonResponse({'success': False, 'remux': True, 'error': '视频可以直接复制，请使用实时转码'})
+    
+    token = ondemand_token(request, movie, resolution)
+    if isinstance(token, dict):
+        return JsonResponse(token)
+    return JsonResponse({
+        'success': True,
+        'hls_url': f"{reverse('ondemand_playlist', args=[pk, resolution])}?{urlencode({'token': token})}",
+        'resolution': resolution,
+        'duration': transcode.duration,
+        'segment_time': transcode.segment_time,
+    })
+
+
+def ondemand_token(request, movie, resolution):
+    """占用用户的转码配额后签发即时分段转码的播放令牌（带配额会话ID），超出配额时返回错误响应内容"""
+    reservation = reserve_quota(request.user, movie, resolution, kind='ondemand')
+    if not reservation['success']:
+        return {'success': False, 'quota': True, 'error': reservation['error']}
+    return issue_playback_token(
+        playback_scope(movie.pk, resolution), request.user.id, quota_session=reservation['session_id']
+    )
+
+
+@require_GET
+def ondemand_playlist(request, pk, resolution):
+    """即时转码的完整VOD播放列表"""
+    token = request.GET.get('token')
+    payload = load_playback_token(token, playback_scope(pk, resolution))
+    if payload is None:
+        return HttpResponseForbidden('无效的播放令牌')
+    if not playback_session_active(payload):
+        return HttpResponseForbidden('转码会话已结束')
+    
+    movie = get_object_or_404(Movie, pk=pk)
+    try:
+        transcode = get_ondemand(movie.file_path, resolution)
+    except (FileNotFoundError, ValueError, SegmentUnavailable):
+        return HttpResponseNotFound('HLS文件不存在')
+    
+    # 片段地址与播放列表同目录：<index>.ts
+    prefix = reverse('ondemand_transcode_request', args=[pk, resolution])
+    query = urlencode({'token': token})
+    content = transcode.playlist(lambda index: f"{prefix}{index}.ts?{query}")
+    
+    response = HttpResponse(content, content_type=PLAYLIST_CONTENT_TYPE)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@require_GET
+def ondemand_segment(request, pk, resolution, index):
+    """
+    即时转码片段：尚未生成时启动转码并等待
+
+    同步worker只等待 request_timeout 秒（远小于worker超时），片段仍未生成时返回503和Retry-After，
+    转码进程继续运行，播放器重试时取得片段；重试落到其他worker时按认领文件等待同一个转码进程
+    """
+    payload = load_playback_token(request.GET.get('token'), playback_scope(pk, resolution))
+    if payload is None:
+        return HttpResponseForbidden('无效的播放令牌')
+    if not playback_session_active(payload):
+        return HttpResponseForbidden('转码会话已结束')
+    
+    movie = get_object_or_404(Movie, pk=pk)
+    try:
+        transcode = get_ondemand(movie.file_path, resolution)
+        segment_path = transcode.get_segment(index, timeout=TRANSCODING_CONFIG['ondemand']['request_timeout'])
+    except (FileNotFoundError, ValueError, IndexError):
+        return HttpResponseNotFound('视频片段不存在')
+    except SegmentUnavailable as e:
+        logger.warning(f"⚠️ {e}")
+        response = HttpResponse(str(e), status=503)
+        response['Retry-After'] = '1'
+        return response
+    
+    # 生成后的片段不会再变化
+    try:
+        return serve_file(
+            request, segment_path, content_type='video/MP2T', cache_control=IMMUTABLE_CACHE_CONTROL, cacheable=True
+        )
+    except FileNotFoundError:
+        return HttpResponseNotFound('视频片段不存在')
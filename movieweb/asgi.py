@@ -0,0 +1,41 @@
+import os
+import asyncio
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'movieweb.settings')
+# 视频和HLS端点使用异步视图
+os.environ.setdefault('DJANGO_ROOT_URLCONF', 'movieweb.urls_asgi')
+
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """
+    在Django外层监听客户端断开
+
+    Django 4.2 在流式响应过程中不会检查 http.disconnect，拖动进度条时浏览器频繁中止的
+    Range请求会继续读完整个文件。这里转发receive消息，收到断开时取消请求任务，
+    异步迭代器随之关闭文件。
+    """
+    if scope['type'] != 'http':
+        return await django_application(scope, receive, send)
+
+    queue = asyncio.Queue()
+    app_task = asyncio.ensure_future(django_application(scope, queue.get, send))
+
+    async def pump():
+        while True:
+            message = await receive()
+            await queue.put(message)
+            if message['type'] == 'http.disconnect':
+                app_task.cancel()
+                return
+
+    pump_task = asyncio.ensure_future(pump())
+    try:
+        await app_task
+    except asyncio.CancelledError:
+        if not pump_task.done():
+            raise
+    finally:
+        pump_task.cancel()
@@ -56,7 +56,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'movieweb.urls'
+# ASGI入口（movieweb.asgi）会改用 movieweb.urls_asgi，将视频和HLS端点切换为异步视图
+ROOT_URLCONF = os.getenv('DJANGO_ROOT_URLCONF', 'movieweb.urls')
 
 TEMPLATES = [
     {
@@ -75,6 +76,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'movieweb.wsgi.application'
+ASGI_APPLICATION = 'movieweb.asgi.application'
 
 # Database
 DATABASES = {
@@ -124,6 +126,82 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 VIDEO_ROOT_PATH = os.getenv('VIDEO_ROOT_PATH', r'D:\Videos')
 VIDEO_EXTENSIONS = ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', '.m4v']
 
+# 媒体传输卸载：Django只负责鉴权，字节传输交给前端Web服务器
+# '' 关闭（由Django/gunicorn自己发送）
+# 'nginx' 使用 X-Accel-Redirect
+# 'apache' / 'lighttpd' 使用 X-Sendfile
+MEDIA_OFFLOAD_MODE = os.getenv('MEDIA_OFFLOAD_MODE', '').lower()
+
+# 文件系统目录 -> nginx internal location 前缀（需与 deploy/nginx.conf 保持一致）
+# X-Sendfile 模式下直接使用文件绝对路径，这里的目录仅作为允许卸载的白名单
+MEDIA_OFFLOAD_LOCATIONS = {
+    VIDEO_ROOT_PATH: os.getenv('MEDIA_OFFLOAD_LIBRARY_LOCATION', '/_protected/library/'),
+    os.path.join(MEDIA_ROOT, 'transcoded'): os.getenv('MEDIA_OFFLOAD_TRANSCODED_LOCATION', '/_protected/transcoded/'),
+}
+
+# 媒体流读取的页缓存策略（posix_fadvise，Windows等不支持的平台上不生效）
+# 预读窗口 = 客户端消费速率 × window_seconds，限制在 [min_window, max_window] 之间
+# drop_behind: 读过的数据立即从页缓存丢弃（同一文件有多个流同时读取时除外）
+STREAM_READAHEAD_DEFAULT = {
+    'enabled': os.getenv('STREAM_READAHEAD', 'True').lower() == 'true',
+    'min_window': 2 * 1024 * 1024,
+    'max_window': 64 * 1024 * 1024,
+    'window_seconds': 10,
+    'drop_behind': False,
+}
+# 按目录覆盖默认策略（最长匹配）
+STREAM_READAHEAD_POLICIES = {
+    # 媒体库原片多为一次性观看的冷数据，读过即丢弃，避免挤出热点转码片段
+    VIDEO_ROOT_PATH: {'drop_behind': True},
+    os.path.join(MEDIA_ROOT, 'transcoded'): {'max_window': 16 * 1024 * 1024},
+}
+
+# 热点HLS片段进程内缓存（每个worker进程独立），0 表示关闭
+HLS_SEGMENT_CACHE_BYTES = int(os.getenv('HLS_SEGMENT_CACHE_BYTES', 256 * 1024 * 1024))
+# 单个片段超过该大小时不缓存
+HLS_SEGMENT_CACHE_MAX_ITEM_BYTES = int(os.getenv('HLS_SEGMENT_CACHE_MAX_ITEM_BYTES', 16 * 1024 * 1024))
+
+# 媒体流限速（令牌桶），默认关闭
+# 单连接速率 = 视频码率 × bitrate_multiplier（不低于min_rate），开始时允许突发burst_seconds秒的数据
+# egress_cap为每个worker进程的出口带宽上限（字节/秒），在所有受控流之间公平分配，0表示不限制
+# 进程内限速和出口上限只在ASGI端点生效；同步gunicorn worker不在进程内限速，只设置X-Accel-Limit-Rate由nginx限速
+STREAM_PACING = {
+    'enabled': os.getenv('STREAM_PACING', 'False').lower() == 'true',
+    'bitrate_multiplier': float(os.getenv('STREAM_PACING_MULTIPLIER', 1.5)),
+    'min_rate': 256 * 1024,
+    # 码率未知时的单连接速率（字节/秒），0表示只受出口上限约束
+    'default_rate': 0,
+    'burst_seconds': 20,
+    'egress_cap': int(float(os.getenv('STREAM_EGRESS_CAP_MBPS', 0)) * 1000 * 1000 / 8),
+}
+
+# 热点媒体文件打开句柄缓存（每个worker进程独立），0 表示关闭
+MEDIA_FD_CACHE_SIZE = int(os.getenv('MEDIA_FD_CACHE_SIZE', 64))
+# 每隔多少秒按路径重新stat一次，发现文件被替换或删除
+MEDIA_FD_CACHE_REVALIDATE = float(os.getenv('MEDIA_FD_CACHE_REVALIDATE', 1.0))
+# 空闲句柄保留时间（秒），Windows下打开的文件无法删除或重命名，不宜过长
+MEDIA_FD_CACHE_IDLE_TIMEOUT = float(os.getenv('MEDIA_FD_CACHE_IDLE_TIMEOUT', 30))
+
+# FFmpeg能力注册表（版本、编码器、硬件加速方式等探测结果），同一主机上的所有worker进程共用
+FFMPEG_CAPABILITIES_FILE = os.getenv('FFMPEG_CAPABILITIES_FILE', str(BASE_DIR / 'cache' / 'ffmpeg_capabilities.json'))
+
+# 实时转码播放令牌有效期（秒），需要覆盖一次完整的观看
+REALTIME_TOKEN_MAX_AGE = int(os.getenv('REALTIME_TOKEN_MAX_AGE', 6 * 3600))
+
+# 媒体边缘服务器（python manage.py run_media_edge）
+# 设置对外地址后，Django为视频和转码输出签发指向边缘服务器的签名URL；为空则不启用
+MEDIA_EDGE_URL = os.getenv('MEDIA_EDGE_URL', '').rstrip('/')
+# 签名密钥，Django和边缘服务器必须一致
+MEDIA_EDGE_SECRET = os.getenv('MEDIA_EDGE_SECRET', SECRET_KEY)
+# 签名URL有效期（秒），需要覆盖一次完整的观看
+MEDIA_EDGE_TTL = int(os.getenv('MEDIA_EDGE_TTL', 6 * 3600))
+# 边缘服务器允许提供的媒体库目录（多个目录用系统路径分隔符分隔），签名URL中记录的是目录序号
+MEDIA_EDGE_LIBRARY_ROOTS = [
+    root for root in os.getenv('MEDIA_EDGE_LIBRARY_ROOTS', '').split(os.pathsep) if root
+] or [VIDEO_ROOT_PATH]
+MEDIA_EDGE_BIND = os.getenv('MEDIA_EDGE_BIND', '0.0.0.0')
+MEDIA_EDGE_PORT = int(os.getenv('MEDIA_EDGE_PORT', 8090))
+
 # Login URLs
 LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/'
@@ -1,7 +1,8 @@
 from django.contrib import admin
-from django.urls import path, include
+import re
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+from movies import views as movie_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -9,6 +10,8 @@ urlpatterns = [
     path('accounts/', include('accounts.urls')),
 ]
 
-# Serve media files in development
+# Serve media files in development（带ETag和条件请求支持）
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) 
\ No newline at end of file
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), movie_views.serve_media, name='serve_media'),
+    ]
@@ -0,0 +1,19 @@
+"""
+ASGI入口使用的URL配置
+
+视频和HLS端点替换为 movies.async_views 中的异步版本（路径与同步版本一致），
+其余路由沿用 movieweb.urls。这里的路由不设置name，反向解析仍落在同步路由上。
+"""
+from django.urls import path, include
+from movies import async_views
+
+urlpatterns = [
+    path('movie/<int:pk>/serve/', async_views.serve_video),
+    path('movie/<int:pk>/hls/<str:resolution>/', async_views.serve_hls_video),
+    path('movie/<int:pk>/hls/<str:resolution>/<str:filename>', async_views.serve_hls_segment),
+    path('api/realtime/segment/<str:session_id>/<str:segment_name>', async_views.realtime_segment),
+    path('api/realtime/<str:session_id>/hls/<str:filename>', async_views.serve_realtime_hls),
+    path('api/realtime/<str:session_id>/ts/<str:filename>', async_views.serve_realtime_segment),
+    path('api/<int:pk>/ondemand/<str:resolution>/<int:index>.ts', async_views.ondemand_segment),
+    path('', include('movieweb.urls')),
+]